@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import bisect
+import hashlib
+import threading
+import logging
+import atexit
+from typing import Callable, Dict, List
+
+sys.path.append("..")
+import common
+
+logger = logging.getLogger(__name__)
+
+def _hash(key : str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing():
+    '''
+    Consistent hash ring, each node is placed 'vnodes' times so that a join or a leave
+    only moves about 1/n of the keys
+    '''
+
+    def __init__(self, nodes : List[str], vnodes : int = 64) -> None:
+        self.nodes = sorted(nodes)
+        points = sorted((_hash(node + "#" + str(i)), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key : str) -> str:
+        if len(self.hashes) == 0:
+            return None
+        pos = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.owners[pos]
+
+class Cluster():
+    '''
+    Nodes sharing a directory split the periodic work between them
+        node_id : unique name of this node
+        shared_dir : membership directory, each live node keeps a heartbeat file in it, default '<home>/cluster'
+        shard_by : 'task' gives each (tenant, task) to one node,
+                   'series' schedules every task on every node and each node keeps the series it owns
+        heartbeat_every : period of the heartbeat and of the membership check
+        node_timeout : a node whose heartbeat is older than this has left
+    The task folder and the model folder of the home must be shared by the nodes too,
+    so that tasks and checkpoints follow their shard.
+    '''
+
+    def __init__(self, node_id : str, shared_dir : str = None, shard_by : str = "task", vnodes : int = 64,
+                 heartbeat_every : str = "5s", node_timeout : str = "15s", address : str = None) -> None:
+        if node_id is None or node_id == "" or "/" in node_id:
+            raise ValueError("[CONFIG](Cluster) 'node_id' is invalid")
+        if shard_by not in ("task", "series"):
+            raise ValueError("[CONFIG](Cluster) 'shard_by' is invalid")
+        if not (common.check_time_range_str(heartbeat_every) and common.check_time_range_str(node_timeout)):
+            raise ValueError("[CONFIG](Cluster) 'heartbeat_every' or 'node_timeout' is invalid")
+        self.node_id = node_id
+        self.shared_dir = shared_dir
+        self.shard_by = shard_by
+        self.vnodes = vnodes
+        self.address = address
+        self.heartbeat_sec = common.parse_time_range_str(heartbeat_every)
+        self.timeout_sec = common.parse_time_range_str(node_timeout)
+        if self.timeout_sec <= self.heartbeat_sec:
+            raise ValueError("[CONFIG](Cluster) 'node_timeout' must be longer than 'heartbeat_every'")
+        self.ring = HashRing([node_id], vnodes)
+        self.listeners : List[Callable[[bool], None]] = []
+        self.stopped = threading.Event()
+
+    def __heartbeat_path(self, node_id : str) -> str:
+        return os.path.join(self.shared_dir, node_id + ".node")
+
+    def start(self) -> None:
+        if self.shared_dir is None:
+            self.shared_dir = os.path.join(common.home_folder, 'cluster')
+        os.makedirs(self.shared_dir, exist_ok=True)
+        self.__heartbeat()
+        self.ring = HashRing(self.live_nodes(), self.vnodes)
+        logger.info("[Cluster] node %s joined, nodes = %s", self.node_id, self.ring.nodes)
+        atexit.register(self.stop)
+        threading.Thread(target=self.__run, name="cluster-heartbeat", daemon=True).start()
+
+    def stop(self) -> None:
+        '''
+        leave the cluster, the other nodes take over the shard on their next check
+        '''
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        path = self.__heartbeat_path(self.node_id)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def on_tick(self, listener : Callable[[bool], None]) -> None:
+        '''
+        listener(changed) is called after each membership check, 'changed' is True if nodes joined or left
+        '''
+        self.listeners.append(listener)
+
+    def __heartbeat(self) -> None:
+        path = self.__heartbeat_path(self.node_id)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({"node_id": self.node_id, "address": self.address, "pid": os.getpid(), "ts": time.time()}, f)
+        os.replace(path + ".tmp", path)
+
+    def live_nodes(self) -> List[str]:
+        now = time.time()
+        nodes = [self.node_id]
+        for fname in os.listdir(self.shared_dir):
+            if not fname.endswith(".node"):
+                continue
+            node_id = fname[:-len(".node")]
+            if node_id == self.node_id:
+                continue
+            try:
+                if now - os.path.getmtime(os.path.join(self.shared_dir, fname)) <= self.timeout_sec:
+                    nodes.append(node_id)
+            except OSError:
+                # removed by a leaving node
+                continue
+        return sorted(nodes)
+
+    def __run(self) -> None:
+        while not self.stopped.wait(self.heartbeat_sec):
+            try:
+                self.__heartbeat()
+                nodes = self.live_nodes()
+                changed = nodes != self.ring.nodes
+                if changed:
+                    logger.info("[Cluster] membership changed : %s -> %s", self.ring.nodes, nodes)
+                    self.ring = HashRing(nodes, self.vnodes)
+            except Exception as e:
+                logger.error("[Cluster] heartbeat error : %s", e)
+                continue
+            for listener in self.listeners:
+                try:
+                    listener(changed)
+                except Exception as e:
+                    logger.error("[Cluster] rebalance error : %s", e)
+
+    def owns_task(self, tenant : str, task_name : str) -> bool:
+        if self.shard_by != "task":
+            return True
+        return self.ring.owner(str(tenant) + "/" + task_name) == self.node_id
+
+    def owns_series(self, series_id : str) -> bool:
+        if self.shard_by != "series":
+            return True
+        return self.ring.owner(series_id) == self.node_id
+
+    def status(self) -> Dict[str, object]:
+        return {"node_id": self.node_id, "shard_by": self.shard_by, "nodes": list(self.ring.nodes)}
@@ -8,23 +8,38 @@ import threading
 home_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 task_folder = None
 model_folder = None
+spill_folder = None
+store_folder = None
 output_metrics_prefix = "_model_output"
 threadlocal = threading.local()
 
-def check_home_folder(specified_home_folder = None):
-    global home_folder, task_folder, model_folder
+def check_home_folder(specified_home_folder = None, node_id : str = None):
+    '''
+    node_id : nodes of a cluster share the home folder, each one spills its instances to 'spill/<node_id>'
+    '''
+    global home_folder, task_folder, model_folder, spill_folder, store_folder
     if specified_home_folder is not None:
         if not os.path.isdir(specified_home_folder):
             raise IOError("Unknown home path : %s", specified_home_folder)
         home_folder = specified_home_folder
     task_folder = os.path.join(home_folder, 'task')
     model_folder = os.path.join(home_folder, 'model')
+    spill_folder = os.path.join(home_folder, 'spill', node_id if node_id is not None else 'local')
+    store_folder = os.path.join(home_folder, 'store')
     if not os.path.isdir(home_folder):
         os.makedirs(home_folder)
     if not os.path.isdir(task_folder):
         os.mkdir(task_folder)
     if not os.path.isdir(model_folder):
         os.mkdir(model_folder)
+    if not os.path.isdir(spill_folder):
+        os.makedirs(spill_folder)
+    if not os.path.isdir(store_folder):
+        os.mkdir(store_folder)
+    # spilled instances only live as long as the process, the folders of the other nodes are left alone
+    for fname in os.listdir(spill_folder):
+        if fname.endswith(".spill"):
+            os.remove(os.path.join(spill_folder, fname))
 
 def map_hash(map : dict) -> str :
     raw_str = ""
@@ -32,6 +47,12 @@ def map_hash(map : dict) -> str :
         raw_str += str(k) + ":" + str(map[k]) + ";"
     return hashlib.md5(raw_str.encode(encoding='utf-8')).hexdigest()
 
+def format_labels(labels : dict) -> str:
+    '''
+    render a label set as '{k1="v1",k2="v2"}'
+    '''
+    return "{" + ",".join([k+"=\""+v+"\"" for k,v in labels.items()]) + "}"
+
 def check_time_range_str(time_range : str):
     return re.match(r'^([0-9])+(s|m|h|d|w)+$', time_range) is not None
     
@@ -54,12 +75,60 @@ def parse_time_range_str(time_range : str) -> int :
 
 def default_time_window(whole_period : str, points : int) -> str:
     seconds = parse_time_range_str(whole_period)
-    window_sec = seconds / points
+    window_sec = seconds // points
     if window_sec <= 0:
         window_sec = 1
     return str(window_sec) + "s"
 
-def get_model_checkpoint_path(tenant : int, task_name : str) -> str:
+def get_model_checkpoint_path(tenant : int, task_name : str, node : str = None) -> str:
+    '''
+    node : set in a cluster sharded by series, each node saves the models of its own series
+    '''
     tenant_dir_list = os.path.join(model_folder, str(tenant))
+    if not os.path.isdir(tenant_dir_list):
+        os.makedirs(tenant_dir_list, exist_ok=True)
     ts = str(int(time.time()))
-    return os.path.join(tenant_dir_list, task_name + "_" + ts + ".checkpoint")
\ No newline at end of file
+    if node is not None:
+        ts += "." + node
+    return os.path.join(tenant_dir_list, task_name + "_" + ts + ".checkpoint")
+
+def list_model_checkpoints(tenant : int, task_name : str, node : str = None, all_nodes : bool = False) -> list:
+    '''
+    checkpoint paths of a task saved by 'node' (None : not sharded by series), or by any node if 'all_nodes', the newest first
+    '''
+    tenant_dir_list = os.path.join(model_folder, str(tenant))
+    if not os.path.isdir(tenant_dir_list):
+        return []
+    prefix = task_name + "_"
+    checkpoints = []
+    for fname in os.listdir(tenant_dir_list):
+        if not (fname.startswith(prefix) and fname.endswith(".checkpoint")):
+            continue
+        # '<ts>' or '<ts>.<node>'
+        ts, _, saved_by = fname[len(prefix):-len(".checkpoint")].partition(".")
+        if not ts.isdigit():
+            continue
+        if all_nodes or saved_by == (node if node is not None else ""):
+            checkpoints.append((int(ts), os.path.join(tenant_dir_list, fname)))
+    return [path for _, path in sorted(checkpoints, reverse=True)]
+
+def remove_model_checkpoints(tenant : int, task_name : str, keep : str = None, node : str = None, all_nodes : bool = False) -> None:
+    for path in list_model_checkpoints(tenant, task_name, node, all_nodes):
+        if path != keep:
+            os.remove(path)
+
+def get_spill_path(name : str) -> str:
+    folder = spill_folder if spill_folder is not None else os.path.join(home_folder, 'spill', 'local')
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, name + ".spill")
+
+def get_store_dir(tenant : str, key : str) -> str:
+    '''
+    folder of the stored series of one query of a tenant
+    '''
+    folder = store_folder if store_folder is not None else os.path.join(home_folder, 'store')
+    path = os.path.join(folder, str(tenant), key)
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    return path
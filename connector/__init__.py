@@ -1,4 +1,5 @@
 from connector.victoriametrics import Victoriametrics
 from connector.mqpulsar import Pulsar
-from connector._interface import Connector
+from connector._interface import Connector, StreamBatch
+from connector._series import SeriesBlock
 from connector.stdio import Stdio
\ No newline at end of file
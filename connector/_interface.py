@@ -1,16 +1,24 @@
 from abc import abstractmethod, ABCMeta
-from typing import Dict, Tuple, Any, List
+from typing import Callable, Dict, Tuple, Any, List
 import sys
+import asyncio
 
+import numpy as np
 import pandas as pd
 
 sys.path.append("..")
 import common
 
+# samples of a micro-batch : {sorted label items : ({label: value} with '__name__', unix seconds int64, values float64)}
+StreamBatch = Dict[Tuple[Tuple[str, str], ...], Tuple[Dict[str,str], np.ndarray, np.ndarray]]
+
 class Connector(metaclass=ABCMeta): 
     """
     Connector interface
     """
+    # max number of queries in flight on this connector, shared by every task of a scheduler
+    query_concurrency : int = 8
+
     @abstractmethod
     def check_query_args(self, args : dict[str,Any]):
         '''
@@ -30,10 +38,19 @@ class Connector(metaclass=ABCMeta):
         '''
         query series data
         return:
-            Exception, {'series_id': returned dataframe}, {'series_id': {'label_key': 'label_value'}}
+            {'series_id': returned dataframe}, {'series_id': {'label_key': 'label_value'}}
+            the first mapping may be a lazy SeriesBlock which builds the dataframe on lookup
         '''
         pass
 
+    async def query_series_async(self, tenant : str, query_name : str, queries : str, sampling_period : str, query_length: str) -> Tuple[Dict[str,pd.DataFrame],Dict[str,Dict[str,str]]]:
+        '''
+        awaitable variant of query_series, runs it on the default executor of the running loop,
+        connectors with a native async client may override it
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.query_series, tenant, query_name, queries, sampling_period, query_length)
+
     @abstractmethod
     def insert_series(self, tenant : str, metrics : List[str], labels : List[dict], values : List[Dict[str,str]]) -> bool:
         '''
@@ -42,4 +59,28 @@ class Connector(metaclass=ABCMeta):
         values: { timestamp_unix_seconds : value }, list
         '''
         pass
-    
+
+    def insert_result(self, tenant : str, metrics_prefix : str, query_name : str, labels : Dict[str,str], result : Any) -> bool:
+        '''
+        write every column of a model.InferResult,
+        connectors may override it to write the columns without building per sample dicts
+        '''
+        # query results may be shared by several tasks, their labels are not modified
+        metrics, values, labels_list = result.to_metrics(metrics_prefix, query_name, dict(labels))
+        return self.insert_series(tenant, metrics, labels_list, values)
+
+    def flush(self, tenant : str = None) -> bool:
+        '''
+        wait until the series and results inserted so far for 'tenant' (every tenant if None) are written,
+        connectors buffering their writes override it
+        return: False if some of them could not be written
+        '''
+        return True
+
+    def subscribe(self, tenant : str, listener : Callable[[StreamBatch], bool]) -> Callable[[], None]:
+        '''
+        deliver the samples pushed to the connector for the tenant in micro-batches,
+        a batch is acknowledged once every listener returned True, it is delivered again if one returned False or raised
+        return: a function removing the listener
+        '''
+        raise RuntimeError("[CONFIG](" + type(self).__name__ + ") cannot stream samples !")
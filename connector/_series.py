@@ -0,0 +1,134 @@
+import gc
+import sys
+import contextlib
+from collections.abc import Mapping
+from itertools import chain
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+sys.path.append("..")
+import common
+
+@contextlib.contextmanager
+def _gc_paused():
+    '''
+    a query result is millions of small objects that live for a few milliseconds,
+    pausing the cyclic gc while decoding avoids repeated full collections
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class SeriesBlock(Mapping):
+    '''
+    Columnar query result, behaves like {series_id : DataFrame{columns=['ds', 'y']}}
+        ts : int64 unix seconds of every sample of every series, concatenated
+        values : float64 values, aligned with ts
+        offsets : samples of the i-th series are [offsets[i], offsets[i+1])
+    DataFrames are only built when a series is looked up.
+    '''
+
+    def __init__(self, ids : List[str], labels : Dict[str, Dict[str,str]],
+                 ts : np.ndarray, values : np.ndarray, offsets : np.ndarray) -> None:
+        self.ids = ids
+        self.labels = labels
+        self.ts = ts
+        self.values = values
+        self.offsets = offsets
+        # series_id -> position, the last series wins on duplicated labels
+        self.index : Dict[str, int] = {sid: pos for pos, sid in enumerate(ids)}
+
+    def __getitem__(self, series_id : str) -> pd.DataFrame:
+        ts, values = self.arrays(series_id)
+        ds = (ts * 1000000000).view('datetime64[ns]')
+        return pd.DataFrame({'ds': ds, 'y': values}, copy=False)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, series_id : Any) -> bool:
+        return series_id in self.index
+
+    def arrays(self, series_id : str) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        return: (timestamps, values) of one series, views on the shared buffers
+        '''
+        pos = self.index[series_id]
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        return self.ts[start:end], self.values[start:end]
+
+    def select(self, series_ids : List[str]) -> 'SeriesBlock':
+        '''
+        a block of the given series only, their samples are copied into new buffers
+        '''
+        series_ids = [sid for sid in series_ids if sid in self.index]
+        parts = [self.arrays(sid) for sid in series_ids]
+        offsets = np.zeros(len(series_ids) + 1, dtype=np.int64)
+        np.cumsum([len(ts) for ts, _ in parts], out=offsets[1:])
+        ts = np.concatenate([ts for ts, _ in parts]) if len(parts) > 0 else np.empty(0, dtype=np.int64)
+        values = np.concatenate([values for _, values in parts]) if len(parts) > 0 else np.empty(0, dtype=np.float64)
+        return SeriesBlock(series_ids, {sid: self.labels[sid] for sid in series_ids}, ts, values, offsets)
+
+    def renamed(self, query_name : str) -> 'SeriesBlock':
+        '''
+        the same samples under the series ids 'decode' gives for another query name, the buffers are shared
+        '''
+        ids = []
+        labels = {}
+        new_ids = {}
+        for sid in self.ids:
+            new_sid = new_ids.get(sid)
+            if new_sid is None:
+                label = dict(self.labels[sid])
+                if query_name is not None and query_name != '':
+                    label['__name__'] = query_name
+                new_sid = common.map_hash(label)
+                new_ids[sid] = new_sid
+                labels[new_sid] = dict(self.labels[sid])
+            ids.append(new_sid)
+        return SeriesBlock(ids, labels, self.ts, self.values, self.offsets)
+
+    @staticmethod
+    def decode(content : bytes, query_name : str) -> 'SeriesBlock':
+        '''
+        decode a prometheus 'query_range' response body in one pass
+        return: None if no series returned
+        '''
+        with _gc_paused():
+            data = _json.loads(content)
+            result = data["data"]["result"]
+            if result is None or len(result) == 0:
+                return None
+            ids : List[str] = []
+            labels : Dict[str, Dict[str,str]] = {}
+            counts = np.empty(len(result), dtype=np.int64)
+            for pos, metric in enumerate(result):
+                label : dict = metric["metric"]
+                if query_name is not None and query_name != '':
+                    label['__name__'] = query_name
+                sid = common.map_hash(label)
+                label.pop('__name__', None)
+                ids.append(sid)
+                labels[sid] = label
+                counts[pos] = len(metric["values"])
+            offsets = np.zeros(len(result) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            total = int(offsets[-1])
+            samples = list(chain.from_iterable(metric["values"] for metric in result))
+            ts = np.rint(np.fromiter((s[0] for s in samples), dtype=np.float64, count=total)).astype(np.int64)
+            values = np.array([s[1] for s in samples], dtype=np.float64)
+        return SeriesBlock(ids, labels, ts, values, offsets)
@@ -0,0 +1,151 @@
+import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from connector._series import SeriesBlock
+
+logger = logging.getLogger(__name__)
+
+# (tenant, query_name, queries, step seconds)
+CacheKey = Tuple[str, str, str, int]
+# fetch(start, end) -> SeriesBlock or None, start/end are unix seconds aligned to the step
+Fetcher = Callable[[int, int], SeriesBlock]
+
+class _CacheEntry():
+
+    def __init__(self, block : SeriesBlock, start : int, end : int) -> None:
+        self.block = block
+        self.start = start
+        self.end = end
+        self.nbytes = _block_nbytes(block)
+
+def _block_nbytes(block : SeriesBlock) -> int:
+    if block is None:
+        return 0
+    # labels and ids are small python objects, count a rough 256 bytes per series
+    return block.ts.nbytes + block.values.nbytes + block.offsets.nbytes + 256 * len(block.ids)
+
+def _seal(block : SeriesBlock) -> SeriesBlock:
+    # cached buffers are shared by every caller, models must not write into them
+    block.ts.flags.writeable = False
+    block.values.flags.writeable = False
+    return block
+
+def merge_blocks(older : SeriesBlock, newer : SeriesBlock, start : int, newer_start : int) -> SeriesBlock:
+    '''
+    keep the samples of 'older' in [start, newer_start) followed by every sample of 'newer'
+    series missing from 'newer' keep their older samples
+    '''
+    ids : List[str] = []
+    labels : Dict[str, Dict[str,str]] = {}
+    ts_parts : List[np.ndarray] = []
+    value_parts : List[np.ndarray] = []
+    counts : List[int] = []
+    sids = list(older.index.keys()) if older is not None else []
+    if newer is not None:
+        sids.extend(sid for sid in newer.index.keys() if older is None or sid not in older.index)
+    for sid in sids:
+        ts_list = []
+        value_list = []
+        if older is not None and sid in older.index:
+            ts, values = older.arrays(sid)
+            lo, hi = np.searchsorted(ts, [start, newer_start])
+            ts_list.append(ts[lo:hi])
+            value_list.append(values[lo:hi])
+            labels[sid] = older.labels[sid]
+        if newer is not None and sid in newer.index:
+            ts, values = newer.arrays(sid)
+            lo = np.searchsorted(ts, start)
+            ts_list.append(ts[lo:])
+            value_list.append(values[lo:])
+            labels[sid] = newer.labels[sid]
+        count = sum(len(part) for part in ts_list)
+        if count == 0:
+            labels.pop(sid, None)
+            continue
+        ids.append(sid)
+        ts_parts.extend(ts_list)
+        value_parts.extend(value_list)
+        counts.append(count)
+    if len(ids) == 0:
+        return None
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return SeriesBlock(ids, labels, np.concatenate(ts_parts), np.concatenate(value_parts), offsets)
+
+class SeriesCache():
+    '''
+    Incremental cache of range query results, one entry per (tenant, query_name, queries, step)
+        - windows are aligned to the step, so consecutive runs share all samples but the newest ones
+        - only the missing tail (plus 'overlap' seconds of possibly incomplete samples) is fetched
+        - an entry keeps the longest window queried, a shorter one (infer and fit windows of a task) is sliced from it
+        - entries are evicted in LRU order once 'max_bytes' is exceeded
+    '''
+
+    def __init__(self, max_bytes : int, overlap : int = 60) -> None:
+        self.max_bytes = max_bytes
+        self.overlap = overlap
+        self.entries : OrderedDict[CacheKey, _CacheEntry] = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fetched_points = 0
+        self.served_points = 0
+
+    def query(self, key : CacheKey, length : int, now : float, fetch : Fetcher) -> SeriesBlock:
+        step = key[3]
+        end = int(now // step) * step
+        start = end - int(math.ceil(length / step)) * step
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        kept_start = start
+        if entry is not None and entry.start <= start and entry.end >= start:
+            # the window of the entry slides with 'end', its older samples are kept for the longer queries
+            kept_start = max(entry.start, min(start, end - (entry.end - entry.start)))
+            # refetch the newest cached samples too, they may have been incomplete
+            tail_start = max(start, entry.end - int(math.ceil(self.overlap / step)) * step)
+            tail = fetch(tail_start, end)
+            kept = merge_blocks(entry.block, tail, kept_start, tail_start)
+            with self.lock:
+                self.hits += 1
+        else:
+            tail = fetch(start, end)
+            kept = tail
+            with self.lock:
+                self.misses += 1
+        if kept is not None:
+            _seal(kept)
+        block = kept
+        if kept is not None and kept_start < start:
+            block = merge_blocks(kept, None, start, end + step)
+            if block is not None:
+                _seal(block)
+        with self.lock:
+            self.fetched_points += len(tail.values) if tail is not None else 0
+            self.served_points += len(block.values) if block is not None else 0
+            self.__put(key, _CacheEntry(kept, kept_start, end))
+        return block
+
+    def __put(self, key : CacheKey, entry : _CacheEntry) -> None:
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        if entry.nbytes > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def stats(self) -> Dict[str,int]:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.nbytes, "hits": self.hits, "misses": self.misses,
+                    "fetched_points": self.fetched_points, "served_points": self.served_points}
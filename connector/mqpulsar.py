@@ -1,13 +1,31 @@
 import sys
 import time
-from typing import Dict, Tuple, Any, List
+import json
+import logging
+import threading
+from typing import Callable, Dict, Tuple, Any, List
 import pulsar
 import re
+import numpy as np
 import pandas as pd
 import connector._interface as _interface
 
 sys.path.append("..")
 import common
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_MESSAGES = metrics.counter("anomaly_pulsar_publish_messages_total", "Messages handed to the producer", ("tenant",))
+PUBLISH_BYTES = metrics.counter("anomaly_pulsar_publish_bytes_total", "Bytes of the messages handed to the producer, before compression", ("tenant",))
+PUBLISH_ERRORS = metrics.counter("anomaly_pulsar_publish_errors_total", "Messages the broker did not persist", ("tenant",))
+
+_COMPRESSION = {"none": pulsar.CompressionType.NONE, "lz4": pulsar.CompressionType.LZ4, "zlib": pulsar.CompressionType.ZLib,
+                "zstd": pulsar.CompressionType.ZSTD, "snappy": pulsar.CompressionType.SNAPPY}
+
+# metric{label="value",...} value [timestamp]
+_SAMPLE_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:.]*)(\{.*\})?\s+(\S+)(?:\s+(\S+))?\s*$')
+_LABEL_PAIR = re.compile(r'([a-zA-Z_][a-zA-Z0-9_.]*)\s*=\s*"((?:[^"\\]|\\.)*)"')
 
 class Pulsar(_interface.Connector):
     def __init__(self,
@@ -15,18 +33,60 @@ class Pulsar(_interface.Connector):
                  jwt_token = None,
                  timeout = "3s",
                  target_topic = None,
+                 target_format = "prometheus",
+                 compression = "lz4",
+                 batch_size = 1000,
+                 batch_linger_ms = 10,
+                 max_pending = 10000,
+                 source_topic = None,
+                 subscription = "anomalyd",
+                 stream_batch_size = 1000,
+                 stream_linger = "1s",
+                 redelivery_delay = "10s",
                 ) -> None:
+        '''
+        target_topic : topic the results are written to, messages are keyed by tenant
+        target_format : 'prometheus' (text exposition) or 'jsonline' (one line per column in the format of
+                        VictoriaMetrics /api/v1/import, arrays instead of a line per sample)
+        compression : 'none', 'lz4', 'zlib', 'zstd' or 'snappy'
+        batch_size, batch_linger_ms : the producer sends a batch after this many messages or this delay
+        max_pending : messages waiting for the broker, a write blocks once it is reached
+        source_topic : topic of the incoming samples read by subscribe(), '{tenant}' is replaced by the tenant,
+                       a message holds prometheus text lines 'metric{labels} value [unix_seconds]'
+                       or json lines in the format of VictoriaMetrics /api/v1/import
+        subscription : failover subscription of the source topics, nodes of a cluster need distinct subscriptions
+        stream_batch_size, stream_linger : a micro-batch ends after this many messages or this delay
+        redelivery_delay : delay before a batch which failed is delivered again
+        '''
         self.datasource_url = datasource_url
         self.jwt_token = jwt_token
         self.timeout = timeout
         self.target_topic = target_topic
+        self.target_format = target_format
+        self.compression = compression
+        self.batch_size = batch_size
+        self.batch_linger_ms = batch_linger_ms
+        self.max_pending = max_pending
+        self.source_topic = source_topic
+        self.subscription = subscription
+        self.stream_batch_size = stream_batch_size
+        self.stream_linger = stream_linger
+        self.redelivery_delay = redelivery_delay
         self.client = None
         self.producer = None
         self.__valid_inputs()
+        self.stream_linger_sec = common.parse_time_range_str(self.stream_linger)
+        # {tenant : [listener, ...]}, a consumer thread runs while a tenant has listeners
+        self.listeners : Dict[str, List[Callable[[_interface.StreamBatch], bool]]] = {}
+        self.listeners_lock = threading.Lock()
+        # {tenant : sends failed since the last flush}
+        self.send_failures : Dict[str, int] = {}
+        self.send_lock = threading.Lock()
         self.__init_conn()
 
     def __del__(self):
         if self.producer is not None:
+            self.producer.flush()
             self.producer.close()
         if self.client is not None:
             self.client.close()
@@ -36,36 +96,220 @@ class Pulsar(_interface.Connector):
             raise ValueError("[CONFIG](Pulsar) 'datasource_url' is invalid")
         if not common.check_time_range_str(self.timeout):
             raise ValueError("[CONFIG](Pulsar) 'timeout' is invalid")
-        
+        if not (common.check_time_range_str(self.stream_linger) and common.check_time_range_str(self.redelivery_delay)):
+            raise ValueError("[CONFIG](Pulsar) 'stream_linger' or 'redelivery_delay' is invalid")
+        if self.stream_batch_size <= 0:
+            raise ValueError("[CONFIG](Pulsar) 'stream_batch_size' is invalid")
+        if self.target_format not in ("prometheus", "jsonline"):
+            raise ValueError("[CONFIG](Pulsar) 'target_format' is invalid")
+        if self.compression not in _COMPRESSION:
+            raise ValueError("[CONFIG](Pulsar) 'compression' is invalid")
+        if self.batch_size <= 0 or self.batch_linger_ms < 0 or self.max_pending <= 0:
+            raise ValueError("[CONFIG](Pulsar) 'batch_size', 'batch_linger_ms' or 'max_pending' is invalid")
+
     def __init_conn(self) -> None:
         auth = None
         if self.jwt_token is not None:
             auth = pulsar.AuthenticationToken(self.jwt_token)
-        self.client = pulsar.Client(service_url=self.datasource_url, 
+        self.client = pulsar.Client(service_url=self.datasource_url,
                                authentication=auth,
-                               operation_timeout_seconds=common.parse_time_range_str(self.timeout), 
+                               operation_timeout_seconds=common.parse_time_range_str(self.timeout),
                                connection_timeout_ms=common.parse_time_range_str(self.timeout)*1000)
         if self.target_topic is not None:
-            self.producer = self.client.create_producer(topic=self.target_topic, 
-                                                        send_timeout_millis=common.parse_time_range_str(self.timeout)*1000)
-            
+            # key based batches only hold the results of one tenant
+            self.producer = self.client.create_producer(topic=self.target_topic,
+                                                        send_timeout_millis=common.parse_time_range_str(self.timeout)*1000,
+                                                        compression_type=_COMPRESSION[self.compression],
+                                                        batching_enabled=True,
+                                                        batching_type=pulsar.BatchingType.KeyBased,
+                                                        batching_max_messages=self.batch_size,
+                                                        batching_max_publish_delay_ms=self.batch_linger_ms,
+                                                        max_pending_messages=self.max_pending,
+                                                        max_pending_messages_across_partitions=self.max_pending,
+                                                        block_if_queue_full=True)
+
     def check_query_args(self, args: dict[str, Any]):
         return False
-            
+
     def query_series(self, tenant : str, query_name : str, queries : str, sampling_period : str, query_length: str) -> Tuple[Dict[str,pd.DataFrame],Dict[str,Dict[str,str]]] :
         raise RuntimeError("[CONFIG](Pulsar) Pulsar cannot query metrics !")
 
     def insert_series(self, tenant : str, metrics : List[str], labels : List[dict], values : List[dict[str,str]]) -> bool:
-        data_total = []
+        '''
+        values: { timestamp_unix_seconds : value }, list
+        the samples are sent asynchronously in one message, return False if it could not be queued
+        '''
+        lines = []
         for idx, metric in enumerate(metrics):
-            label = labels[idx]
             value = values[idx]
-            label_s = "{" + ",".join([k+"=\""+v+"\"" for k,v in label.items()]) + "}"
-            for time_s, val in value:
-                data = metric.strip() + label_s + " " + val + " " + time_s
-                data_total.append(data)
+            if self.target_format == "prometheus":
+                label_s = common.format_labels(labels[idx])
+                lines.extend([metric.strip() + label_s + " " + val + " " + time_s + "\n" for time_s, val in value.items()])
+            else:
+                label = dict(labels[idx])
+                label["__name__"] = metric.strip()
+                lines.append(json.dumps({"metric": label,
+                                         "values": [float(val) for val in value.values()],
+                                         "timestamps": [int(float(time_s) * 1000) for time_s in value.keys()]}) + "\n")
+        return self.__send(tenant, "".join(lines))
+
+    def insert_result(self, tenant : str, metrics_prefix : str, query_name : str, labels : Dict[str,str], result : Any) -> bool:
+        '''
+        one message per series, rendered from the columns of the result
+        '''
+        if self.target_format == "prometheus":
+            text = result.to_exposition(metrics_prefix, query_name, dict(labels))
+        else:
+            text = result.to_jsonlines(metrics_prefix, query_name, dict(labels))
+        return self.__send(tenant, text)
+
+    def flush(self, tenant : str = None) -> bool:
+        '''
+        wait until the broker persisted the queued messages
+        return: False if a message of 'tenant' (of any tenant if None) failed since the previous flush
+        '''
+        if self.producer is None:
+            return True
         try:
-            self.producer.send("\n".join(data_total))
+            self.producer.flush()
+        except Exception as e:
+            logger.error("[Pulsar](Producer) flush error : %s", e)
+            return False
+        with self.send_lock:
+            if tenant is None:
+                failed = sum(self.send_failures.values())
+                self.send_failures.clear()
+            else:
+                failed = self.send_failures.pop(str(tenant), 0)
+        return failed == 0
+
+    def __send(self, tenant : str, text : str) -> bool:
+        if self.producer is None:
+            logger.error("[Pulsar](Producer) 'target_topic' is not set, cannot write results !")
+            return False
+        if text == "":
             return True
-        except:
-            return False
\ No newline at end of file
+        data = text.encode("utf-8")
+        tenant = str(tenant)
+        def on_sent(res, msg_id) -> None:
+            if res != pulsar.Result.Ok:
+                PUBLISH_ERRORS.inc(tenant)
+                with self.send_lock:
+                    self.send_failures[tenant] = self.send_failures.get(tenant, 0) + 1
+                logger.error("[Pulsar](Producer) send error : tenant = %s, %s", tenant, res)
+        try:
+            # blocks only while 'max_pending' messages wait for the broker
+            self.producer.send_async(data, on_sent, partition_key=tenant)
+        except Exception as e:
+            PUBLISH_ERRORS.inc(tenant)
+            logger.error("[Pulsar](Producer) send error : tenant = %s, %s", tenant, e)
+            return False
+        PUBLISH_MESSAGES.inc(tenant)
+        PUBLISH_BYTES.inc(tenant, amount=len(data))
+        return True
+
+    def subscribe(self, tenant : str, listener : Callable[[_interface.StreamBatch], bool]) -> Callable[[], None]:
+        if self.source_topic is None:
+            raise RuntimeError("[CONFIG](Pulsar) 'source_topic' is not set, cannot stream samples !")
+        with self.listeners_lock:
+            start = tenant not in self.listeners
+            self.listeners.setdefault(tenant, []).append(listener)
+        if start:
+            topic = self.source_topic.replace("{tenant}", str(tenant))
+            consumer = self.client.subscribe(topic, self.subscription,
+                                             consumer_type=pulsar.ConsumerType.Failover,
+                                             negative_ack_redelivery_delay_ms=common.parse_time_range_str(self.redelivery_delay)*1000)
+            threading.Thread(target=self.__consume, args=(tenant, consumer), name="pulsar-stream-" + str(tenant), daemon=True).start()
+            logger.info("[Pulsar](Stream) subscribed to %s", topic)
+        def unsubscribe() -> None:
+            with self.listeners_lock:
+                listeners = self.listeners.get(tenant, [])
+                if listener in listeners:
+                    listeners.remove(listener)
+        return unsubscribe
+
+    def __receive_batch(self, consumer) -> List[Any]:
+        messages = []
+        deadline = time.time() + self.stream_linger_sec
+        while len(messages) < self.stream_batch_size:
+            wait_ms = int((deadline - time.time()) * 1000)
+            if wait_ms <= 0:
+                break
+            try:
+                messages.append(consumer.receive(timeout_millis=wait_ms))
+            except pulsar.Timeout:
+                break
+        return messages
+
+    def __consume(self, tenant : str, consumer) -> None:
+        while True:
+            with self.listeners_lock:
+                listeners = list(self.listeners.get(tenant, []))
+                if len(listeners) == 0:
+                    # the last task of the tenant stopped, undelivered messages stay in the subscription
+                    self.listeners.pop(tenant, None)
+                    break
+            try:
+                messages = self.__receive_batch(consumer)
+            except Exception as e:
+                logger.error("[Pulsar](Stream) receive error : tenant = %s, %s", tenant, e)
+                time.sleep(self.stream_linger_sec)
+                continue
+            if len(messages) == 0:
+                continue
+            batch = {}
+            for message in messages:
+                try:
+                    self.__decode(message.data(), batch)
+                except Exception as e:
+                    # a malformed message would be delivered forever, it is dropped
+                    logger.error("[Pulsar](Stream) malformed message dropped : tenant = %s, %s", tenant, e)
+            batch = {key: (labels, np.asarray(ts, dtype=np.int64), np.asarray(values, dtype=np.float64))
+                     for key, (labels, ts, values) in batch.items()}
+            success = True
+            for listener in listeners:
+                try:
+                    success = listener(batch) is not False and success
+                except Exception as e:
+                    logger.error("[Pulsar](Stream) listener error, batch delivered again : tenant = %s, %s", tenant, e)
+                    success = False
+            for message in messages:
+                if success:
+                    consumer.acknowledge(message)
+                else:
+                    consumer.negative_acknowledge(message)
+        consumer.close()
+        logger.info("[Pulsar](Stream) unsubscribed, tenant = %s", tenant)
+
+    @staticmethod
+    def __decode(data : bytes, batch : Dict[Tuple, Tuple[Dict[str,str], List[int], List[float]]]) -> None:
+        '''
+        add the samples of a message to 'batch', timestamps in milliseconds are converted to seconds
+        '''
+        now = int(time.time())
+        for line in data.decode("utf-8").splitlines():
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                row = json.loads(line)
+                labels = {str(k): str(v) for k, v in row["metric"].items()}
+                ts_list = [int(t) // 1000 for t in row["timestamps"]]
+                value_list = [float(v) for v in row["values"]]
+            else:
+                match = _SAMPLE_LINE.match(line)
+                if match is None:
+                    raise ValueError("bad sample line: " + line[:200])
+                labels = {k: v.replace('\\"', '"').replace('\\n', '\n').replace('\\\\', '\\')
+                          for k, v in _LABEL_PAIR.findall(match.group(2) or "")}
+                labels["__name__"] = match.group(1)
+                ts = float(match.group(4)) if match.group(4) is not None else now
+                ts_list = [int(ts // 1000) if ts > 1e11 else int(ts)]
+                value_list = [float(match.group(3))]
+            key = tuple(sorted(labels.items()))
+            entry = batch.get(key)
+            if entry is None:
+                entry = (labels, [], [])
+                batch[key] = entry
+            entry[1].extend(ts_list)
+            entry[2].extend(value_list)
@@ -0,0 +1,357 @@
+import copy
+import fcntl
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from connector._series import SeriesBlock
+from connector.cache import CacheKey, Fetcher
+
+sys.path.append("..")
+import common
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE = ".lock"
+
+SEGMENT_PREFIX = "seg-"
+
+class _Segment():
+    '''
+    Samples of the series fetched by one refresh, never modified once its index is written
+        'seg-<uuid>.ts' : int64 unix seconds of every series, one after the other
+        'seg-<uuid>.values' : float64 values, aligned with the timestamps
+        'seg-<uuid>.json' : ids, labels, offsets and last timestamp of the series
+    The files are created exclusively and never written again, a removed segment stays readable by its mappings.
+    '''
+
+    def __init__(self, folder : str, name : str) -> None:
+        self.name = name
+        with open(os.path.join(folder, name + ".json"), 'r') as f:
+            index = json.load(f)
+        offsets = np.asarray(index["offsets"], dtype=np.int64)
+        self.points = int(offsets[-1])
+        # {series_id : timestamp of its last sample}
+        self.last : Dict[str, int] = dict(zip(index["ids"], index["last"]))
+        self.block : SeriesBlock = None
+        if self.points > 0:
+            # read only mappings, the pages are shared with the page cache and never copied to the heap
+            ts = np.memmap(os.path.join(folder, name + ".ts"), dtype=np.int64, mode='r', shape=(self.points,))
+            values = np.memmap(os.path.join(folder, name + ".values"), dtype=np.float64, mode='r', shape=(self.points,))
+            self.block = SeriesBlock(index["ids"], index["labels"], ts, values, offsets)
+
+class _Chain():
+    '''
+    Window of one query, the segments appended by the refreshes since the last compaction, oldest first
+        '<gen>-<uuid>.json' : the [start, end] of the window and the (segment name, since) of its segments
+    A segment holds the samples of its series from its 'since' to the 'since' of the next segment,
+    the samples fetched again by a newer segment (overlap) replace the older ones.
+    '''
+
+    def __init__(self, name : str, start : int, end : int, segments : List[Tuple[_Segment, int]]) -> None:
+        self.name = name
+        self.gen = _gen_number(name)
+        self.start = start
+        self.end = end
+        self.segments = segments
+        self.points = sum(segment.points for segment, _ in segments)
+        self.block = _ChainBlock(start, segments)
+
+    @staticmethod
+    def load(folder : str, name : str, known : Dict[str, _Segment]) -> '_Chain':
+        '''
+        known : segments already mapped, by name, they are shared with the chain loaded before
+        '''
+        with open(os.path.join(folder, name + ".json"), 'r') as f:
+            index = json.load(f)
+        segments = [(known[seg] if seg in known else _Segment(folder, seg), since) for seg, since in index["segments"]]
+        return _Chain(name, index["start"], index["end"], segments)
+
+class _ChainBlock(SeriesBlock):
+    '''
+    The window of a chain as a SeriesBlock, a series stored in one segment is a view on its mapping,
+    a series spread over several segments is concatenated when it is looked up, one series at a time
+    '''
+
+    def __init__(self, start : int, segments : List[Tuple[_Segment, int]]) -> None:
+        # [(segment block, first timestamp, first timestamp of the next segment)]
+        self.parts : List[Tuple[SeriesBlock, int, int]] = []
+        # {series_id : [(part, series_id in the segment)]}
+        rows : Dict[str, List[Tuple[int, str]]] = {}
+        labels : Dict[str, Dict[str, str]] = {}
+        for pos, (segment, since) in enumerate(segments):
+            until = segments[pos + 1][1] if pos + 1 < len(segments) else np.iinfo(np.int64).max
+            if segment.block is None or until <= start:
+                continue
+            lo = max(since, start)
+            part = len(self.parts)
+            self.parts.append((segment.block, lo, until))
+            for sid in segment.block.index:
+                # a series which stopped before the window is dropped
+                if segment.last[sid] >= lo:
+                    rows.setdefault(sid, []).append((part, sid))
+                    labels[sid] = segment.block.labels[sid]
+        ids = list(rows.keys())
+        # the samples are read through the segments, see arrays
+        super().__init__(ids, labels, None, None, None)
+        self.rows = [rows[sid] for sid in ids]
+
+    def arrays(self, series_id : str) -> Tuple[np.ndarray, np.ndarray]:
+        ts_parts = []
+        value_parts = []
+        for part, sid in self.rows[self.index[series_id]]:
+            block, lo, hi = self.parts[part]
+            ts, values = block.arrays(sid)
+            first, last = np.searchsorted(ts, [lo, hi])
+            if last > first:
+                ts_parts.append(ts[first:last])
+                value_parts.append(values[first:last])
+        if len(ts_parts) == 1:
+            return ts_parts[0], value_parts[0]
+        if len(ts_parts) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return np.concatenate(ts_parts), np.concatenate(value_parts)
+
+    def renamed(self, query_name : str) -> 'SeriesBlock':
+        block = super().renamed(query_name)
+        renamed = copy.copy(self)
+        renamed.ids, renamed.labels, renamed.index = block.ids, block.labels, block.index
+        return renamed
+
+def _gen_number(name : str) -> int:
+    # '<gen>-<uuid>', -1 for the files which are not a chain (segments, lock)
+    gen = name.split("-")[0]
+    return int(gen) if gen.isdigit() else -1
+
+class SeriesStore():
+    '''
+    On-disk store of range query results under the home folder, one folder per (tenant, query_name, queries, step, length)
+        - like SeriesCache, windows are aligned to the step and only the missing tail (plus 'overlap' seconds)
+          is fetched, so a refit does not query the historic samples again, even after a restart
+        - each refresh appends the tail as a new segment of the chain of the query, the stored samples are not
+          written again, see _Chain
+        - the chain is compacted into one segment of the window when it exceeds 'max_segments' segments or when half
+          of the window has slid out of its first segment, the files of a compacted chain are removed,
+          a block returned before keeps reading them
+        - blocks are memmaps of the segment files, the samples live in the page cache rather than in the heap
+        - refreshes of a folder hold a lock file, so stores of other processes sharing the home (a cluster) can refresh it too
+        - folders not refreshed for 'idle' seconds (stopped tasks) are removed, see retain
+    One store is shared by the schedulers of the process, see shared_store.
+    '''
+
+    def __init__(self, overlap : int = 60, idle : int = 7 * 86400, max_segments : int = 8) -> None:
+        self.overlap = overlap
+        self.idle = idle
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        # {folder : lock}, refreshes of one query are serialized
+        self.folder_locks : Dict[str, threading.Lock] = {}
+        # {folder : last chain}
+        self.current : Dict[str, _Chain] = {}
+        self.swept = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+        self.fetched_points = 0
+        self.served_points = 0
+        self.written_bytes = 0
+
+    def query(self, key : CacheKey, length : int, now : float, fetch : Fetcher) -> SeriesBlock:
+        tenant, query_name, queries, step = key
+        end = int(now // step) * step
+        start = end - int(math.ceil(length / step)) * step
+        folder = common.get_store_dir(tenant, common.map_hash({"query_name": query_name, "queries": queries,
+                                                               "step": step, "length": length}))
+        with self.lock:
+            folder_lock = self.folder_locks.setdefault(folder, threading.Lock())
+        with folder_lock, open(os.path.join(folder, LOCK_FILE), 'a') as lock_file:
+            # the other processes sharing the folder wait for the refresh, then read its chain
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                current = self.__load(folder)
+                segments : List[Tuple[_Segment, int]] = []
+                tail_start = start
+                hit = current is not None and current.start <= start and current.end >= start
+                if hit:
+                    # refetch the newest stored samples too, they may have been incomplete
+                    segments = [(segment, since) for pos, (segment, since) in enumerate(current.segments)
+                                if pos + 1 == len(current.segments) or current.segments[pos + 1][1] > start]
+                    tail_start = max(start, current.end - int(math.ceil(self.overlap / step)) * step)
+                tail = fetch(tail_start, end)
+                if tail is not None:
+                    segments.append((self.__write_segment(folder, tail, tail_start), tail_start))
+                compacted = len(segments) > self.max_segments or \
+                    (len(segments) > 1 and start - segments[0][1] >= (end - start) // 2)
+                if compacted:
+                    segments = [(self.__write_segment(folder, _ChainBlock(start, segments), start), start)]
+                written = self.__write_chain(folder, start, end, segments)
+                with self.lock:
+                    if hit:
+                        self.hits += 1
+                    else:
+                        self.misses += 1
+                    self.compactions += 1 if compacted else 0
+                    self.fetched_points += len(tail.values) if tail is not None else 0
+                    self.served_points += written.points
+                    self.current[folder] = written
+                self.__remove_older(folder, written)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.__sweep(now)
+        return written.block if len(written.block) > 0 else None
+
+    @staticmethod
+    def __names(folder : str) -> Dict[int, List[str]]:
+        '''
+        {generation number : [names]} of the chains of the folder, several names of one number are crashed writes
+        '''
+        names : Dict[int, List[str]] = {}
+        for fname in os.listdir(folder):
+            name = fname.split(".")[0]
+            gen = _gen_number(name)
+            if gen >= 0 and name not in names.get(gen, []):
+                names.setdefault(gen, []).append(name)
+        return names
+
+    def __load(self, folder : str) -> _Chain:
+        '''
+        last complete chain of the folder, must be called with the folder locked
+        '''
+        complete = sorted((_gen_number(fname[:-len(".json")]), fname[:-len(".json")]) for fname in os.listdir(folder)
+                          if fname.endswith(".json") and _gen_number(fname[:-len(".json")]) >= 0)
+        if len(complete) == 0:
+            return None
+        name = complete[-1][1]
+        with self.lock:
+            current = self.current.get(folder)
+        if current is not None and current.name == name:
+            return current
+        known = {segment.name: segment for segment, _ in current.segments} if current is not None else {}
+        try:
+            # written by another process, or before a restart
+            return _Chain.load(folder, name, known)
+        except Exception as e:
+            logger.error("[SeriesStore] unreadable chain dropped : folder = %s, %s", folder, e)
+            return None
+
+    def __remove_older(self, folder : str, written : _Chain) -> None:
+        '''
+        remove the files of the other chains and of the segments 'written' does not use,
+        must be called with the folder locked, so no other write is in progress
+        '''
+        kept = {written.name}
+        kept.update(segment.name for segment, _ in written.segments)
+        for fname in os.listdir(folder):
+            if fname == LOCK_FILE or fname.split(".")[0] in kept:
+                continue
+            try:
+                os.remove(os.path.join(folder, fname))
+            except FileNotFoundError:
+                pass
+
+    def __write_segment(self, folder : str, block : SeriesBlock, start : int) -> _Segment:
+        '''
+        write the samples of 'block' from 'start', one series at a time so that a compacted window is never held in memory
+        '''
+        ids : List[str] = []
+        labels : Dict[str, Dict[str, str]] = {}
+        last : List[int] = []
+        offsets = [0]
+        # a new name for every write, a file mapped by a block is never truncated
+        name = SEGMENT_PREFIX + uuid.uuid4().hex
+        tmp_index = os.path.join(folder, name + ".json.tmp")
+        with open(os.path.join(folder, name + ".ts"), 'xb') as f_ts, \
+             open(os.path.join(folder, name + ".values"), 'xb') as f_values:
+            for sid in block.index.keys():
+                ts, values = block.arrays(sid)
+                lo = int(np.searchsorted(ts, start))
+                if lo == len(ts):
+                    continue
+                np.ascontiguousarray(ts[lo:], dtype=np.int64).tofile(f_ts)
+                np.ascontiguousarray(values[lo:], dtype=np.float64).tofile(f_values)
+                ids.append(sid)
+                labels[sid] = block.labels[sid]
+                last.append(int(ts[-1]))
+                offsets.append(offsets[-1] + len(ts) - lo)
+        with open(tmp_index, 'x') as f:
+            json.dump({"ids": ids, "labels": labels, "offsets": offsets, "last": last}, f)
+        os.replace(tmp_index, os.path.join(folder, name + ".json"))
+        with self.lock:
+            self.written_bytes += offsets[-1] * 16
+        return _Segment(folder, name)
+
+    def __write_chain(self, folder : str, start : int, end : int, segments : List[Tuple[_Segment, int]]) -> _Chain:
+        gen = max(self.__names(folder).keys(), default=-1) + 1
+        name = str(gen) + "-" + uuid.uuid4().hex
+        tmp_index = os.path.join(folder, name + ".json.tmp")
+        with open(tmp_index, 'x') as f:
+            json.dump({"start": start, "end": end, "segments": [[segment.name, since] for segment, since in segments]}, f)
+        # the chain is complete once its index exists
+        os.replace(tmp_index, os.path.join(folder, name + ".json"))
+        return _Chain(name, start, end, segments)
+
+    def retain(self, seconds : int) -> None:
+        '''
+        keep the idle folders at least 'seconds', called with twice the longest refit period of the tasks using the store
+        '''
+        with self.lock:
+            self.idle = max(self.idle, seconds)
+
+    def __sweep(self, now : float) -> None:
+        with self.lock:
+            if now - self.swept < min(self.idle, 3600):
+                return
+            self.swept = now
+            idle = self.idle
+        root = common.store_folder if common.store_folder is not None else os.path.join(common.home_folder, 'store')
+        for tenant in os.listdir(root):
+            for key in os.listdir(os.path.join(root, tenant)):
+                folder = os.path.join(root, tenant, key)
+                with self.lock:
+                    # refreshed by this process since it started, its task is alive
+                    if folder in self.current or folder in self.folder_locks:
+                        continue
+                if now - os.path.getmtime(folder) < idle:
+                    continue
+                try:
+                    with open(os.path.join(folder, LOCK_FILE), 'a') as lock_file:
+                        # refreshed by another process right now
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        if now - os.path.getmtime(folder) < idle:
+                            continue
+                        shutil.rmtree(folder, ignore_errors=True)
+                except (BlockingIOError, FileNotFoundError):
+                    continue
+                logger.info("[SeriesStore] idle query removed : %s", folder)
+
+    def stats(self) -> Dict[str,int]:
+        with self.lock:
+            return {"queries": len(self.current), "hits": self.hits, "misses": self.misses, "compactions": self.compactions,
+                    "fetched_points": self.fetched_points, "served_points": self.served_points,
+                    "written_bytes": self.written_bytes}
+
+_shared : SeriesStore = None
+_shared_lock = threading.Lock()
+
+def shared_store() -> SeriesStore:
+    '''
+    the store of the process, the schedulers share it so that a folder has one writer per process
+    '''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SeriesStore()
+            metrics.collected("anomaly_series_store", "Stored fit windows, points fetched to refresh them and points served",
+                              ("stat",), "gauge",
+                              lambda: {(stat,): value for stat, value in _shared.stats().items()})
+        return _shared
@@ -4,16 +4,34 @@ import re
 import requests
 import base64
 import time
+import threading
+import atexit
+import json
+import zlib
+import functools
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin
-from typing import Tuple, Dict, Any, List
+from typing import Callable, Tuple, Dict, Any, List
 import connector._interface as _interface
+from connector._series import SeriesBlock
+from connector.cache import SeriesCache
 
 sys.path.append("..")
 import common
+import metrics
 
 logger = logging.getLogger(__name__)
 
+QUERY_SECONDS = metrics.histogram("anomaly_vm_query_seconds", "Duration of the series queries sent to VictoriaMetrics", ("tenant", "query"))
+QUERY_SERIES = metrics.counter("anomaly_vm_query_series_total", "Series returned by the queries", ("tenant", "query"))
+QUERY_ERRORS = metrics.counter("anomaly_vm_query_errors_total", "Failed queries", ("tenant", "query"))
+INSERT_SAMPLES = metrics.counter("anomaly_vm_insert_samples_total", "Samples buffered for ingestion", ("tenant",))
+FLUSH_SECONDS = metrics.histogram("anomaly_vm_flush_seconds", "Duration of an ingest flush, retries included", ("tenant",))
+FLUSH_BYTES = metrics.counter("anomaly_vm_flush_bytes_total", "Bytes of the ingest bodies sent, after compression", ("tenant",))
+FLUSH_DROPPED = metrics.counter("anomaly_vm_dropped_samples_total", "Samples dropped after the ingest retries failed", ("tenant",))
+
 class Victoriametrics(_interface.Connector):
     def __init__(self,
                  datasource_url = "http://localhost:8481/",
@@ -23,8 +41,27 @@ class Victoriametrics(_interface.Connector):
                  pwd_query = None,
                  user_insert = None,
                  pwd_insert = None,
-                 timeout = "30s"
+                 timeout = "30s",
+                 pool_size = 32,
+                 max_retries = 3,
+                 retry_backoff = 0.5,
+                 ingest_format = "prometheus",
+                 ingest_batch_size = 100000,
+                 ingest_flush_every = "5s",
+                 ingest_compress = True,
+                 cache_size_mb = 0
                  ) -> None:
+        '''
+        pool_size : max number of keep-alive connections kept to the datasource,
+                    shared by all scheduler worker threads, also the max number of queries in flight
+        max_retries : retries of a failed request (connection errors, 502/503/504)
+        retry_backoff : backoff factor in seconds between retries
+        ingest_format : 'prometheus' (text exposition) or 'jsonline' (/api/v1/import)
+        ingest_batch_size : buffered samples of a tenant that trigger a flush, <= 0 flushes on every insert
+        ingest_flush_every : max time a sample stays in the buffer
+        ingest_compress : send the ingest body gzip compressed
+        cache_size_mb : memory budget of the incremental query cache, <= 0 disables it
+        '''
         self.datasource_url = datasource_url
         self.multi_tenant = multi_tenant
         self.user_query = user_query
@@ -33,10 +70,54 @@ class Victoriametrics(_interface.Connector):
         self.pwd_insert = pwd_insert
         self.timeout = timeout
         self.health_path = health_path
+        self.pool_size = pool_size
+        self.query_concurrency = pool_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.ingest_format = ingest_format
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_flush_every = ingest_flush_every
+        self.ingest_compress = ingest_compress
+        self.cache_size_mb = cache_size_mb
         self.down = False
         self.__valid_inputs()
+        self.timeout_sec = common.parse_time_range_str(self.timeout)
+        self.query_headers = self.__build_headers(self.user_query, self.pwd_query)
+        self.insert_headers = self.__build_headers(self.user_insert, self.pwd_insert)
+        self.insert_headers["Content-Type"] = "text/plain" if self.ingest_format == "prometheus" else "application/stream+json"
+        if self.ingest_compress:
+            self.insert_headers["Content-Encoding"] = "gzip"
+        self.requests_total = 0
+        self.requests_lock = threading.Lock()
+        self.session = self.__init_session(self.max_retries)
+        # streamed bodies cannot be replayed by urllib3, ingest retries are done in __flush_tenant
+        self.ingest_session = self.__init_session(0)
+        # {tenant : [render(ingest_format) -> str, ...]}, entries are rendered while the body is streamed
+        self.ingest_buffer : Dict[str, List[Callable[[str], str]]] = {}
+        self.ingest_buffer_samples : Dict[str, int] = {}
+        self.ingest_lock = threading.Lock()
+        self.ingest_flush_sec = common.parse_time_range_str(self.ingest_flush_every)
+        self.cache : SeriesCache = None
+        if self.cache_size_mb > 0:
+            self.cache = SeriesCache(max_bytes=int(self.cache_size_mb * 1024 * 1024))
+        if self.ingest_batch_size > 0:
+            threading.Thread(target=self.__flush_periodically, daemon=True).start()
+            atexit.register(self.flush)
         #self.__health_check()
 
+    def register_metrics(self, name : str, role : str) -> None:
+        '''
+        export the connection and cache stats, called once per configured connector
+        name : connector name in the config, role : 'reader' | 'writer', a connector of both pipelines has one instance per role
+        '''
+        metrics.collected("anomaly_vm_requests_total", "Requests sent and connections opened to the datasource",
+                          ("connector", "role", "datasource", "stat"), "counter",
+                          lambda: {(name, role, self.datasource_url, k): v for k, v in self.connection_stats().items()})
+        if self.cache is not None:
+            metrics.collected("anomaly_vm_cache", "State of the incremental query cache",
+                              ("connector", "role", "datasource", "stat"), "gauge",
+                              lambda: {(name, role, self.datasource_url, k): v for k, v in self.cache.stats().items()})
+
     def __valid_inputs(self) -> None:
         if re.match(r'^((http|https)://)([a-zA-Z0-9.-])+:([0-9])+/?', self.datasource_url) is None:
             raise ValueError("[CONFIG](Victoriametrics) 'datasource_url' is invalid")
@@ -44,15 +125,63 @@ class Victoriametrics(_interface.Connector):
             self.datasource_url.strip('/')
         if not common.check_time_range_str(self.timeout):
             raise ValueError("[CONFIG](Victoriametrics) 'timeout' is invalid")
-        
+        if self.pool_size <= 0:
+            raise ValueError("[CONFIG](Victoriametrics) 'pool_size' is invalid")
+        if self.max_retries < 0 or self.retry_backoff < 0:
+            raise ValueError("[CONFIG](Victoriametrics) 'max_retries' or 'retry_backoff' is invalid")
+        if self.ingest_format not in ("prometheus", "jsonline"):
+            raise ValueError("[CONFIG](Victoriametrics) 'ingest_format' is invalid")
+        if not common.check_time_range_str(self.ingest_flush_every):
+            raise ValueError("[CONFIG](Victoriametrics) 'ingest_flush_every' is invalid")
+
+    def __build_headers(self, user : str, pwd : str) -> Dict[str,str]:
+        headers = {"Accept-Encoding":"gzip, deflate"}
+        if user is not None:
+            headers['Authorization'] = 'Basic ' + base64.b64encode(f"{user}:{pwd}".encode("utf-8")).decode("ascii")
+        return headers
+
+    def __init_session(self, max_retries : int) -> requests.Session:
+        retry = Retry(total=max_retries, backoff_factor=self.retry_backoff,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET", "PUT", "POST"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def __request(self, method : str, url : str, session : requests.Session = None, **kwargs) -> requests.Response:
+        with self.requests_lock:
+            self.requests_total += 1
+        if session is None:
+            session = self.session
+        return session.request(method, url, timeout=self.timeout_sec, **kwargs)
+
+    def connection_stats(self) -> Dict[str,int]:
+        '''
+        counters of the connection pool:
+            requests : requests sent by this connector
+            connections : new connections opened to the datasource
+            reused : requests served by an already open (keep-alive) connection
+        '''
+        connections = 0
+        pool_requests = 0
+        adapters = list(self.session.adapters.values()) + list(self.ingest_session.adapters.values())
+        for adapter in set(adapters):
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+        return {"requests": self.requests_total, "connections": connections,
+                "reused": max(pool_requests - connections, 0)}
+
     def __health_check(self) -> None:
         url =  urljoin(self.datasource_url, self.health_path)
-        headers = {}
         down_time = 0
-        if self.user_query is not None:
-            headers['Authorization'] = 'Basic' + base64.b64encode(f"{self.user_query}:{self.pwd_query}".encode("utf-8")).decode("ascii")
         while True:
-            res = requests.get(url=url, headers=headers)
+            res = self.__request("GET", url, headers=self.query_headers)
             if res.status_code == 200:
                 time.sleep(60)
                 continue
@@ -66,10 +195,11 @@ class Victoriametrics(_interface.Connector):
                 time.sleep(120)
 
     def __get_ingest_url(self, tenant):
+        path = "api/v1/import/prometheus" if self.ingest_format == "prometheus" else "api/v1/import"
         if self.multi_tenant:
-            return self.datasource_url + "insert/" + tenant + "/prometheus/api/v1/import/prometheus"
+            return self.datasource_url + "insert/" + tenant + "/prometheus/" + path
         else:
-            return self.datasource_url + "api/v1/import/prometheus"
+            return self.datasource_url + path
         
     def __get_query_url(self, tenant):
         if self.multi_tenant:
@@ -81,57 +211,168 @@ class Victoriametrics(_interface.Connector):
         return super().check_query_args(args=args)
 
     def query_series(self, tenant : str, query_name : str, queries : str, sampling_period : str, query_length: str) -> Tuple[Dict[str,pd.DataFrame],Dict[str,Dict[str,str]]] :
+        start_t = time.perf_counter()
+        try:
+            y_map, y_label_map = self.__query_series(tenant, query_name, queries, sampling_period, query_length)
+        except Exception:
+            QUERY_ERRORS.inc(str(tenant), query_name)
+            raise
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start_t, str(tenant), query_name)
+        if y_map is not None:
+            QUERY_SERIES.inc(str(tenant), query_name, amount=len(y_map))
+        return y_map, y_label_map
+
+    def __query_series(self, tenant : str, query_name : str, queries : str, sampling_period : str, query_length: str) -> Tuple[Dict[str,pd.DataFrame],Dict[str,Dict[str,str]]] :
         if self.down:
             raise ValueError("[CONFIG](Victoriametrics) datasource is down")
         if not (common.check_time_range_str(sampling_period) and \
             common.check_time_range_str(query_length)):
             raise ValueError("[CONFIG](Victoriametrics) 'sampling_period' or 'query_length' is invalid: {}, {}".format(sampling_period, query_length))
-        end = time.time()
-        start = end - common.parse_time_range_str(query_length)
+        if self.cache is not None:
+            step = common.parse_time_range_str(sampling_period)
+            fetch = lambda start, end: self.query_range(tenant, query_name, queries, str(step) + "s", start, end)
+            block = self.cache.query((tenant, query_name, queries, step), common.parse_time_range_str(query_length),
+                                     time.time(), fetch)
+        else:
+            end = time.time()
+            start = end - common.parse_time_range_str(query_length)
+            block = self.query_range(tenant, query_name, queries, sampling_period, start, end)
+        if block is None:
+            return None, None
+        return block, block.labels
+
+    def query_range(self, tenant : str, query_name : str, queries : str, sampling_period : str, start : float, end : float) -> SeriesBlock:
+        '''
+        query series data between 'start' and 'end' (unix seconds)
+        return: None if no series returned
+        '''
         queries_params = {"query": queries, "start": start, "end": end, "step": sampling_period}
         url = self.__get_query_url(tenant)
-        headers = {"Accept-Encoding":"gzip, deflate"}
-        if self.user_query is not None:
-            headers['Authorization'] = 'Basic ' + base64.b64encode(f"{self.user_query}:{self.pwd_query}".encode("utf-8")).decode("ascii")
-        res = requests.get(url=url, params=queries_params, headers=headers, timeout=common.parse_time_range_str(self.timeout))
-        data = res.json()
-        if data["data"]["result"] is None or len(data["data"]["result"]) == 0 :
-            return None, None
-        result : Dict[str,pd.DataFrame] = {}
-        labels : Dict[str,Dict[str,str]] = {}
-        for metric in data["data"]["result"]:
-            label : dict = metric["metric"]
-            if query_name is not None and query_name != '':
-                label['__name__'] = query_name
-            sid = common.map_hash(labels)
-            df = pd.DataFrame(columns=['ds', 'y'], data=metric["values"])
-            df['ds'] = pd.to_datetime(df['ds'].round(), unit='s')
-            df['y'] = df['y'].astype(float)
-            result[sid] = df
-            label.pop('__name__')
-            labels[sid] = label
-        return result, labels
+        res = self.__request("GET", url, params=queries_params, headers=self.query_headers)
+        return SeriesBlock.decode(res.content, query_name)
         
     def insert_series(self, tenant : str, metrics : List[str], labels : List[dict], values : List[dict[str,str]]) -> bool:
+        '''
+        samples are buffered per tenant and written by a later flush,
+        return False only if the datasource is down or the write failed
+        '''
         if self.down:
             return False
-        data_total = []
-        url = self.__get_ingest_url(tenant)
+        samples = 0
+        entries = []
         for idx, metric in enumerate(metrics):
-            label = labels[idx]
-            value = values[idx]
-            label_s = "{" + ",".join([k+"=\""+v+"\"" for k,v in label.items()]) + "}"
-            for time_s, val in value.items():
-                data = metric.strip() + label_s + " " + val + " " + time_s
-                data_total.append(data)
-        headers = {"Accept-Encoding":"gzip, deflate", "Content-Type": "text/plain"}
-        if self.user_insert is not None:
-            headers['Authorization'] = 'Basic ' + base64.b64encode(f"{self.user_insert}:{self.pwd_insert}".encode("utf-8")).decode("ascii")
-        res = requests.put(url=url, headers=headers, data="\n".join(data_total))
-        if res.status_code > 205 or res.status_code < 200:
-            logger.warning("Insert to VM failed: status_code = %d", res.status_code)
+            entries.append(functools.partial(self.__render_series, metric.strip(), dict(labels[idx]), values[idx]))
+            samples += len(values[idx])
+        return self.__buffer(tenant, entries, samples)
+
+    def insert_result(self, tenant : str, metrics_prefix : str, query_name : str, labels : Dict[str,str], result : Any) -> bool:
+        '''
+        the columns of the result are kept as arrays in the buffer and rendered in one pass on flush
+        '''
+        if self.down:
             return False
-        else:
+        labels = dict(labels)
+        render = lambda fmt: result.to_exposition(metrics_prefix, query_name, labels) if fmt == "prometheus" \
+            else result.to_jsonlines(metrics_prefix, query_name, labels)
+        samples = len(result.data['ds']) * (len(result.data) - 1)
+        return self.__buffer(tenant, [render], samples)
+
+    def __buffer(self, tenant : str, entries : List[Callable[[str], str]], samples : int) -> bool:
+        INSERT_SAMPLES.inc(str(tenant), amount=samples)
+        with self.ingest_lock:
+            self.ingest_buffer.setdefault(tenant, []).extend(entries)
+            self.ingest_buffer_samples[tenant] = self.ingest_buffer_samples.get(tenant, 0) + samples
+            full = self.ingest_buffer_samples[tenant] >= self.ingest_batch_size
+        if full:
+            return self.__flush_tenant(tenant)
+        return True
+
+    def flush(self, tenant : str = None) -> bool:
+        '''
+        write the buffered samples of 'tenant', of every tenant if None
+        '''
+        if tenant is not None:
+            return self.__flush_tenant(tenant)
+        with self.ingest_lock:
+            tenants = list(self.ingest_buffer.keys())
+        success = True
+        for tenant in tenants:
+            success = self.__flush_tenant(tenant) and success
+        return success
+
+    def __flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.ingest_flush_sec)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("[Victoriametrics](Ingest) periodical flush error : %s", e)
+
+    def __flush_tenant(self, tenant : str) -> bool:
+        with self.ingest_lock:
+            entries = self.ingest_buffer.pop(tenant, None)
+            samples = self.ingest_buffer_samples.pop(tenant, 0)
+        if entries is None or len(entries) == 0:
             return True
+        with FLUSH_SECONDS.time(str(tenant)):
+            if self.__send_entries(tenant, entries):
+                return True
+        FLUSH_DROPPED.inc(str(tenant), amount=samples)
+        logger.error("[Victoriametrics](Ingest) dropped %d samples of tenant %s", samples, tenant)
+        return False
+
+    def __send_entries(self, tenant : str, entries : List[Callable[[str], str]]) -> bool:
+        url = self.__get_ingest_url(tenant)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            try:
+                res = self.__request("PUT", url, session=self.ingest_session, headers=self.insert_headers,
+                                     data=self.__stream_body(tenant, entries))
+            except requests.RequestException as e:
+                logger.warning("Insert to VM failed: tenant = %s, %s", tenant, e)
+                continue
+            if res.status_code >= 200 and res.status_code <= 205:
+                return True
+            logger.warning("Insert to VM failed: status_code = %d", res.status_code)
+            if res.status_code not in (502, 503, 504):
+                break
+        return False
+
+    @staticmethod
+    def __render_series(metric : str, label : Dict[str,str], value : Dict[str,str], ingest_format : str) -> str:
+        if ingest_format == "prometheus":
+            label_s = common.format_labels(label)
+            return "".join([metric + label_s + " " + val + " " + time_s + "\n" for time_s, val in value.items()])
+        label = dict(label)
+        label["__name__"] = metric
+        return json.dumps({"metric": label,
+                           "values": [float(val) for val in value.values()],
+                           "timestamps": [int(float(time_s) * 1000) for time_s in value.keys()]}) + "\n"
 
-            
\ No newline at end of file
+    def __stream_body(self, tenant : str, entries : List[Callable[[str], str]], chunk_size : int = 1 << 16):
+        '''
+        render the buffered entries lazily, the body is sent with chunked transfer encoding
+        '''
+        compressor = zlib.compressobj(wbits=31) if self.ingest_compress else None
+        pending = []
+        pending_len = 0
+        for render in entries:
+            text = render(self.ingest_format)
+            pending.append(text)
+            pending_len += len(text)
+            if pending_len >= chunk_size:
+                data = "".join(pending).encode("utf-8")
+                pending = []
+                pending_len = 0
+                data = compressor.compress(data) if compressor is not None else data
+                if len(data) > 0:
+                    FLUSH_BYTES.inc(str(tenant), amount=len(data))
+                    yield data
+        data = "".join(pending).encode("utf-8")
+        if compressor is not None:
+            data = compressor.compress(data) + compressor.flush()
+        if len(data) > 0:
+            FLUSH_BYTES.inc(str(tenant), amount=len(data))
+            yield data
@@ -9,10 +9,15 @@ import common
 import uuid
 import logging
 import sys
+import threading
+import time
+from typing import Dict, Tuple
 
 import connector
 import model
 import scheduler
+import cluster
+import metrics
 
 sys.path.append("..")
 import common
@@ -23,21 +28,91 @@ readers : dict[str, connector.Connector] = {}
 writers : dict[str, connector.Connector] = {}
 models : dict[str, model.BaseModel] = {}
 schedulers : dict[str, scheduler.Scheduler] = {}
+cluster_node : cluster.Cluster = None
+# {(tenant, task name) : (scheduler name, task file mtime)}, the persisted tasks scheduled by this node
+scheduled_tasks : Dict[Tuple[str, str], Tuple[str, float]] = {}
+tasks_lock = threading.RLock()
+# seconds a /test request may take, see start_app
+request_timeout_sec = 120
 
 def init_global_configs(data_folder : str, 
                         reader : dict[str, connector.Connector], 
                         writer: dict[str, connector.Connector], 
                         model : dict[str, model.BaseModel],
-                        scheduler : dict[str, scheduler.Scheduler]):
-    global readers, writers, models, schedulers
+                        scheduler : dict[str, scheduler.Scheduler],
+                        node : cluster.Cluster = None):
+    global readers, writers, models, schedulers, cluster_node
     readers = reader
     writers = writer
     models = model
     schedulers = scheduler
-    common.check_home_folder(data_folder)
+    cluster_node = node
+    common.check_home_folder(data_folder, node.node_id if node is not None else None)
+    for sch in schedulers.values():
+        if hasattr(sch, 'connectors'):
+            sch.connectors = readers
+    for name, sch in schedulers.items():
+        if hasattr(sch, 'register_metrics'):
+            sch.register_metrics(name)
+    for role, connectors in (("reader", readers), ("writer", writers)):
+        for name, cnt in connectors.items():
+            if hasattr(cnt, 'register_metrics'):
+                cnt.register_metrics(name, role)
+    for name, m in models.items():
+        if hasattr(m, 'memory_usage'):
+            metrics.collected("anomaly_model_memory", "Fitted series and bytes held by a configured model",
+                              ("model", "stat"), "gauge",
+                              functools.partial(__model_memory, name, m))
+        if hasattr(m, 'quarantine'):
+            metrics.collected("anomaly_model_quarantined_series", "Series skipped by the fits or infers of a configured model after repeated failures",
+                              ("model",), "gauge",
+                              functools.partial(lambda name, m: {(name,): len(m.quarantine)}, name, m))
+    if cluster_node is not None:
+        if cluster_node.shard_by == "series":
+            for sch in schedulers.values():
+                if hasattr(sch, 'series_filter'):
+                    sch.series_filter = cluster_node.owns_series
+                    sch.checkpoint_node = cluster_node.node_id
+        cluster_node.start()
 
-def start_app(port : int):
-    app.run(port=port, host='0.0.0.0')
+def __model_memory(name : str, m : model.BaseModel) -> Dict[Tuple[str, str], float]:
+    usage = m.memory_usage()
+    return {(name, stat): usage[stat] for stat in ("series", "bytes") if stat in usage}
+
+def start_app(port : int, backend : str = "waitress", threads : int = 16, connection_limit : int = 256,
+              idle_timeout : str = "120s", request_timeout : str = "120s"):
+    '''
+    backend : 'waitress' serves the api with a pool of 'threads' request threads,
+              'flask' is the development server of Flask
+    idle_timeout : a connection idle for this long is closed
+    request_timeout : deadline of the /test requests, a result not ready by then is a 503 (poll the job instead),
+                      a result stream still running then ends with a 'timeout' status line
+    The scheduler threads live in this process, so the api is served by threads rather than worker processes.
+    '''
+    global request_timeout_sec
+    if not common.check_time_range_str(request_timeout):
+        raise ValueError("[CONFIG](Server) 'request_timeout' is invalid")
+    request_timeout_sec = common.parse_time_range_str(request_timeout)
+    if backend == "flask":
+        app.run(port=port, host='0.0.0.0', threaded=True)
+        return
+    if backend != "waitress":
+        raise ValueError("[CONFIG](Server) 'backend' is invalid")
+    if threads <= 0 or connection_limit <= 0 or not common.check_time_range_str(idle_timeout):
+        raise ValueError("[CONFIG](Server) 'threads', 'connection_limit' or 'idle_timeout' is invalid")
+    import waitress
+    waitress.serve(app, host='0.0.0.0', port=port, threads=threads, connection_limit=connection_limit,
+                   channel_timeout=common.parse_time_range_str(idle_timeout), ident="anomaly-detection")
+
+def with_deadline(func):
+    '''
+    flask.g.deadline is the time the request must answer by, request_timeout after it started
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        flask.g.setdefault('deadline', time.time() + request_timeout_sec)
+        return func(*args, **kwargs)
+    return wrapper
 
 def require_url_args(*required_args : str):
     def decorator(func):
@@ -65,17 +140,60 @@ def check_submit(task : dict[str,Any]) -> bool :
 
 def resume_task():
     logger.info("Loading task configs ...")
-    tenant_dir_list = os.listdir(common.task_folder)
-    for tenant in tenant_dir_list:
+    sync_tasks()
+    if cluster_node is not None:
+        # tasks submitted or stopped on other nodes and shards moved by a join or a leave
+        cluster_node.on_tick(__on_tick)
+
+def __on_tick(changed : bool) -> None:
+    sync_tasks()
+    if changed and cluster_node.shard_by == "series":
+        # the series which moved to this node are fitted now rather than at the next 'fit_every'
+        for sch in schedulers.values():
+            if hasattr(sch, 'rebalance'):
+                sch.rebalance()
+
+def __task_files() -> Dict[Tuple[str, str], str]:
+    files = {}
+    for tenant in os.listdir(common.task_folder):
         folder = os.path.join(common.task_folder, tenant)
-        fp_list = os.listdir(folder)
-        for fname in fp_list:
-            fpath = os.path.join(folder, fname)
+        if not os.path.isdir(folder):
+            continue
+        for fname in os.listdir(folder):
+            if fname.endswith(".yaml"):
+                files[(tenant, fname[:-len(".yaml")])] = os.path.join(folder, fname)
+    return files
+
+def __owns_task(tenant : str, task_name : str) -> bool:
+    return cluster_node is None or cluster_node.owns_task(tenant, task_name)
+
+def sync_tasks():
+    '''
+    schedule the saved tasks owned by this node, a task whose file changed is scheduled again,
+    a scheduled task whose file is gone or which moved to another node is stopped
+    '''
+    with tasks_lock:
+        files = __task_files()
+        for (tenant, task_name), fpath in files.items():
+            if not __owns_task(tenant, task_name):
+                continue
+            mtime = os.path.getmtime(fpath)
+            if (tenant, task_name) in scheduled_tasks and scheduled_tasks[(tenant, task_name)][1] == mtime:
+                continue
             with open(fpath, 'r') as f:
                 task = yaml.safe_load(f)
-                succ = __add_scheduled_task(task, tenant)
-                if not succ:
-                    logger.warning("Failed to load task: task_config = %s", tenant, fpath)
+            succ = __add_scheduled_task(task, tenant)
+            if not succ:
+                logger.warning("Failed to load task: tenant = %s, task_config = %s", tenant, fpath)
+            # a bad config is not retried until its file changes
+            scheduled_tasks[(tenant, task_name)] = (task['scheduler_name'] if succ else None, mtime)
+        for (tenant, task_name) in list(scheduled_tasks.keys()):
+            if (tenant, task_name) in files and __owns_task(tenant, task_name):
+                continue
+            scheduler_name, _ = scheduled_tasks.pop((tenant, task_name))
+            if scheduler_name is not None:
+                schedulers[scheduler_name].stop(str(tenant) + "_" + task_name)
+                logger.info("Task released: tenant = %s, task = %s", tenant, task_name)
 
 def __add_scheduled_task(task, tenant) -> bool:
     if task['model_name'] not in models:
@@ -96,7 +214,7 @@ def __add_scheduled_task(task, tenant) -> bool:
                                                 args=task['scheduler_args']) 
     return True
 
-def __submit_once_task(task, tenant) -> Any:
+def __submit_once_task(task, tenant, use_cache : bool = True) -> Any:
     if task['model_name'] not in models:
         return 'Invalid model'
     if not check_submit(task):
@@ -104,15 +222,15 @@ def __submit_once_task(task, tenant) -> Any:
         return 'parameters check failed'
     # get model object
     model = models[task['model_name']]
-    # submit
-    schedulers['once'].schedule(name = "", tenant = str(tenant),
-                                        reader=readers[task['reader_name']], 
-                                        writer=writers[task['writer_name']],
-                                        model=model, 
-                                        model_args=task['model_args'],
-                                        query={task['query_name']:task['query_args']},
-                                        args=task['scheduler_args'])
-    return common.threadlocal.result
+    # submit, the job runs on the workers of the 'once' scheduler
+    return schedulers['once'].submit(name = "", tenant = str(tenant),
+                                     reader=readers[task['reader_name']], 
+                                     writer=writers[task['writer_name']],
+                                     model=model, 
+                                     model_args=task['model_args'],
+                                     query={task['query_name']:task['query_args']},
+                                     args=task['scheduler_args'],
+                                     use_cache=use_cache)
 
 @app.route('/submit/<int:tenant>', methods=['POST'])
 def submit_task(tenant : int):
@@ -132,12 +250,18 @@ def submit_task(tenant : int):
             os.makedirs(tenant_dir)
     else:
         return flask.abort(400, "bad configuration !")
-    with open(os.path.join(tenant_dir, task['name']+'.yaml'), 'w') as f:
-        yaml.safe_dump(task, f)
-    # task scheduling
-    succ = __add_scheduled_task(task, tenant)
-    if not succ:
-        return flask.abort(400, "invalid model config !")
+    task_file = os.path.join(tenant_dir, task['name']+'.yaml')
+    with tasks_lock:
+        with open(task_file, 'w') as f:
+            yaml.safe_dump(task, f)
+        if not __owns_task(str(tenant), task['name']):
+            # scheduled by its owner on the next sync
+            return 'success'
+        # task scheduling
+        succ = __add_scheduled_task(task, tenant)
+        if not succ:
+            return flask.abort(400, "invalid model config !")
+        scheduled_tasks[(str(tenant), task['name'])] = (task['scheduler_name'], os.path.getmtime(task_file))
     return 'success'
 
 @app.route('/stop/<int:tenant>', methods=['POST'])
@@ -148,14 +272,32 @@ def stop_task(tenant : int):
     task_name = request.json.get('name') # str
     tenant_dir = os.path.join(common.task_folder, str(tenant))
     task_file = os.path.join(tenant_dir, task_name + ".yaml")
-    succ = schedulers[scheduler_name].stop(str(tenant) + "_" + task_name)
-    if not succ:
-        return flask.abort(400, "no task to stop")
-    if os.path.isfile(task_file):
-        os.remove(task_file)
+    with tasks_lock:
+        succ = schedulers[scheduler_name].stop(str(tenant) + "_" + task_name)
+        scheduled_tasks.pop((str(tenant), task_name), None)
+        # in a cluster the task may run on another node, which stops it once the file is gone
+        if not succ and not (cluster_node is not None and os.path.isfile(task_file)):
+            return flask.abort(400, "no task to stop")
+        if os.path.isfile(task_file):
+            os.remove(task_file)
+    common.remove_model_checkpoints(str(tenant), str(tenant) + "_" + task_name, all_nodes=True)
     return 'success'
 
+@app.route('/cluster', methods=['GET'])
+def cluster_status():
+    if cluster_node is None:
+        return flask.abort(404, "cluster mode is disabled")
+    status = cluster_node.status()
+    with tasks_lock:
+        status["tasks"] = sorted(tenant + "/" + task_name for (tenant, task_name), (sch, _) in scheduled_tasks.items() if sch is not None)
+    return status
+
+@app.route('/metrics', methods=['GET'])
+def metrics_exposition():
+    return flask.Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/test/<int:tenant>', methods=['POST'])
+@with_deadline
 def test_task(tenant : int):
     task = {}
     task['name'] = "test_" + str(uuid.uuid4()) # str
@@ -169,4 +311,35 @@ def test_task(tenant : int):
     task['query_args'] = request.json.get('query_args')   # dict
     if not check_submit(task):
         return flask.abort(400, "bad configuration !")
-    return __submit_once_task(task, tenant)
\ No newline at end of file
+    try:
+        job_id, cached = __submit_once_task(task, tenant, request.args.get('cache', 'true').lower() != 'false')
+    except RuntimeError as e:
+        return flask.abort(503, str(e))
+    if request.args.get('stream', 'false').lower() == 'true':
+        return test_result(tenant, job_id)
+    job = schedulers['once'].job(job_id)
+    return {"job_id": job_id, "status": job["status"] if job is not None else "done", "cached": cached}, 202
+
+@app.route('/test/<int:tenant>/<job_id>', methods=['GET'])
+def test_job(tenant : int, job_id : str):
+    job = schedulers['once'].job(job_id, tenant=str(tenant))
+    if job is None:
+        return flask.abort(404, "unknown or expired job")
+    return job
+
+@app.route('/test/<int:tenant>/<job_id>/result', methods=['GET'])
+@with_deadline
+def test_result(tenant : int, job_id : str):
+    '''
+    one json line per series as soon as it is inferred, the last line gives the status of the job
+    '''
+    try:
+        lines = schedulers['once'].stream(job_id, tenant=str(tenant), timeout=max(flask.g.deadline - time.time(), 0))
+    except RuntimeError as e:
+        return flask.abort(503, str(e))
+    if lines is None:
+        return flask.abort(404, "unknown or expired job")
+    if not schedulers['once'].wait_ready(job_id, flask.g.deadline - time.time()):
+        lines.close()
+        return flask.abort(503, "no result within 'request_timeout', poll the job and read its result once done !")
+    return flask.Response(lines, mimetype="application/x-ndjson")
\ No newline at end of file
@@ -2,11 +2,13 @@ import yaml
 import argparse
 import logging
 import sys
+import socket
 
 from model import *
 from connector import *
 import handler
 from scheduler import *
+from cluster import Cluster
 
 def load_config(file_path : str) -> dict:
     data = None
@@ -20,6 +22,7 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--config", type=str, help="config file path, default is config.yaml", default="config.yaml")
     parser.add_argument("-m", "--home", type=str, help="Home folder, default is 'data' folder in current path", default=None)
     parser.add_argument("-p", "--port", type=int, help="address on which to expose web interface, default 8450", default=8450)
+    parser.add_argument("-n", "--node-id", type=str, help="node name in cluster mode, default is '<hostname>-<port>'", default=None)
     args = parser.parse_args()
 
     configs = load_config(args.config)
@@ -37,13 +40,19 @@ if __name__ == "__main__":
         if 'writer' in cnt['pipeline']:
             writers[cnt['name']] = globals()[cnt['class']](**cnt['params'])
     for m in configs['model']:
-        models[m['name']] = globals()[m['class']]()
+        models[m['name']] = globals()[m['class']](**m.get('params', {}))
     for sch in configs['scheduler']:
         schedulers[sch['name']] = globals()[sch['class']](**sch['params'])
-    schedulers['once'] = globals()['Once']()
-
-    handler.init_global_configs(args.home, reader=readers, writer=writers, model=models, scheduler = schedulers)
+    if 'once' not in schedulers:
+        schedulers['once'] = globals()['Once']()
+    node = None
+    if configs.get('cluster', {}).get('enabled', False):
+        node_id = args.node_id if args.node_id is not None else socket.gethostname() + "-" + str(args.port)
+        node = Cluster(node_id=node_id, address=socket.gethostname() + ":" + str(args.port), **configs['cluster'].get('params', {}))
+
+    handler.init_global_configs(args.home, reader=readers, writer=writers, model=models, scheduler = schedulers, node = node)
     handler.resume_task()
-    handler.start_app(args.port)
+    server = configs.get('server', {})
+    handler.start_app(args.port, backend=server.get('backend', 'waitress'), **server.get('params', {}))
 
     
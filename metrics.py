@@ -0,0 +1,192 @@
+import bisect
+import math
+import threading
+import time
+import contextlib
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# latency buckets in seconds, from a cached query to a fit of a large task
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def _escape(value : str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names : Tuple[str, ...], values : Tuple[str, ...], extra : str = None) -> str:
+    pairs = [name + '="' + _escape(value) + '"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def _format_value(value : float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+class _Metric():
+
+    type = "untyped"
+
+    def __init__(self, name : str, help : str, label_names : Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def samples(self) -> Iterator[str]:
+        return iter(())
+
+    def exposition(self) -> str:
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " " + self.type]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+class Counter(_Metric):
+    '''
+    monotonic count, counter.inc(*label_values, amount=1)
+    '''
+
+    type = "counter"
+
+    def __init__(self, name : str, help : str, label_names : Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, label_names)
+        self.values : Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values : str, amount : float = 1.0) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield self.name + _format_labels(self.label_names, label_values) + " " + _format_value(value)
+
+class Gauge(Counter):
+    '''
+    value which goes up and down, gauge.set(value, *label_values)
+    '''
+
+    type = "gauge"
+
+    def set(self, value : float, *label_values : str) -> None:
+        with self.lock:
+            self.values[label_values] = value
+
+    def remove(self, *label_values : str) -> None:
+        with self.lock:
+            self.values.pop(label_values, None)
+
+class Histogram(_Metric):
+    '''
+    distribution of observations in cumulative buckets, histogram.observe(value, *label_values)
+    '''
+
+    type = "histogram"
+
+    def __init__(self, name : str, help : str, label_names : Tuple[str, ...] = (),
+                 buckets : Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # {label values : [count of each bucket (not cumulative) + overflow, sum]}
+        self.values : Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value : float, *label_values : str) -> None:
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = ([0] * (len(self.buckets) + 1), [0.0])
+                self.values[label_values] = state
+            state[0][pos] += 1
+            state[1][0] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values : str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = [(label_values, list(counts), total[0]) for label_values, (counts, total) in self.values.items()]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield self.name + "_bucket" + _format_labels(self.label_names, label_values, le) + " " + str(cumulative)
+            labels = _format_labels(self.label_names, label_values)
+            yield self.name + "_sum" + labels + " " + _format_value(total)
+            yield self.name + "_count" + labels + " " + str(cumulative)
+
+class Collected(_Metric):
+    '''
+    samples read at scrape time from the stats the components already keep,
+    collect() returns {label values : value}
+    '''
+
+    def __init__(self, name : str, help : str, label_names : Tuple[str, ...], type : str,
+                 collect : Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        super().__init__(name, help, label_names)
+        self.type = type
+        self.collectors = [collect]
+
+    def samples(self) -> Iterator[str]:
+        for collect in list(self.collectors):
+            for label_values, value in collect().items():
+                yield self.name + _format_labels(self.label_names, label_values) + " " + _format_value(value)
+
+class Registry():
+
+    def __init__(self) -> None:
+        self.metrics : Dict[str, _Metric] = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, cls : type, name : str, help : str, label_names : Tuple[str, ...] = (), **kwargs) -> _Metric:
+        # components are instantiated once per config entry but share their metrics
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, label_names, **kwargs)
+                self.metrics[name] = metric
+            return metric
+
+    def collected(self, name : str, help : str, label_names : Tuple[str, ...], type : str,
+                  collect : Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                self.metrics[name] = Collected(name, help, label_names, type, collect)
+            else:
+                metric.collectors.append(collect)
+
+    def exposition(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        parts = []
+        for metric in metrics:
+            try:
+                parts.append(metric.exposition())
+            except Exception as e:
+                parts.append("# " + metric.name + " collection failed : " + _escape(e) + "\n")
+        return "".join(parts)
+
+REGISTRY = Registry()
+
+def counter(name : str, help : str, label_names : Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.get_or_create(Counter, name, help, label_names)
+
+def gauge(name : str, help : str, label_names : Tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.get_or_create(Gauge, name, help, label_names)
+
+def histogram(name : str, help : str, label_names : Tuple[str, ...] = (), buckets : Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.get_or_create(Histogram, name, help, label_names, buckets=buckets)
+
+def collected(name : str, help : str, label_names : Tuple[str, ...], type : str,
+              collect : Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+    REGISTRY.collected(name, help, label_names, type, collect)
+
+def exposition() -> str:
+    return REGISTRY.exposition()
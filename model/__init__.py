@@ -1,2 +1,3 @@
-from model._interface import BaseModel, InferResult
-from model.m_prophet import ProphetModel
\ No newline at end of file
+from model._interface import BaseModel, InferResult, SeriesQuarantine
+from model.m_prophet import ProphetModel
+from model.m_stats import ZScoreModel, HoltWintersModel, SeasonalQuantileModel
\ No newline at end of file
@@ -1,12 +1,124 @@
 from abc import abstractmethod, ABCMeta
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, List, Set, Tuple
+import sys
+import numpy as np
 import pandas as pd
 import copy
+import json
+import time
+import functools
+import hashlib
+import logging
+import threading
+
+sys.path.append("..")
+import common
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FIT_SECONDS = metrics.histogram("anomaly_model_fit_seconds", "Duration of BaseModel.fit", ("model",))
+INFER_SECONDS = metrics.histogram("anomaly_model_infer_seconds", "Duration of BaseModel.infer", ("model",))
+MODEL_SERIES = metrics.counter("anomaly_model_series_total", "Series passed to fit and infer", ("model", "kind"))
+MODEL_FAILURES = metrics.counter("anomaly_model_failures_total", "Fit or infer calls which failed or raised", ("model", "kind"))
+SERIES_ERRORS = metrics.counter("anomaly_model_series_errors_total", "Series whose fit or infer raised, the other series went on", ("model", "kind"))
+
+def _instrumented(kind : str, method):
+    # records the duration, the input series and the failures of a fit or an infer of any model
+    histogram = FIT_SECONDS if kind == 'fit' else INFER_SECONDS
+    @functools.wraps(method)
+    def wrapper(self, instance : str, y : Dict[str, pd.DataFrame], *args, **kwargs):
+        model = type(self).__name__
+        start_t = time.perf_counter()
+        ok = False
+        try:
+            result = method(self, instance, y, *args, **kwargs)
+            ok = result is not None and result is not False
+            return result
+        finally:
+            histogram.observe(time.perf_counter() - start_t, model)
+            MODEL_SERIES.inc(model, kind, amount=len(y) if y is not None else 0)
+            if not ok:
+                MODEL_FAILURES.inc(model, kind)
+    wrapper.__instrumented__ = True
+    return wrapper
+
+class SeriesQuarantine():
+    '''
+    Failures of the series of the instances of a model
+    A series whose fit (or infer) failed 'max_failures' times in a row is skipped by the next fits (or infers) until its values change,
+    a degenerate series (all NaN, constant, too few points) keeps the same values whatever its timestamps.
+    '''
+
+    def __init__(self, model : str, max_failures : int = 3) -> None:
+        self.model = model
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+        # {(kind, instance, series_id) : (failures in a row, digest of the values of the last failure)}
+        self.failures : Dict[Tuple[str, str, str], Tuple[int, str]] = {}
+
+    @staticmethod
+    def __digest(values : np.ndarray) -> str:
+        return hashlib.md5(np.ascontiguousarray(values, dtype=np.float64).tobytes()).hexdigest()
+
+    def skipped(self, kind : str, instance : str, series_id : str, values : np.ndarray) -> bool:
+        '''
+        kind : 'fit' | 'infer'
+        return: True if the series is quarantined and its values did not change since its last failure
+        '''
+        with self.lock:
+            if len(self.failures) == 0:
+                return False
+            entry = self.failures.get((kind, instance, series_id))
+        if entry is None or entry[0] < self.max_failures:
+            return False
+        return self.__digest(values) == entry[1]
+
+    def failed(self, kind : str, instance : str, series_id : str, values : np.ndarray, error : Any) -> None:
+        SERIES_ERRORS.inc(self.model, kind)
+        digest = self.__digest(values)
+        with self.lock:
+            count = self.failures.get((kind, instance, series_id), (0, None))[0] + 1
+            self.failures[(kind, instance, series_id)] = (count, digest)
+        if count == self.max_failures:
+            logger.warning("[%s](%s) series quarantined after %d failures : series_id = %s, %s",
+                           self.model, kind.capitalize(), count, series_id, error)
+        elif count < self.max_failures:
+            logger.warning("[%s](%s) series failed : series_id = %s, %s", self.model, kind.capitalize(), series_id, error)
+
+    def succeeded(self, kind : str, instance : str, *series_ids : str) -> None:
+        with self.lock:
+            if len(self.failures) == 0:
+                return
+            for series_id in series_ids:
+                self.failures.pop((kind, instance, series_id), None)
+
+    def failing(self, kind : str, instance : str, series_ids : Iterable[str]) -> Set[str]:
+        '''
+        the series among 'series_ids' whose last fit (or infer) failed or was skipped
+        '''
+        with self.lock:
+            if len(self.failures) == 0:
+                return set()
+            return {series_id for series_id in series_ids if (kind, instance, series_id) in self.failures}
+
+    def remove_instance(self, instance : str) -> None:
+        with self.lock:
+            for key in [key for key in self.failures if key[1] == instance]:
+                del self.failures[key]
+
+    def __len__(self) -> int:
+        '''
+        number of quarantined series
+        '''
+        with self.lock:
+            return sum(1 for count, _ in self.failures.values() if count >= self.max_failures)
 
 class InferResult():
 
     '''
-    self.data是一个dataframe，列包含：['ds', 'y', 'yhat', 'yhat_lower', 'yhat_upper', 'anomaly_score']
+    self.data是一个dict，键为列名，值为numpy数组，列包含：['ds', 'y', 'yhat', 'yhat_lower', 'yhat_upper', 'anomaly_score']
+    ds为datetime64[ns]，其余列为float64，传入的numpy数组/Series不会被复制
     '''
 
     def __init__(self, series_id : str, ds : List[int], y : List[float], yhat : List[float], 
@@ -14,12 +126,33 @@ class InferResult():
                  extra_metrics : dict[str, List[Any]]) -> None:
         column = ['ds', 'y', 'yhat', 'yhat_lower', 'yhat_upper', 'anomaly_score']
         data = [ds, y, yhat, yhat_lower, yhat_upper, anomaly_score]
-        if extra_metrics is not None and extra_metrics.__len__ > 0:
+        if extra_metrics is not None and len(extra_metrics) > 0:
             column.extend(extra_metrics.keys())
             data.extend(extra_metrics.values())
-        self.data = pd.DataFrame(columns=column, data=zip(*data))
+        self.data : Dict[str, np.ndarray] = {'ds': np.asarray(ds, dtype='datetime64[ns]')}
+        for name, values in zip(column[1:], data[1:]):
+            self.data[name] = np.asarray(values, dtype=np.float64)
         self.series_id = series_id
 
+    def timestamps(self) -> np.ndarray:
+        '''
+        unix seconds of the 'ds' column, int64
+        '''
+        return self.data['ds'].view(np.int64) // 1000000000
+
+    def since(self, ts_sec : int) -> 'InferResult':
+        '''
+        the rows at or after 'ts_sec' (unix seconds), the arrays are views
+        '''
+        start = int(np.searchsorted(self.timestamps(), ts_sec, side='left'))
+        result = InferResult.__new__(InferResult)
+        result.data = {name: values[start:] for name, values in self.data.items()}
+        result.series_id = self.series_id
+        return result
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.data, copy=False)
+
     def to_metrics(self, metrics_prefix : str, query_name : str, query_labels : dict) -> Tuple[List[str],List[Dict[str,str]],List[Dict[str,str]]]:
         '''
         return:
@@ -27,31 +160,57 @@ class InferResult():
         '''
         metrics_names = []
         values = []
-        for column in self.data.columns:
-            if str(column) in ['ds']:
+        ts_sec = [str(ts) for ts in self.timestamps().tolist()]
+        for column, value in self.data.items():
+            if column == 'ds':
                 continue
-            metrics_name = metrics_prefix + "_" + column
-            value = {}
-            ts_sec = self.data['ds'].astype('int64').divide(1e9)
-            value = self.data[column]
-            to_write = {str(k):str(v) for k,v in zip(ts_sec, value)}
-            metrics_names.append(metrics_name)
-            values.append(to_write)
+            metrics_names.append(metrics_prefix + "_" + column)
+            values.append(dict(zip(ts_sec, map(str, value.tolist()))))
         query_labels['__for'] = query_name
         labels = [query_labels] * len(metrics_names)
         return metrics_names, values, labels
+
+    def to_exposition(self, metrics_prefix : str, query_name : str, query_labels : dict) -> str:
+        '''
+        prometheus text exposition lines of every column, one pass over the arrays
+        '''
+        labels = dict(query_labels)
+        labels['__for'] = query_name
+        label_s = common.format_labels(labels)
+        ts_sec = self.timestamps().tolist()
+        lines = []
+        for column, value in self.data.items():
+            if column == 'ds':
+                continue
+            prefix = metrics_prefix + "_" + column + label_s + " "
+            lines.extend([f"{prefix}{v} {ts}\n" for v, ts in zip(value.tolist(), ts_sec)])
+        return "".join(lines)
+
+    def to_jsonlines(self, metrics_prefix : str, query_name : str, query_labels : dict) -> str:
+        '''
+        one line per column in the format of VictoriaMetrics /api/v1/import
+        '''
+        timestamps = (self.timestamps() * 1000).tolist()
+        lines = []
+        for column, value in self.data.items():
+            if column == 'ds':
+                continue
+            labels = dict(query_labels)
+            labels['__for'] = query_name
+            labels['__name__'] = metrics_prefix + "_" + column
+            lines.append(json.dumps({"metric": labels, "values": value.tolist(), "timestamps": timestamps}) + "\n")
+        return "".join(lines)
     
     def to_metrics_prom(self, metrics_prefix : str, query_labels : dict) -> Dict:
         result = {"data": {"result": []}}
-        for column in self.data.columns:
-            if str(column) in ['ds']:
+        ts_sec = self.timestamps().tolist()
+        for column, value in self.data.items():
+            if column == 'ds':
                 continue
             metrics_name = metrics_prefix + "_" + column
             labels = copy.deepcopy(query_labels)
             labels["__name__"] = metrics_name
-            ts_sec = self.data['ds'].astype('int64').divide(1e9)
-            value = self.data[column]
-            to_write = [[k,str(v)] for k,v in zip(ts_sec, value)]
+            to_write = [[k,str(v)] for k,v in zip(ts_sec, value.tolist())]
             result["data"]["result"].append({"metric": labels, "values": to_write})
         return result
 
@@ -65,6 +224,13 @@ class BaseModel(metaclass=ABCMeta):
 
     [IMPORTANT] the implementation should implement a '__json__' method to enable json serialization
     """
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        for kind in ('fit', 'infer'):
+            method = cls.__dict__.get(kind)
+            if method is not None and not getattr(method, '__instrumented__', False):
+                setattr(cls, kind, _instrumented(kind, method))
+
     @abstractmethod
     def check_args(self, args : dict[str,Any]) -> bool:
         return False
@@ -98,19 +264,33 @@ class BaseModel(metaclass=ABCMeta):
         '''
         instance: instance id
         y: {series_id: Dataframe{columns=[ts,value,...]}}  ts: 'yyyy-MM-dd HH:mm:ss'  value: float
+        the series of the instance missing from y keep their previous fit, a scheduler may refit a few series only
         '''
         return False
+
+    def close(self) -> None:
+        '''
+        release the workers of the model (pools, processes), the model stays usable
+        '''
+        pass
+
+    def failed_series(self, instance : str, series_ids : Iterable[str]) -> Set[str]:
+        '''
+        the series among 'series_ids' whose last fit failed (or was skipped), they keep their previous fit if any
+        '''
+        return set()
     
     @abstractmethod
-    def save_checkpoint(self) -> bool:
+    def save_checkpoint(self, instance : str, path : str) -> bool:
         '''
-        save checkpoint, called by scheduler
+        save the fitted series of an instance to 'path', called by scheduler
         '''
         return False
     
     @abstractmethod
-    def load_checkpoint(self) -> bool:
+    def load_checkpoint(self, instance : str, path : str) -> bool:
         '''
-        load checkpoint, called by scheduler
+        restore the fitted series of an instance from 'path', called by scheduler
+        return False if the checkpoint is missing, corrupted or was saved with other instance args
         '''
         return False
\ No newline at end of file
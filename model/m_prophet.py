@@ -1,26 +1,462 @@
 import sys
+import os
+import copy
+import json
 import model._interface as _interface
+from model.store import InstanceStore
 import uuid
-import random
 import threading
-from typing import Any, Dict, List, Tuple
+import time
+import atexit
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, BinaryIO, Dict, Iterable, List, Set, Tuple
 from prophet import Prophet
+from prophet.models import ModelParams
+from prophet.serialize import model_to_json, model_from_json
 
+import numpy as np
 import pandas as pd
 import logging
 
 sys.path.append("..")
+import common
+import metrics
+
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_VERSION = 2
+
+FIT_STARTS = metrics.counter("anomaly_prophet_series_fits_total",
+                             "Series fitted by ProphetModel, by start of the optimizer (warm from the previous fit, cold)", ("start",))
+FIT_SERIES_SECONDS = metrics.histogram("anomaly_prophet_series_fit_seconds",
+                                       "Duration of the fit of one series by ProphetModel, by start of the optimizer", ("start",))
+
+def _warm_start_params(previous : Prophet, model : Prophet, drift_threshold : float) -> ModelParams:
+    '''
+    convert the fitted parameters of 'previous' to the scales and changepoints of the preprocessed 'model'
+    return: None if a cold start is needed (other structure, or the series drifted from the previous fit)
+    '''
+    if previous is None or previous.params is None or previous.history is None:
+        return None
+    if model.growth != 'linear' or previous.growth != 'linear' or model.mcmc_samples > 0:
+        return None
+    if list(previous.seasonalities) != list(model.seasonalities) \
+        or previous.train_component_cols.shape != model.train_component_cols.shape \
+        or len(previous.changepoints_t) != len(model.changepoints_t):
+        return None
+    # drift : mean absolute residual of the previous fit on the new history, in units of its noise level
+    df = previous.setup_dataframe(model.history[['ds', 'y']].copy())
+    seasonal = previous.predict_seasonal_components(df)
+    yhat = previous.predict_trend(df) * (1 + seasonal['multiplicative_terms']) + seasonal['additive_terms']
+    noise = np.nanmean(previous.params['sigma_obs']) * previous.y_scale
+    if not np.nanmean(np.abs(df['y'] - yhat)) <= drift_threshold * noise:
+        return None
+    k = np.nanmean(previous.params['k'])
+    m = np.nanmean(previous.params['m'])
+    deltas = np.nanmean(previous.params['delta'], axis=0)
+    # trend slope (y units per second) of the previous fit at the new start and at each new changepoint
+    t_new = np.concatenate([[0.0], model.changepoints_t])
+    points = model.start.timestamp() + t_new * model.t_scale.total_seconds()
+    t_prev = (points - previous.start.timestamp()) / previous.t_scale.total_seconds()
+    slopes = k + (deltas[None, :] * (t_prev[:, None] >= previous.changepoints_t[None, :])).sum(axis=1)
+    slopes = slopes * previous.y_scale / previous.t_scale.total_seconds()
+    slopes = slopes * model.t_scale.total_seconds() / model.y_scale
+    trend_start = Prophet.piecewise_linear(t_prev[:1], deltas, k, m, previous.changepoints_t)[0]
+    trend_start = trend_start * previous.y_scale + previous.y_min
+    beta = np.nanmean(previous.params['beta'], axis=0)
+    additive = previous.train_component_cols['additive_terms'].values > 0
+    sigma_obs = np.nanmean(previous.params['sigma_obs']) * previous.y_scale / model.y_scale
+    return ModelParams(k=float(slopes[0]),
+                       m=float((trend_start - model.y_min) / model.y_scale),
+                       delta=np.diff(slopes),
+                       beta=np.where(additive, beta * previous.y_scale / model.y_scale, beta),
+                       sigma_obs=float(max(sigma_obs, 1e-6)))
+
+class _WarmStartProphet(Prophet):
+    '''
+    Prophet whose optimizer starts from the parameters of the previous fit of the same series
+    '''
+
+    def __init__(self, previous : Prophet, drift_threshold : float, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.previous = previous
+        self.drift_threshold = drift_threshold
+        self.warm_started = False
+
+    def calculate_initial_params(self, num_total_regressors : int) -> ModelParams:
+        # called by Prophet.fit once the new history is preprocessed
+        previous, self.previous = self.previous, None
+        try:
+            params = _warm_start_params(previous, self, self.drift_threshold)
+        except Exception as e:
+            logger.warning("[ProphetModel](Fit) warm start failed, fitting from scratch : %s", e)
+            params = None
+        if params is None:
+            return super().calculate_initial_params(num_total_regressors)
+        self.warm_started = True
+        return params
+
+def _new_prophet(args : Dict[str,Any], previous : Prophet, drift_threshold : float) -> Prophet:
+    if previous is None:
+        return Prophet(**args)
+    return _WarmStartProphet(previous, drift_threshold, **args)
+
+def _fit_chunk(args : Dict[str,Any], templates : Dict[str, str], chunk : List[Tuple[str, pd.DataFrame, Any]],
+               drift_threshold : float) -> List[Tuple[str, str, str, bool, float]]:
+    '''
+    executed in a worker process of the fit pool
+        templates : {structure key : serialized template}, the groups of the previous fits of the chunk
+        chunk : [(series_id, data, previous fit)], previous fit is None, (structure key, packed row) or a serialized model
+    return: [(series_id, serialized model or None, error message or None, warm started, fit seconds), ...]
+    '''
+    rebuilt : Dict[str, Prophet] = {}
+    result = []
+    for series_id, data, previous_fit in chunk:
+        try:
+            previous = None
+            if isinstance(previous_fit, tuple):
+                key, row = previous_fit
+                if key not in rebuilt:
+                    rebuilt[key] = model_from_json(templates[key])
+                previous = _unpack(rebuilt[key], row)
+            elif previous_fit is not None:
+                previous = model_from_json(previous_fit)
+            start_t = time.perf_counter()
+            model = _new_prophet(args, previous, drift_threshold)
+            model.fit(data)
+            seconds = time.perf_counter() - start_t
+            result.append((series_id, model_to_json(_slim(model)), None, getattr(model, 'warm_started', False), seconds))
+        except Exception as e:
+            result.append((series_id, None, str(e), False, 0.0))
+    return result
+
+def _fast_infer_supported(model : Prophet) -> bool:
+    if model.growth not in ('linear', 'flat') or len(model.extra_regressors) > 0:
+        return False
+    return all(props['condition_name'] is None for props in model.seasonalities.values())
+
+def _feature_config_key(model : Prophet) -> str:
+    holidays = None if model.holidays is None else model.holidays.to_json()
+    holiday_names = None if model.train_holiday_names is None else list(model.train_holiday_names)
+    return json.dumps([model.seasonalities, model.country_holidays, holiday_names, holidays, model.component_modes],
+                      sort_keys=True, default=str)
+
+class _FeatureCache():
+    '''
+    seasonality and holiday feature matrices keyed by (timestamp grid, seasonality config),
+    series sharing a grid and a config share one matrix
+    '''
+
+    def __init__(self, max_entries : int = 64) -> None:
+        self.max_entries = max_entries
+        self.entries : OrderedDict[Tuple[str, str], Tuple[np.ndarray, np.ndarray, np.ndarray]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, grid_key : str, config_key : str, model : Prophet, ds : pd.Series) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        return: (features T x K, additive column mask K, multiplicative column mask K)
+        '''
+        key = (grid_key, config_key)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        df = model.setup_dataframe(pd.DataFrame({'ds': ds}))
+        features, _, component_cols, _ = model.make_all_seasonality_features(df)
+        entry = (features.values,
+                 component_cols['additive_terms'].values > 0,
+                 component_cols['multiplicative_terms'].values > 0)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+def _slim(model : Prophet) -> Prophet:
+    '''
+    drop what inference does not need : the stan backend, the fit inputs and the per sample trend,
+    the training history is cut to its last row (Prophet.predict and model_to_json only check that it is set)
+    '''
+    model.history = model.history.iloc[-1:].copy()
+    model.history_dates = model.history_dates.iloc[-1:].copy()
+    model.stan_backend = None
+    model.fit_kwargs = {}
+    if model.params is not None:
+        model.params.pop('trend', None)
+    return model
+
+def _packable(model : Prophet) -> bool:
+    return _fast_infer_supported(model) and model.mcmc_samples == 0
+
+def _structure_key(model : Prophet) -> str:
+    # series of one group share their features and their parameter shapes
+    structure = [_feature_config_key(model), model.growth, model.scaling, len(model.changepoints_t),
+                 model.params['beta'].shape[1], model.interval_width, model.uncertainty_samples]
+    return hashlib.md5(json.dumps(structure, default=str).encode('utf-8')).hexdigest()
+
+def _pack_row(model : Prophet) -> Dict[str, Any]:
+    linear = model.growth == 'linear'
+    return {'k': np.nanmean(model.params['k']) if linear else 0.0,
+            'm': np.nanmean(model.params['m']),
+            'sigma': np.nanmean(model.params['sigma_obs']),
+            'start': model.start.timestamp(),
+            't_scale': model.t_scale.total_seconds(),
+            'y_scale': model.y_scale,
+            'y_min': model.y_min,
+            'delta': np.nanmean(model.params['delta'], axis=0) if linear else np.zeros(len(model.changepoints_t)),
+            'changepoints_t': np.asarray(model.changepoints_t, dtype=np.float64),
+            'beta': np.nanmean(model.params['beta'], axis=0)}
+
+def _unpack(template : Prophet, row : Dict[str, Any]) -> Prophet:
+    '''
+    a Prophet of one series, built from the template of its group and its row of parameters, see _pack_row
+    '''
+    model = copy.copy(template)
+    model.params = {'k': np.array([[row['k']]]), 'm': np.array([[row['m']]]), 'delta': row['delta'][None, :].copy(),
+                    'beta': row['beta'][None, :].copy(), 'sigma_obs': np.array([[row['sigma']]])}
+    model.start = pd.Timestamp(row['start'], unit='s')
+    model.t_scale = pd.Timedelta(seconds=row['t_scale'])
+    model.y_scale = float(row['y_scale'])
+    model.y_min = float(row['y_min'])
+    model.changepoints_t = row['changepoints_t'].copy()
+    model.changepoints = pd.Series(model.start + pd.to_timedelta(model.changepoints_t * row['t_scale'], unit='s'), name='ds')
+    return model
+
+class _PackedGroup():
+    '''
+    fitted series sharing one structure, their point estimates stacked one row per series
+        template : a slim fitted model of the group without parameters, source of the config and the features
+        params : {name : array of shape (series, ...)}, see _pack_row
+    '''
+
+    def __init__(self, template : Prophet, ids : List[str], params : Dict[str, np.ndarray], template_json : str = None) -> None:
+        self.template = template
+        self.config_key = _feature_config_key(template)
+        self.ids = ids
+        self.params = params
+        self.index : Dict[str, int] = {series_id: row for row, series_id in enumerate(ids)}
+        self.template_json : str = template_json
+
+    @staticmethod
+    def pack(template : Prophet, rows : List[Tuple[str, Dict[str, Any]]]) -> '_PackedGroup':
+        params = {name: np.array([row[name] for _, row in rows], dtype=np.float64) for name in rows[0][1]}
+        return _PackedGroup(template, [series_id for series_id, _ in rows], params)
+
+    def row(self, series_id : str) -> Dict[str, Any]:
+        return {name: values[self.index[series_id]] for name, values in self.params.items()}
+
+    def unpack(self, series_id : str) -> Prophet:
+        '''
+        rebuild a Prophet of the series, for Prophet.predict and warm starts
+        '''
+        return _unpack(self.template, self.row(series_id))
+
+    def serialized_template(self) -> str:
+        '''
+        the template as json, computed once, the template is shared with the groups derived from this one
+        '''
+        if self.template_json is None:
+            self.template_json = model_to_json(self.template)
+        return self.template_json
+
+    def take(self, rows : np.ndarray) -> Dict[str, np.ndarray]:
+        return {name: values[rows] for name, values in self.params.items()}
+
+    def without(self, series_ids : Any) -> '_PackedGroup':
+        kept = [row for row, series_id in enumerate(self.ids) if series_id not in series_ids]
+        if len(kept) == len(self.ids):
+            return self
+        kept = np.array(kept, dtype=np.int64)
+        return _PackedGroup(self.template, [self.ids[row] for row in kept], self.take(kept), self.template_json)
+
+    def extend(self, rows : List[Tuple[str, Dict[str, Any]]]) -> '_PackedGroup':
+        added = _PackedGroup.pack(self.template, rows)
+        if len(self.ids) == 0:
+            return added
+        params = {name: np.concatenate([values, added.params[name]]) for name, values in self.params.items()}
+        return _PackedGroup(self.template, self.ids + added.ids, params, self.template_json)
+
+class _PackedInstance():
+    '''
+    fitted series of an instance, payload of the InstanceStore
+        groups : {structure key : _PackedGroup}, the series the fast path can evaluate, kept as arrays
+        others : {series_id : slim Prophet}, series which need the full model (logistic growth, regressors, mcmc ...)
+    Never mutated, with_models returns a new payload.
+    '''
+
+    # rough size of a slim Prophet besides its arrays : seasonality config, one row frames, python objects
+    MODEL_OVERHEAD = 16384
+
+    def __init__(self, groups : Dict[str, _PackedGroup] = None, others : Dict[str, Prophet] = None) -> None:
+        self.groups = groups if groups is not None else {}
+        self.others = others if others is not None else {}
+        self.series = sum(len(group.ids) for group in self.groups.values()) + len(self.others)
+        self.nbytes = sum(self.__group_bytes(group) for group in self.groups.values()) \
+            + sum(self.__model_bytes(model) for model in self.others.values())
+
+    @staticmethod
+    def __group_bytes(group : _PackedGroup) -> int:
+        # ids : string and index entry
+        return sum(values.nbytes for values in group.params.values()) + 128 * len(group.ids) + _PackedInstance.MODEL_OVERHEAD
+
+    @staticmethod
+    def __model_bytes(model : Prophet) -> int:
+        arrays = sum(np.asarray(values).nbytes for values in model.params.values())
+        return arrays + int(model.history.memory_usage(deep=True).sum()) + _PackedInstance.MODEL_OVERHEAD
+
+    def locate(self, series_id : str) -> Tuple[str, _PackedGroup]:
+        '''
+        return: (structure key, group) of a packed series, (None, None) otherwise
+        '''
+        for key, group in self.groups.items():
+            if series_id in group.index:
+                return key, group
+        return None, None
+
+    def get(self, series_id : str) -> Prophet:
+        if series_id in self.others:
+            return self.others[series_id]
+        _, group = self.locate(series_id)
+        return group.unpack(series_id) if group is not None else None
+
+    def ids(self) -> List[str]:
+        ids = list(self.others.keys())
+        for group in self.groups.values():
+            ids.extend(group.ids)
+        return ids
+
+    def with_models(self, models : Dict[str, Prophet]) -> '_PackedInstance':
+        '''
+        a payload where the given freshly fitted models replace the previous fit of their series
+        '''
+        if len(models) == 0:
+            return self
+        rows : Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        templates : Dict[str, Prophet] = {}
+        others = {series_id: model for series_id, model in self.others.items() if series_id not in models}
+        for series_id, model in models.items():
+            if not _packable(model):
+                others[series_id] = _slim(model)
+                continue
+            key = _structure_key(model)
+            rows.setdefault(key, []).append((series_id, _pack_row(model)))
+            if key not in templates:
+                template = _slim(model)
+                template.params = {}
+                templates[key] = template
+        groups = {}
+        for key, group in self.groups.items():
+            group = group.without(models)
+            if len(group.ids) > 0 or key in rows:
+                groups[key] = group
+        for key, added in rows.items():
+            groups[key] = groups[key].extend(added) if key in groups else _PackedGroup.pack(templates[key], added)
+        return _PackedInstance(groups, others)
+
+    def dump(self, f : BinaryIO, header : Dict[str, Any] = None) -> None:
+        '''
+        npz archive : 'header', 'groups' (json of the templates), the arrays of each group and 'others' (json)
+        '''
+        arrays = {"header": np.array(json.dumps(header if header is not None else {})),
+                  "groups": np.array(json.dumps([[key, group.serialized_template()] for key, group in self.groups.items()])),
+                  "others": np.array(json.dumps({series_id: model_to_json(model) for series_id, model in self.others.items()}))}
+        for pos, group in enumerate(self.groups.values()):
+            arrays["g%d_ids" % pos] = np.array(group.ids, dtype=str)
+            for name, values in group.params.items():
+                arrays["g%d_%s" % (pos, name)] = values
+        np.savez_compressed(f, **arrays)
+
+    @staticmethod
+    def read_header(f : BinaryIO) -> Dict[str, Any]:
+        with np.load(f, allow_pickle=False) as archive:
+            return json.loads(str(archive["header"]))
+
+    @staticmethod
+    def load(f : BinaryIO) -> '_PackedInstance':
+        with np.load(f, allow_pickle=False) as archive:
+            groups = {}
+            for pos, (key, template_json) in enumerate(json.loads(str(archive["groups"]))):
+                prefix = "g%d_" % pos
+                params = {name[len(prefix):]: archive[name] for name in archive.files
+                          if name.startswith(prefix) and name != prefix + "ids"}
+                groups[key] = _PackedGroup(model_from_json(template_json), archive[prefix + "ids"].tolist(), params, template_json)
+            others = {series_id: model_from_json(model_json)
+                      for series_id, model_json in json.loads(str(archive["others"])).items()}
+        return _PackedInstance(groups, others)
+
+def _predict_group(params : Dict[str, np.ndarray], ts : np.ndarray, features : np.ndarray,
+                   additive : np.ndarray, multiplicative : np.ndarray, scaling : str) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    evaluate trend and seasonal components of many packed series on one timestamp grid (unix seconds)
+    return: (yhat T x n, observation noise n) in y units
+    '''
+    k, b, deltas, changepoints, beta = params['k'], params['m'], params['delta'], params['changepoints_t'], params['beta']
+    y_scale = params['y_scale']
+    floor = params['y_min'] if scaling == 'minmax' else np.zeros(len(k))
+    sigma = params['sigma'] * y_scale
+    # piecewise linear trend, T x n
+    t = (ts[:, None] - params['start'][None, :]) / params['t_scale'][None, :]
+    passed = t[:, :, None] >= changepoints[None, :, :]
+    slope = k[None, :] + (passed * deltas[None, :, :]).sum(axis=2)
+    offset = b[None, :] + (passed * (-changepoints * deltas)[None, :, :]).sum(axis=2)
+    trend = (slope * t + offset) * y_scale[None, :] + floor[None, :]
+    add = (features @ (beta * additive[None, :]).T) * y_scale[None, :]
+    mult = features @ (beta * multiplicative[None, :]).T
+    return trend * (1 + mult) + add, sigma
+
 class ProphetModel(_interface.BaseModel):
 
     lock = threading.Lock()
 
-    def __init__(self) -> None:
-        # {instance_id : {series_id : model instance}}
-        self.instances : Dict[str, Dict[str,Prophet]] = {}
+    def __init__(self, fit_backend : str = "local", fit_workers : int = 0, fit_chunksize : int = 8,
+                 warm_start : bool = False, warm_start_drift : float = 3.0,
+                 infer_mode : str = "prophet", uncertainty_samples : int = None,
+                 max_memory_mb : float = 0, max_series_failures : int = 3) -> None:
+        '''
+        fit_backend : 'local' fits series one by one in the calling thread,
+                      'process' fits series in parallel in a pool of worker processes
+        fit_workers : size of the process pool, <= 0 means the number of cpu cores
+        fit_chunksize : number of series shipped to a worker at a time
+        warm_start : start refits of a series from the parameters of its previous fit
+        warm_start_drift : refit from scratch when the previous fit misses the new data by more than
+                           this many noise levels (mean absolute residual / sigma_obs)
+        infer_mode : 'prophet' calls Prophet.predict for each series,
+                     'fast' evaluates trend and seasonalities of many series at once with shared feature
+                     matrices and analytic intervals (observation noise only, no trend uncertainty sampling)
+        uncertainty_samples : overrides the uncertainty samples drawn by Prophet.predict, None keeps the model args
+        max_memory_mb : memory of the fitted series above which the least recently used instances are
+                        spilled to disk, <= 0 means no limit
+        max_series_failures : a series failing this many fits (or infers) in a row is skipped until its values change,
+                              the failure of a series never stops the other ones
+        '''
+        if fit_backend not in ("local", "process"):
+            raise ValueError("[CONFIG](ProphetModel) 'fit_backend' is invalid")
+        if infer_mode not in ("prophet", "fast"):
+            raise ValueError("[CONFIG](ProphetModel) 'infer_mode' is invalid")
+        if fit_chunksize <= 0:
+            raise ValueError("[CONFIG](ProphetModel) 'fit_chunksize' is invalid")
+        if max_series_failures <= 0:
+            raise ValueError("[CONFIG](ProphetModel) 'max_series_failures' is invalid")
+        # {instance_id : _PackedInstance}, only the point estimates needed by inference are kept
+        self.store = InstanceStore("prophet", _PackedInstance.load, int(max_memory_mb * 1024 * 1024))
         # {instance_id : {args map}}
         self.instances_args : Dict[str, Dict[str,Any]] = {}
+        self.fit_backend = fit_backend
+        self.fit_workers = fit_workers if fit_workers > 0 else os.cpu_count()
+        self.fit_chunksize = fit_chunksize
+        self.fit_pool : ProcessPoolExecutor = None
+        atexit.register(self.close)
+        self.warm_start = warm_start
+        self.warm_start_drift = warm_start_drift
+        self.infer_mode = infer_mode
+        self.uncertainty_samples = uncertainty_samples
+        self.feature_cache = _FeatureCache()
+        self.quarantine = _interface.SeriesQuarantine("ProphetModel", max_series_failures)
 
     def check_args(self, args : dict[str,Any]) -> bool:
         try:
@@ -32,64 +468,280 @@ class ProphetModel(_interface.BaseModel):
     def create_instance(self, args : dict[str,Any]) -> str:
         instance_id = uuid.uuid4()
         self.instances_args[instance_id] = args
-        self.instances[instance_id] = {}
+        self.store.put(instance_id, _PackedInstance())
         return instance_id
 
     def remove_instance(self, instance_id : str) -> bool:
-        if instance_id in self.instances:
-            del self.instances[instance_id]
-        if instance_id in self.instances_args:
-            del self.instances_args[instance_id]
-        # 20% probability to copy to a new dict
-        if random.randint(1, 100) > 80:
-            with ProphetModel.lock:
-                self.instances = dict(self.instances)
-                self.instances_args = dict(self.instances_args)
+        with ProphetModel.lock:
+            self.instances_args.pop(instance_id, None)
+        self.store.remove(instance_id)
+        self.quarantine.remove_instance(instance_id)
         return True
+
+    def failed_series(self, instance : str, series_ids : Iterable[str]) -> Set[str]:
+        return self.quarantine.failing('fit', instance, series_ids)
+
+    def memory_usage(self) -> Dict[str, Any]:
+        '''
+        {'instances', 'spilled', 'bytes', 'series', 'bytes_per_series', 'spills', 'loads', 'per_instance'}
+        '''
+        usage = self.store.stats()
+        usage["per_instance"] = self.store.usage()
+        return usage
     
     def infer(self, instance : str, y : Dict[str, pd.DataFrame]) -> Dict[str, _interface.InferResult]:
-        if instance not in self.instances:
-            return None
-        series_map = self.instances[instance]
-        if len(series_map) == 0:
+        packed : _PackedInstance = self.store.get(instance)
+        if packed is None or packed.series == 0:
             return None
         result_map : Dict[str, _interface.InferResult] = {}
+        if self.infer_mode == "fast":
+            y = self.__infer_fast(instance, packed, y, result_map)
         for series_id, df in y.items():
-            if series_id not in series_map:
+            model = packed.get(series_id)
+            if model is None or self.quarantine.skipped('infer', instance, series_id, df['y'].values):
+                continue
+            try:
+                if self.uncertainty_samples is not None:
+                    model.uncertainty_samples = self.uncertainty_samples
+                predicted = model.predict(df[['ds']])
+                yhat, yhat_lower, yhat_upper = predicted['yhat'].values, predicted['yhat_lower'].values, predicted['yhat_upper'].values
+                score = self.__evaluate_anomaly_score(df['y'].values, yhat, yhat_lower, yhat_upper)
+                result = _interface.InferResult(series_id, predicted['ds'].values, df['y'].values,
+                                                yhat, yhat_lower, yhat_upper, score, None)
+            except Exception as e:
+                # the other series go on
+                self.quarantine.failed('infer', instance, series_id, df['y'].values, e)
                 continue
-            model = series_map[series_id]
-            predicted = model.predict(df[['ds']])
-            score = self.__evaluate_anomaly_score(predicted, df)
-            result = _interface.InferResult(series_id, list(predicted['ds']), list(df['y']), 
-                                            list(predicted['yhat']), list(predicted['yhat_lower']),
-                                            list(predicted['yhat_upper']), score, None)
+            self.quarantine.succeeded('infer', instance, series_id)
             result_map[series_id] = result
         return result_map
 
-    def __evaluate_anomaly_score(self, predicted : pd.DataFrame, y : pd.DataFrame) -> List[float]:
-        score = 2*(y['y']-predicted['yhat'])/(predicted['yhat_upper']-predicted['yhat_lower'])
-        return list(score)
+    def __infer_fast(self, instance : str, packed : _PackedInstance, y : Dict[str, pd.DataFrame],
+                     result_map : Dict[str, _interface.InferResult]) -> Dict[str, pd.DataFrame]:
+        '''
+        infer the packed series in groups sharing a timestamp grid and a structure
+        return: the series left to Prophet.predict, the series of a group which failed included
+        '''
+        fallback : Dict[str, pd.DataFrame] = {}
+        batches : Dict[Tuple[str, str], List[Tuple[str, int, pd.DataFrame]]] = {}
+        for series_id, df in y.items():
+            key, group = packed.locate(series_id)
+            if group is None:
+                if series_id in packed.others:
+                    fallback[series_id] = df
+                continue
+            if self.quarantine.skipped('infer', instance, series_id, df['y'].values):
+                continue
+            ds = df['ds'].values.astype('datetime64[ns]')
+            grid_key = hashlib.md5(ds.view(np.int64).tobytes()).hexdigest()
+            batches.setdefault((key, grid_key), []).append((series_id, group.index[series_id], df))
+        for (key, grid_key), members in batches.items():
+            group = packed.groups[key]
+            first_df = members[0][2]
+            try:
+                features, additive, multiplicative = self.feature_cache.get(grid_key, group.config_key, group.template, first_df['ds'])
+            except Exception as e:
+                logger.warning("[ProphetModel](Infer) fast infer failed, %d series left to Prophet.predict : %s", len(members), e)
+                fallback.update({series_id: df for series_id, _, df in members})
+                continue
+            ts = first_df['ds'].values.astype('datetime64[ns]').view(np.int64) / 1e9
+            half_width = NormalDist().inv_cdf(0.5 + group.template.interval_width / 2)
+            # bounds the (timestamps x series x changepoints) temporaries of _predict_group
+            for chunk_start in range(0, len(members), 256):
+                chunk = members[chunk_start:chunk_start + 256]
+                try:
+                    params = group.take(np.array([row for _, row, _ in chunk], dtype=np.int64))
+                    yhat, sigma = _predict_group(params, ts, features, additive, multiplicative, group.template.scaling)
+                except Exception as e:
+                    # Prophet.predict isolates the series of the chunk
+                    logger.warning("[ProphetModel](Infer) fast infer failed, %d series left to Prophet.predict : %s", len(chunk), e)
+                    fallback.update({series_id: df for series_id, _, df in chunk})
+                    continue
+                inferred = []
+                for pos, (series_id, _, df) in enumerate(chunk):
+                    y_values = df['y'].values
+                    try:
+                        half = half_width * sigma[pos]
+                        series_yhat = yhat[:, pos]
+                        score = self.__evaluate_anomaly_score(y_values, series_yhat, series_yhat - half, series_yhat + half)
+                        result_map[series_id] = _interface.InferResult(series_id, df['ds'].values, y_values, series_yhat,
+                                                                       series_yhat - half, series_yhat + half, score, None)
+                    except Exception as e:
+                        # the other series go on
+                        self.quarantine.failed('infer', instance, series_id, y_values, e)
+                        continue
+                    inferred.append(series_id)
+                self.quarantine.succeeded('infer', instance, *inferred)
+        return fallback
+
+    def __evaluate_anomaly_score(self, y : np.ndarray, yhat : np.ndarray, yhat_lower : np.ndarray, yhat_upper : np.ndarray) -> np.ndarray:
+        return 2*(y-yhat)/(yhat_upper-yhat_lower)
     
     def fit(self, instance : str, y : Dict[str, pd.DataFrame]) -> bool:
         if instance not in self.instances_args:
             return False
-        if instance not in self.instances:
-            self.instances[instance] = {}
+        packed : _PackedInstance = self.store.get(instance)
+        if packed is None:
+            packed = _PackedInstance()
+        if self.fit_backend == "process":
+            return self.__fit_parallel(instance, packed, y)
+        fitted : Dict[str, Prophet] = {}
+        failed = 0
         for series_id, data in y.items():
             if not ('y' in data.columns and 'ds' in data.columns):
                 logger.error("[ProphetModel](Fit) invalid fit dataset (series_id=%s), lack of columns", series_id)
                 continue
+            if self.quarantine.skipped('fit', instance, series_id, data['y'].values):
+                continue
             try:
-                model = Prophet(**self.instances_args[instance])
+                start_t = time.perf_counter()
+                previous = packed.get(series_id) if self.warm_start else None
+                model = _new_prophet(self.instances_args[instance], previous, self.warm_start_drift)
                 model.fit(data)
-                self.instances[instance][series_id] = model
             except Exception as e:
-                logger.error("[ProphetModel](Fit) fitting error : %s", e)
-                return False
-        return True
+                # the other series go on
+                self.quarantine.failed('fit', instance, series_id, data['y'].values, e)
+                failed += 1
+                continue
+            self.quarantine.succeeded('fit', instance, series_id)
+            self.__count_fit(getattr(model, 'warm_started', False), time.perf_counter() - start_t)
+            fitted[series_id] = model
+        self.__store_fitted(instance, packed, fitted)
+        return self.__fit_done(len(fitted), failed)
+
+    def __fit_done(self, fitted : int, failed : int) -> bool:
+        '''
+        a fit succeeds if at least one series was fitted, or none failed
+        '''
+        if failed > 0:
+            logger.warning("[ProphetModel](Fit) %d series fitted, %d failed", fitted, failed)
+        return fitted > 0 or failed == 0
+
+    def __store_fitted(self, instance : str, packed : _PackedInstance, fitted : Dict[str, Prophet]) -> None:
+        # the training history and the stan handles are dropped here, only the packed parameters are kept
+        packed = packed.with_models(fitted)
+        with ProphetModel.lock:
+            if instance in self.instances_args:
+                self.store.put(instance, packed)
+
+    @staticmethod
+    def __count_fit(warm_started : bool, seconds : float) -> None:
+        start = "warm" if warm_started else "cold"
+        FIT_STARTS.inc(start)
+        FIT_SERIES_SECONDS.observe(seconds, start)
+
+    def __get_fit_pool(self) -> ProcessPoolExecutor:
+        with ProphetModel.lock:
+            if self.fit_pool is None:
+                # 'spawn' avoids forking the threads of the scheduler into the workers
+                self.fit_pool = ProcessPoolExecutor(max_workers=self.fit_workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            return self.fit_pool
+
+    def close(self) -> None:
+        '''
+        stop the fit pool, its worker processes are spawned again by the next parallel fit
+        '''
+        with ProphetModel.lock:
+            pool, self.fit_pool = self.fit_pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def __fit_parallel(self, instance : str, packed : _PackedInstance, y : Dict[str, pd.DataFrame]) -> bool:
+        # previous fits are shipped as packed rows and rebuilt in the workers, each template is serialized once
+        chunks : List[Tuple[Dict[str, str], List[Tuple[str, pd.DataFrame, Any]]]] = [({}, [])]
+        for series_id, data in y.items():
+            if not ('y' in data.columns and 'ds' in data.columns):
+                logger.error("[ProphetModel](Fit) invalid fit dataset (series_id=%s), lack of columns", series_id)
+                continue
+            if self.quarantine.skipped('fit', instance, series_id, data['y'].values):
+                continue
+            if len(chunks[-1][1]) >= self.fit_chunksize:
+                chunks.append(({}, []))
+            templates, chunk = chunks[-1]
+            previous_fit = None
+            if self.warm_start:
+                key, group = packed.locate(series_id)
+                if group is not None:
+                    templates[key] = group.serialized_template()
+                    previous_fit = (key, group.row(series_id))
+                elif series_id in packed.others:
+                    # not packable (logistic growth, regressors ...), rare
+                    previous_fit = model_to_json(packed.others[series_id])
+            chunk.append((series_id, data[['ds', 'y']], previous_fit))
+        args = self.instances_args[instance]
+        pool = self.__get_fit_pool()
+        fitted : Dict[str, Prophet] = {}
+        try:
+            futures = [(chunk, pool.submit(_fit_chunk, args, templates, chunk, self.warm_start_drift))
+                       for templates, chunk in chunks if len(chunk) > 0]
+            failed = 0
+            for chunk, future in futures:
+                values = {series_id: data['y'].values for series_id, data, _ in chunk}
+                for series_id, model_json, error, warm_started, seconds in future.result():
+                    if error is not None:
+                        self.quarantine.failed('fit', instance, series_id, values[series_id], error)
+                        failed += 1
+                        continue
+                    self.quarantine.succeeded('fit', instance, series_id)
+                    self.__count_fit(warm_started, seconds)
+                    fitted[series_id] = model_from_json(model_json)
+            return self.__fit_done(len(fitted), failed)
+        except BrokenProcessPool as e:
+            logger.error("[ProphetModel](Fit) fit pool is broken, recreating : %s", e)
+            with ProphetModel.lock:
+                self.fit_pool = None
+            return False
+        finally:
+            self.__store_fitted(instance, packed, fitted)
             
-    def save_checkpoint(self) -> bool:
-        return False
+    def save_checkpoint(self, instance : str, path : str) -> bool:
+        '''
+        the packed series as a npz archive, with a header {version, args_hash, series}
+        '''
+        if instance not in self.instances_args:
+            return False
+        packed : _PackedInstance = self.store.get(instance)
+        if packed is None:
+            return False
+        header = {"version": CHECKPOINT_VERSION,
+                  "args_hash": common.map_hash(self.instances_args[instance]),
+                  "series": packed.series}
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                packed.dump(f, header)
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            logger.error("[ProphetModel](Checkpoint) saving error : path = %s, %s", path, e)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return False
 
-    def load_checkpoint(self) -> bool:
-        return False
\ No newline at end of file
+    def load_checkpoint(self, instance : str, path : str) -> bool:
+        if instance not in self.instances_args:
+            return False
+        try:
+            with open(path, 'rb') as f:
+                header = _PackedInstance.read_header(f)
+                if header.get("version") != CHECKPOINT_VERSION:
+                    logger.info("[ProphetModel](Checkpoint) version mismatch, ignored : path = %s", path)
+                    return False
+                if header.get("args_hash") != common.map_hash(self.instances_args[instance]):
+                    logger.info("[ProphetModel](Checkpoint) instance args changed, ignored : path = %s", path)
+                    return False
+                f.seek(0)
+                loaded = _PackedInstance.load(f)
+        except Exception as e:
+            logger.warning("[ProphetModel](Checkpoint) unreadable checkpoint : path = %s, %s", path, e)
+            return False
+        current : _PackedInstance = self.store.get(instance)
+        if current is not None and current.series > 0:
+            # series fitted since the instance was created are newer
+            loaded = loaded.with_models({series_id: current.get(series_id) for series_id in current.ids()})
+        with ProphetModel.lock:
+            if instance in self.instances_args:
+                self.store.put(instance, loaded)
+        logger.info("[ProphetModel](Checkpoint) %d series loaded : path = %s", loaded.series, path)
+        return True
@@ -0,0 +1,620 @@
+import sys
+import os
+import json
+import uuid
+import threading
+import warnings
+import model._interface as _interface
+from abc import abstractmethod
+from collections import ChainMap
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import logging
+
+sys.path.append("..")
+import common
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+def _series_arrays(y : Dict[str, pd.DataFrame]) -> Iterator[Tuple[List[str], List[np.ndarray], List[np.ndarray]]]:
+    '''
+    yield (series_ids, timestamps, values) of each query result merged in 'y', the first mapping wins on duplicates
+    timestamps are int64 unix seconds, values are float64
+    '''
+    maps = y.maps if isinstance(y, ChainMap) else [y]
+    seen = set()
+    for mapping in maps:
+        # a SeriesBlock hands out views on its buffers, no dataframe is built
+        arrays = getattr(mapping, 'arrays', None)
+        ids, ts_list, value_list = [], [], []
+        for series_id in mapping.keys():
+            if series_id in seen:
+                continue
+            seen.add(series_id)
+            if arrays is not None:
+                ts, values = arrays(series_id)
+            else:
+                df = mapping[series_id]
+                ts = df['ds'].values.astype('datetime64[ns]').view(np.int64) // 1000000000
+                values = df['y'].values
+            if len(ts) == 0:
+                continue
+            ids.append(series_id)
+            ts_list.append(np.asarray(ts, dtype=np.int64))
+            value_list.append(np.asarray(values, dtype=np.float64))
+        if len(ids) > 0:
+            yield ids, ts_list, value_list
+
+class _SeriesMatrix():
+    '''
+    series of one query result aligned on a common step grid
+        values : (series x time) float64, NaN where a sample is missing
+        grid : int64 unix seconds of the columns
+        ts, y : original samples of every series, concatenated
+        cols : column of every original sample
+        offsets : samples of the i-th series are [offsets[i], offsets[i+1])
+    '''
+
+    def __init__(self, ids : List[str], ts_list : List[np.ndarray], value_list : List[np.ndarray]) -> None:
+        self.ids = ids
+        counts = np.array([len(ts) for ts in ts_list], dtype=np.int64)
+        self.offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.ts = np.concatenate(ts_list)
+        self.y = np.concatenate(value_list)
+        self.step = self.__guess_step()
+        t0 = int(self.ts.min())
+        self.cols = np.rint((self.ts - t0) / self.step).astype(np.int64)
+        self.grid = t0 + np.arange(int(self.cols.max()) + 1, dtype=np.int64) * self.step
+        self.values = np.full((len(ids), len(self.grid)), np.nan)
+        self.values[np.repeat(np.arange(len(ids)), counts), self.cols] = self.y
+
+    def __guess_step(self) -> int:
+        diffs = np.diff(self.ts)
+        # differences across two series are meaningless
+        inner = np.ones(len(diffs), dtype=bool)
+        inner[self.offsets[1:-1] - 1] = False
+        diffs = diffs[inner & (diffs > 0)] if len(diffs) > 0 else diffs
+        if len(diffs) == 0:
+            return 60
+        return max(int(np.median(diffs)), 1)
+
+    def take(self, rows : np.ndarray) -> '_SeriesMatrix':
+        '''
+        a matrix of the given rows, the original samples are not copied
+        '''
+        sub = object.__new__(_SeriesMatrix)
+        sub.ids = [self.ids[row] for row in rows]
+        sub.step = self.step
+        sub.grid = self.grid
+        sub.values = self.values[rows]
+        sub.ts, sub.y, sub.cols = self.ts, self.y, self.cols
+        sub.offsets = np.stack([self.offsets[rows], self.offsets[rows + 1]], axis=1)
+        return sub
+
+    def samples(self, row : int) -> slice:
+        if self.offsets.ndim == 2:
+            return slice(self.offsets[row, 0], self.offsets[row, 1])
+        return slice(self.offsets[row], self.offsets[row + 1])
+
+class _SeriesTable():
+    '''
+    fitted parameters of every series of an instance, one row per series
+        params : {name : array of shape (series, ...)}, 2-D parameters of different widths are padded with NaN
+    '''
+
+    def __init__(self, ids : List[str], params : Dict[str, np.ndarray]) -> None:
+        self.ids = ids
+        self.params = params
+        self.index : Dict[str, int] = {series_id: row for row, series_id in enumerate(ids)}
+
+    def rows(self, ids : List[str]) -> np.ndarray:
+        '''
+        row of each series id, -1 if the series was never fitted
+        '''
+        return np.fromiter((self.index.get(series_id, -1) for series_id in ids), dtype=np.int64, count=len(ids))
+
+    def take(self, rows : np.ndarray) -> Dict[str, np.ndarray]:
+        return {name: values[rows] for name, values in self.params.items()}
+
+    def merge(self, newer : '_SeriesTable') -> '_SeriesTable':
+        '''
+        rows of 'newer' replace the rows of the same series, the other rows are kept
+        '''
+        if len(newer.ids) == 0:
+            return self
+        if len(self.ids) == 0:
+            return newer
+        kept = np.fromiter((row for row, series_id in enumerate(self.ids) if series_id not in newer.index), dtype=np.int64)
+        if len(kept) == 0:
+            return newer
+        params = {}
+        for name, values in newer.params.items():
+            older = self.params[name][kept]
+            if values.ndim == 2 and older.shape[1] != values.shape[1]:
+                width = max(older.shape[1], values.shape[1])
+                older = np.pad(older, ((0, 0), (0, width - older.shape[1])), constant_values=np.nan)
+                values = np.pad(values, ((0, 0), (0, width - values.shape[1])), constant_values=np.nan)
+            params[name] = np.concatenate([values, older])
+        return _SeriesTable(newer.ids + [self.ids[row] for row in kept], params)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in self.params.values())
+
+class _VectorizedModel(_interface.BaseModel):
+    '''
+    base of the models fitted and inferred on a (series x time) matrix at once,
+    an instance only keeps a few arrays of parameters whatever the number of series
+        chunk_size : number of series processed at a time, bounds the temporaries of fit and infer
+        max_series_failures : a series failing this many fits (or infers) in a row is skipped until its values change,
+                              a chunk which raises is retried one series at a time so that the other series go on
+    '''
+
+    name = "VectorizedModel"
+
+    def __init__(self, chunk_size : int = 16384, max_series_failures : int = 3) -> None:
+        if chunk_size <= 0:
+            raise ValueError("[CONFIG](%s) 'chunk_size' is invalid" % self.name)
+        if max_series_failures <= 0:
+            raise ValueError("[CONFIG](%s) 'max_series_failures' is invalid" % self.name)
+        self.chunk_size = chunk_size
+        self.quarantine = _interface.SeriesQuarantine(self.name, max_series_failures)
+        self.lock = threading.Lock()
+        # {instance_id : fitted series}
+        self.instances : Dict[str, _SeriesTable] = {}
+        # {instance_id : parsed args}
+        self.instances_args : Dict[str, Dict[str,Any]] = {}
+        # {instance_id : args as given, for checkpoint validation}
+        self.instances_raw_args : Dict[str, Dict[str,Any]] = {}
+
+    @abstractmethod
+    def parse_args(self, args : Dict[str,Any]) -> Dict[str,Any]:
+        '''
+        fill the defaults of the instance args, raise ValueError if invalid
+        '''
+        return None
+
+    @abstractmethod
+    def fit_matrix(self, args : Dict[str,Any], matrix : _SeriesMatrix) -> Tuple[np.ndarray, Dict[str,np.ndarray]]:
+        '''
+        return: (mask of the series which could be fitted, {param name : array of shape (fitted series, ...)})
+        '''
+        return None
+
+    @abstractmethod
+    def infer_matrix(self, args : Dict[str,Any], params : Dict[str,np.ndarray],
+                     matrix : _SeriesMatrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        return: yhat, yhat_lower, yhat_upper of shape (series x time) on the grid of the matrix
+        '''
+        return None
+
+    def check_args(self, args : dict[str,Any]) -> bool:
+        try:
+            self.parse_args(args if args is not None else {})
+        except Exception as e:
+            return False
+        return True
+
+    def create_instance(self, args : dict[str,Any]) -> str:
+        instance_id = uuid.uuid4()
+        args = args if args is not None else {}
+        self.instances_args[instance_id] = self.parse_args(args)
+        self.instances_raw_args[instance_id] = args
+        self.instances[instance_id] = _SeriesTable([], {})
+        return instance_id
+
+    def remove_instance(self, instance_id : str) -> bool:
+        with self.lock:
+            self.instances.pop(instance_id, None)
+            self.instances_args.pop(instance_id, None)
+            self.instances_raw_args.pop(instance_id, None)
+        self.quarantine.remove_instance(instance_id)
+        return True
+
+    def failed_series(self, instance : str, series_ids : Iterable[str]) -> Set[str]:
+        return self.quarantine.failing('fit', instance, series_ids)
+
+    def fit(self, instance : str, y : Dict[str, pd.DataFrame]) -> bool:
+        if instance not in self.instances:
+            return False
+        args = self.instances_args[instance]
+        fitted, failed = 0, 0
+        for ids, ts_list, value_list in self.__admitted('fit', instance, y):
+            for start in range(0, len(ids), self.chunk_size):
+                end = start + self.chunk_size
+                def fit_chunk(matrix : _SeriesMatrix) -> _SeriesTable:
+                    with warnings.catch_warnings():
+                        # all-NaN series are expected, they are dropped by the mask
+                        warnings.simplefilter("ignore", RuntimeWarning)
+                        mask, params = self.fit_matrix(args, matrix)
+                    return _SeriesTable([series_id for series_id, ok in zip(matrix.ids, mask) if ok], params)
+                tables, chunk_failed = self.__isolated('fit', instance, ids[start:end], ts_list[start:end], value_list[start:end], fit_chunk)
+                failed += chunk_failed
+                for table in tables:
+                    with self.lock:
+                        if instance not in self.instances:
+                            return False
+                        self.instances[instance] = self.instances[instance].merge(table)
+                    fitted += len(table.ids)
+        if failed > 0:
+            logger.warning("[%s](Fit) %d series fitted, %d failed", self.name, fitted, failed)
+            return fitted > 0
+        logger.info("[%s](Fit) %d series fitted", self.name, fitted)
+        return True
+
+    def infer(self, instance : str, y : Dict[str, pd.DataFrame]) -> Dict[str, _interface.InferResult]:
+        if instance not in self.instances:
+            return None
+        table = self.instances[instance]
+        if len(table.ids) == 0:
+            return None
+        args = self.instances_args[instance]
+        result_map : Dict[str, _interface.InferResult] = {}
+        for ids, ts_list, value_list in self.__admitted('infer', instance, y):
+            for start in range(0, len(ids), self.chunk_size):
+                end = start + self.chunk_size
+                def infer_chunk(matrix : _SeriesMatrix) -> Dict[str, _interface.InferResult]:
+                    chunk_results = {}
+                    rows = table.rows(matrix.ids)
+                    known = np.flatnonzero(rows >= 0)
+                    if len(known) == 0:
+                        return chunk_results
+                    matrix = matrix.take(known)
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore", RuntimeWarning)
+                        yhat, yhat_lower, yhat_upper = self.infer_matrix(args, table.take(rows[known]), matrix)
+                    self.__collect(matrix, yhat, yhat_lower, yhat_upper, chunk_results)
+                    return chunk_results
+                chunk_results, _ = self.__isolated('infer', instance, ids[start:end], ts_list[start:end], value_list[start:end], infer_chunk)
+                for results in chunk_results:
+                    result_map.update(results)
+        return result_map
+
+    def __admitted(self, kind : str, instance : str,
+                   y : Dict[str, pd.DataFrame]) -> Iterator[Tuple[List[str], List[np.ndarray], List[np.ndarray]]]:
+        '''
+        _series_arrays without the quarantined series
+        '''
+        for ids, ts_list, value_list in _series_arrays(y):
+            kept = [i for i, series_id in enumerate(ids) if not self.quarantine.skipped(kind, instance, series_id, value_list[i])]
+            if len(kept) == len(ids):
+                yield ids, ts_list, value_list
+            elif len(kept) > 0:
+                yield [ids[i] for i in kept], [ts_list[i] for i in kept], [value_list[i] for i in kept]
+
+    def __isolated(self, kind : str, instance : str, ids : List[str], ts_list : List[np.ndarray], value_list : List[np.ndarray],
+                   run : Callable[[_SeriesMatrix], Any]) -> Tuple[List[Any], int]:
+        '''
+        run(matrix) on the series, if it raises the series are run one at a time and the failing ones are quarantined
+        return: ([results of the matrices which did not raise], number of failed series)
+        '''
+        try:
+            result = run(_SeriesMatrix(ids, ts_list, value_list))
+        except Exception as e:
+            if len(ids) == 1:
+                self.quarantine.failed(kind, instance, ids[0], value_list[0], e)
+                return [], 1
+            logger.warning("[%s](%s) %d series failed together, retried one at a time : %s", self.name, kind.capitalize(), len(ids), e)
+            results, failed = [], 0
+            for i in range(len(ids)):
+                result, series_failed = self.__isolated(kind, instance, ids[i:i + 1], ts_list[i:i + 1], value_list[i:i + 1], run)
+                results.extend(result)
+                failed += series_failed
+            return results, failed
+        self.quarantine.succeeded(kind, instance, *ids)
+        return [result], 0
+
+    def __collect(self, matrix : _SeriesMatrix, yhat : np.ndarray, yhat_lower : np.ndarray, yhat_upper : np.ndarray,
+                  result_map : Dict[str, _interface.InferResult]) -> None:
+        # back from the grid to the original samples of each series
+        ds = (matrix.ts * 1000000000).view('datetime64[ns]')
+        for row, series_id in enumerate(matrix.ids):
+            samples = matrix.samples(row)
+            cols = matrix.cols[samples]
+            y = matrix.y[samples]
+            series_yhat, series_lower, series_upper = yhat[row, cols], yhat_lower[row, cols], yhat_upper[row, cols]
+            score = 2*(y-series_yhat)/(series_upper-series_lower)
+            result_map[series_id] = _interface.InferResult(series_id, ds[samples], y, series_yhat,
+                                                           series_lower, series_upper, score, None)
+
+    def memory_usage(self) -> Dict[str, int]:
+        '''
+        {'series', 'bytes'} of the fitted parameters of every instance
+        '''
+        tables = list(self.instances.values())
+        return {"series": sum(len(table.ids) for table in tables), "bytes": sum(table.nbytes for table in tables)}
+
+    def save_checkpoint(self, instance : str, path : str) -> bool:
+        '''
+        npz archive of the parameter arrays, with a header {version, model, args_hash, series}
+        '''
+        if instance not in self.instances or instance not in self.instances_raw_args:
+            return False
+        table = self.instances[instance]
+        header = {"version": CHECKPOINT_VERSION, "model": self.name,
+                  "args_hash": common.map_hash(self.instances_raw_args[instance]), "series": len(table.ids)}
+        arrays = {"param_" + name: values for name, values in table.params.items()}
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, header=np.array(json.dumps(header)), ids=np.array(table.ids, dtype=str), **arrays)
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            logger.error("[%s](Checkpoint) saving error : path = %s, %s", self.name, path, e)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def load_checkpoint(self, instance : str, path : str) -> bool:
+        if instance not in self.instances_raw_args:
+            return False
+        try:
+            with np.load(path, allow_pickle=False) as archive:
+                header = json.loads(str(archive["header"]))
+                if header.get("version") != CHECKPOINT_VERSION or header.get("model") != self.name:
+                    logger.info("[%s](Checkpoint) version or model mismatch, ignored : path = %s", self.name, path)
+                    return False
+                if header.get("args_hash") != common.map_hash(self.instances_raw_args[instance]):
+                    logger.info("[%s](Checkpoint) instance args changed, ignored : path = %s", self.name, path)
+                    return False
+                params = {name[len("param_"):]: archive[name] for name in archive.files if name.startswith("param_")}
+                ids = archive["ids"].tolist()
+        except Exception as e:
+            logger.warning("[%s](Checkpoint) unreadable checkpoint : path = %s, %s", self.name, path, e)
+            return False
+        with self.lock:
+            if instance not in self.instances:
+                return False
+            # series fitted since the instance was created are newer
+            self.instances[instance] = _SeriesTable(ids, params).merge(self.instances[instance])
+        logger.info("[%s](Checkpoint) %d series loaded : path = %s", self.name, len(ids), path)
+        return True
+
+def _window_columns(window : str, step : int, width : int) -> int:
+    if window is None:
+        return width
+    return min(max(common.parse_time_range_str(window) // step, 2), width)
+
+def _scale_floor(center : np.ndarray) -> np.ndarray:
+    # constant series would get a zero-width band and infinite scores
+    return 1e-6 * np.maximum(np.abs(center), 1.0)
+
+class ZScoreModel(_VectorizedModel):
+    '''
+    band of 'threshold' deviations around the center of the last 'window' of the fit data
+    instance args:
+        method : 'mad' (median, 1.4826 * median absolute deviation) or 'std' (mean, standard deviation)
+        window : trailing part of the fit window used for the statistics, None for all of it
+        threshold : half width of the band, in deviations
+    '''
+
+    name = "ZScoreModel"
+
+    def parse_args(self, args : Dict[str,Any]) -> Dict[str,Any]:
+        parsed = {"method": args.get("method", "mad"), "window": args.get("window"),
+                  "threshold": float(args.get("threshold", 3.0))}
+        if parsed["method"] not in ("mad", "std"):
+            raise ValueError("'method' is invalid")
+        if parsed["window"] is not None and not common.check_time_range_str(parsed["window"]):
+            raise ValueError("'window' is invalid")
+        if parsed["threshold"] <= 0:
+            raise ValueError("'threshold' is invalid")
+        return parsed
+
+    def fit_matrix(self, args : Dict[str,Any], matrix : _SeriesMatrix) -> Tuple[np.ndarray, Dict[str,np.ndarray]]:
+        values = matrix.values[:, -_window_columns(args["window"], matrix.step, matrix.values.shape[1]):]
+        if args["method"] == "mad":
+            center = np.nanmedian(values, axis=1)
+            scale = 1.4826 * np.nanmedian(np.abs(values - center[:, None]), axis=1)
+        else:
+            center = np.nanmean(values, axis=1)
+            scale = np.nanstd(values, axis=1)
+        mask = np.count_nonzero(~np.isnan(values), axis=1) >= 2
+        scale = np.maximum(scale, _scale_floor(center))
+        return mask, {"center": center[mask], "scale": scale[mask]}
+
+    def infer_matrix(self, args : Dict[str,Any], params : Dict[str,np.ndarray],
+                     matrix : _SeriesMatrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        shape = matrix.values.shape
+        center = params["center"][:, None]
+        half = args["threshold"] * params["scale"][:, None]
+        return np.broadcast_to(center, shape), np.broadcast_to(center - half, shape), np.broadcast_to(center + half, shape)
+
+class HoltWintersModel(_VectorizedModel):
+    '''
+    additive exponential smoothing, one step ahead forecasts with a band of 'threshold' residual deviations
+    instance args:
+        alpha : level smoothing, a plain EWMA when neither 'beta' nor 'season' is set
+        beta : trend smoothing, None for no trend
+        gamma : seasonal smoothing
+        season : season length (e.g. '1d'), None for no seasonality
+        threshold : half width of the band, in deviations of the one step ahead residuals of the fit
+    The seasonal profile is only updated by fits, infer updates level and trend on a copy of the state.
+    '''
+
+    name = "HoltWintersModel"
+
+    def parse_args(self, args : Dict[str,Any]) -> Dict[str,Any]:
+        parsed = {"alpha": float(args.get("alpha", 0.3)), "beta": args.get("beta"),
+                  "gamma": float(args.get("gamma", 0.1)), "season": args.get("season"),
+                  "threshold": float(args.get("threshold", 3.0))}
+        if parsed["beta"] is not None:
+            parsed["beta"] = float(parsed["beta"])
+            if not 0 < parsed["beta"] <= 1:
+                raise ValueError("'beta' is invalid")
+        if not 0 < parsed["alpha"] <= 1 or not 0 < parsed["gamma"] <= 1:
+            raise ValueError("'alpha' or 'gamma' is invalid")
+        if parsed["season"] is not None and not common.check_time_range_str(parsed["season"]):
+            raise ValueError("'season' is invalid")
+        if parsed["threshold"] <= 0:
+            raise ValueError("'threshold' is invalid")
+        return parsed
+
+    def __season_length(self, args : Dict[str,Any], matrix : _SeriesMatrix) -> int:
+        if args["season"] is None:
+            return 0
+        length = common.parse_time_range_str(args["season"]) // matrix.step
+        # like prophet, a seasonality needs two full seasons of history, else the profile just memorizes the data
+        if length < 2 or len(matrix.grid) < 2 * length:
+            return 0
+        return length
+
+    def fit_matrix(self, args : Dict[str,Any], matrix : _SeriesMatrix) -> Tuple[np.ndarray, Dict[str,np.ndarray]]:
+        values = matrix.values
+        n, width = values.shape
+        alpha, beta, gamma = args["alpha"], args["beta"], args["gamma"]
+        season_len = self.__season_length(args, matrix)
+        phases = (matrix.grid // matrix.step) % season_len if season_len > 0 else None
+        observed = ~np.isnan(values)
+        mean = np.nanmean(values, axis=1)
+        season = np.zeros((n, max(season_len, 1)))
+        if season_len > 0:
+            # initial profile : mean deviation from the series mean of each phase
+            onehot = np.zeros((width, season_len))
+            onehot[np.arange(width), phases] = 1.0
+            sums = np.where(observed, values - mean[:, None], 0.0) @ onehot
+            counts = observed.astype(np.float64) @ onehot
+            season = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+        first = np.argmax(observed, axis=1)
+        level = values[np.arange(n), first] - (season[np.arange(n), phases[first]] if season_len > 0 else 0.0)
+        level = np.where(np.isnan(level), 0.0, level)
+        trend = np.zeros(n)
+        residuals = np.full((n, width), np.nan)
+        rows = np.arange(n)
+        for col in range(width):
+            x = values[:, col]
+            ok = observed[:, col]
+            s = season[:, phases[col]] if season_len > 0 else 0.0
+            forecast = level + trend
+            residuals[:, col] = x - (forecast + s)
+            new_level = np.where(ok, alpha * (x - s) + (1 - alpha) * forecast, forecast)
+            if beta is not None:
+                trend = np.where(ok, beta * (new_level - level) + (1 - beta) * trend, trend)
+            if season_len > 0:
+                season[rows, phases[col]] = np.where(ok, gamma * (x - new_level) + (1 - gamma) * s, s)
+            level = new_level
+        # the first forecasts only reflect the initial state
+        warmup = min(width // 4, 10)
+        sigma = np.nanstd(residuals[:, warmup:], axis=1)
+        mask = np.count_nonzero(observed, axis=1) >= 2
+        sigma = np.maximum(np.where(np.isnan(sigma), 0.0, sigma), _scale_floor(mean))
+        # seasonal profiles dominate the memory of an instance, they are kept in float32
+        return mask, {"level": level[mask], "trend": trend[mask], "sigma": sigma[mask],
+                      "season": season[mask].astype(np.float32),
+                      "season_len": np.full(int(mask.sum()), season_len, dtype=np.int64),
+                      "step": np.full(int(mask.sum()), matrix.step, dtype=np.int64),
+                      "last_t": np.full(int(mask.sum()), matrix.grid[-1], dtype=np.int64)}
+
+    def infer_matrix(self, args : Dict[str,Any], params : Dict[str,np.ndarray],
+                     matrix : _SeriesMatrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        values = matrix.values
+        n, width = values.shape
+        alpha, beta = args["alpha"], args["beta"]
+        step = params["step"]
+        season_len = params["season_len"]
+        seasonal = season_len > 0
+        season = params["season"]
+        # phase of each column in the season of each series
+        phases = (matrix.grid[None, :] // step[:, None]) % np.maximum(season_len, 1)[:, None]
+        seasonals = np.where(seasonal[:, None], np.take_along_axis(season, np.minimum(phases, season.shape[1] - 1), axis=1), 0.0)
+        seasonals = np.where(np.isnan(seasonals), 0.0, seasonals)
+        # forecast over the gap between the end of the fit data and the first column
+        gap = np.maximum((matrix.grid[0] - params["last_t"]) // step - 1, 0)
+        level = params["level"] + gap * params["trend"]
+        trend = params["trend"].copy()
+        yhat = np.empty((n, width))
+        for col in range(width):
+            x = values[:, col]
+            ok = ~np.isnan(x)
+            s = seasonals[:, col]
+            forecast = level + trend
+            yhat[:, col] = forecast + s
+            new_level = np.where(ok, alpha * (x - s) + (1 - alpha) * forecast, forecast)
+            if beta is not None:
+                trend = np.where(ok, beta * (new_level - level) + (1 - beta) * trend, trend)
+            level = new_level
+        half = args["threshold"] * params["sigma"][:, None]
+        return yhat, yhat - half, yhat + half
+
+def _nanquantile_rows(values : np.ndarray, levels : List[float]) -> np.ndarray:
+    '''
+    linear interpolated quantiles of each row ignoring NaN, same as np.nanquantile(values, levels, axis=1)
+    which loops over the rows in python
+    return: (levels x rows), NaN for rows without samples
+    '''
+    ordered = np.sort(values, axis=1)
+    counts = np.count_nonzero(~np.isnan(values), axis=1)
+    result = np.full((len(levels), values.shape[0]), np.nan)
+    if values.shape[1] == 0:
+        return result
+    last = np.maximum(counts - 1, 0)
+    for pos, level in enumerate(levels):
+        rank = level * last
+        lo = np.floor(rank).astype(np.int64)
+        hi = np.minimum(lo + 1, last)
+        low_values = np.take_along_axis(ordered, lo[:, None], axis=1)[:, 0]
+        high_values = np.take_along_axis(ordered, hi[:, None], axis=1)[:, 0]
+        result[pos] = np.where(counts > 0, low_values + (rank - lo) * (high_values - low_values), np.nan)
+    return result
+
+class SeasonalQuantileModel(_VectorizedModel):
+    '''
+    quantiles of the fit data in each bucket of the season, e.g. each hour of the day
+    instance args:
+        season : season length, default '1d'
+        buckets : number of buckets in a season
+        interval_width : probability mass between the lower and upper quantiles
+    Buckets without samples fall back to the quantiles of the whole series.
+    '''
+
+    name = "SeasonalQuantileModel"
+
+    def parse_args(self, args : Dict[str,Any]) -> Dict[str,Any]:
+        parsed = {"season": args.get("season", "1d"), "buckets": int(args.get("buckets", 24)),
+                  "interval_width": float(args.get("interval_width", 0.98))}
+        if not common.check_time_range_str(parsed["season"]):
+            raise ValueError("'season' is invalid")
+        if parsed["buckets"] <= 0:
+            raise ValueError("'buckets' is invalid")
+        if not 0 < parsed["interval_width"] < 1:
+            raise ValueError("'interval_width' is invalid")
+        return parsed
+
+    def __buckets(self, args : Dict[str,Any], grid : np.ndarray) -> np.ndarray:
+        season = common.parse_time_range_str(args["season"])
+        return (grid % season) * args["buckets"] // season
+
+    def fit_matrix(self, args : Dict[str,Any], matrix : _SeriesMatrix) -> Tuple[np.ndarray, Dict[str,np.ndarray]]:
+        values = matrix.values
+        tail = (1 - args["interval_width"]) / 2
+        levels = [tail, 0.5, 1 - tail]
+        overall = _nanquantile_rows(values, levels)
+        profile = np.empty((3, values.shape[0], args["buckets"]))
+        buckets = self.__buckets(args, matrix.grid)
+        for bucket in range(args["buckets"]):
+            cols = buckets == bucket
+            if not cols.any():
+                profile[:, :, bucket] = overall
+                continue
+            quantiles = _nanquantile_rows(values[:, cols], levels)
+            profile[:, :, bucket] = np.where(np.isnan(quantiles), overall, quantiles)
+        lower, median, upper = profile
+        floor = _scale_floor(median)
+        lower = np.minimum(lower, median - floor)
+        upper = np.maximum(upper, median + floor)
+        mask = np.count_nonzero(~np.isnan(values), axis=1) >= 2
+        return mask, {"lower": lower[mask].astype(np.float32), "median": median[mask].astype(np.float32),
+                      "upper": upper[mask].astype(np.float32)}
+
+    def infer_matrix(self, args : Dict[str,Any], params : Dict[str,np.ndarray],
+                     matrix : _SeriesMatrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        buckets = self.__buckets(args, matrix.grid)
+        return (params["median"][:, buckets].astype(np.float64), params["lower"][:, buckets].astype(np.float64),
+                params["upper"][:, buckets].astype(np.float64))
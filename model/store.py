@@ -0,0 +1,129 @@
+import sys
+import os
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, BinaryIO, Callable, Dict
+
+sys.path.append("..")
+import common
+
+logger = logging.getLogger(__name__)
+
+class InstanceStore():
+    '''
+    Fitted series of the instances of a model, one payload per instance
+        a payload exposes 'nbytes', 'series' (number of series) and 'dump(file)', 'loader(file)' reads it back
+        max_bytes : once the payloads exceed it, the least recently used ones are spilled to disk
+                    and loaded back on their next access, <= 0 means no limit
+    Payloads are replaced, never mutated, so a reader keeps a consistent snapshot while a fit is stored.
+    '''
+
+    def __init__(self, name : str, loader : Callable[[BinaryIO], Any], max_bytes : int = 0) -> None:
+        self.name = name
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        # {instance_id : payload}, least recently used first
+        self.payloads : OrderedDict[str, Any] = OrderedDict()
+        self.payload_bytes : Dict[str, int] = {}
+        # {instance_id : spill file path}
+        self.spilled : Dict[str, str] = {}
+        self.nbytes = 0
+        self.spills = 0
+        self.loads = 0
+
+    def __contains__(self, instance : str) -> bool:
+        with self.lock:
+            return instance in self.payloads or instance in self.spilled
+
+    def get(self, instance : str) -> Any:
+        '''
+        return: the payload of the instance, None if unknown
+        '''
+        with self.lock:
+            if instance in self.payloads:
+                self.payloads.move_to_end(instance)
+                return self.payloads[instance]
+            if instance not in self.spilled:
+                return None
+            path = self.spilled.pop(instance)
+            try:
+                with open(path, 'rb') as f:
+                    payload = self.loader(f)
+            except Exception as e:
+                logger.error("[InstanceStore](%s) spilled instance lost : path = %s, %s", self.name, path, e)
+                return None
+            finally:
+                if os.path.isfile(path):
+                    os.remove(path)
+            self.loads += 1
+            self.__put(instance, payload)
+            return payload
+
+    def put(self, instance : str, payload : Any) -> None:
+        with self.lock:
+            self.__put(instance, payload)
+
+    def __put(self, instance : str, payload : Any) -> None:
+        self.nbytes -= self.payload_bytes.pop(instance, 0)
+        self.payloads.pop(instance, None)
+        path = self.spilled.pop(instance, None)
+        if path is not None and os.path.isfile(path):
+            os.remove(path)
+        self.payloads[instance] = payload
+        self.payload_bytes[instance] = payload.nbytes
+        self.nbytes += payload.nbytes
+        self.__spill_cold(instance)
+
+    def __spill_cold(self, keep : str) -> None:
+        if self.max_bytes <= 0:
+            return
+        for instance in list(self.payloads.keys()):
+            if self.nbytes <= self.max_bytes:
+                return
+            if instance == keep:
+                continue
+            payload = self.payloads[instance]
+            path = common.get_spill_path(self.name + "_" + str(instance))
+            try:
+                with open(path + ".tmp", 'wb') as f:
+                    payload.dump(f)
+                os.replace(path + ".tmp", path)
+            except Exception as e:
+                logger.error("[InstanceStore](%s) spilling error, instance kept in memory : %s", self.name, e)
+                continue
+            del self.payloads[instance]
+            self.nbytes -= self.payload_bytes.pop(instance)
+            self.spilled[instance] = path
+            self.spills += 1
+
+    def remove(self, instance : str) -> None:
+        with self.lock:
+            self.payloads.pop(instance, None)
+            self.nbytes -= self.payload_bytes.pop(instance, 0)
+            path = self.spilled.pop(instance, None)
+            if path is not None and os.path.isfile(path):
+                os.remove(path)
+
+    def usage(self) -> Dict[str, Dict[str, Any]]:
+        '''
+        {instance_id : {'bytes', 'series', 'bytes_per_series', 'spilled'}}, spilled instances report 0 bytes
+        '''
+        with self.lock:
+            usage = {}
+            for instance, payload in self.payloads.items():
+                nbytes = self.payload_bytes[instance]
+                usage[str(instance)] = {"bytes": nbytes, "series": payload.series,
+                                        "bytes_per_series": nbytes // payload.series if payload.series > 0 else 0,
+                                        "spilled": False}
+            for instance in self.spilled:
+                usage[str(instance)] = {"bytes": 0, "series": 0, "bytes_per_series": 0, "spilled": True}
+            return usage
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            series = sum(payload.series for payload in self.payloads.values())
+            return {"instances": len(self.payloads), "spilled": len(self.spilled), "bytes": self.nbytes,
+                    "series": series, "bytes_per_series": self.nbytes // series if series > 0 else 0,
+                    "spills": self.spills, "loads": self.loads}
@@ -1,3 +1,4 @@
 from scheduler._interface import Scheduler
 from scheduler.periodic import Periodical
-from scheduler.once import Once
\ No newline at end of file
+from scheduler.once import Once
+from scheduler.streaming import Streaming
\ No newline at end of file
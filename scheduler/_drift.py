@@ -0,0 +1,105 @@
+import threading
+import warnings
+from typing import Any, Dict, Iterable, List, Set
+
+import numpy as np
+
+class DriftTracker():
+    '''
+    Fit quality of the series of a task, measured on the results of its infers since each series was last fitted
+        coverage : share of the samples inside [yhat_lower, yhat_upper]
+        bias : mean anomaly score, a level shift moves it away from 0 while the spikes of a few samples barely do
+    A series is due for a refit once 'min_samples' samples were inferred and its coverage is under 'min_coverage'
+    or its bias is over 'max_bias', when its last fit is 'max_age' seconds old, or when an infer queried it
+    but the model has no fit for it (a new series).
+    '''
+
+    def __init__(self, min_coverage : float, max_bias : float, max_age : int, min_samples : int) -> None:
+        self.min_coverage = min_coverage
+        self.max_bias = max_bias
+        self.max_age = max_age
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        # {series_id : unix time of its last fit}
+        self.fit_t : Dict[str, float] = {}
+        # {series_id : [samples, samples inside the band, sum of the scores]} since its last fit
+        self.residuals : Dict[str, List[float]] = {}
+        self.unfitted : Set[str] = set()
+        # fit time of the series restored from a checkpoint, they are only known once inferred
+        self.restored_t : float = None
+
+    def restored(self, fit_t : float) -> None:
+        with self.lock:
+            self.restored_t = fit_t
+
+    def observe(self, queried : Iterable[str], results : Dict[str, Any], now : float) -> None:
+        '''
+        queried : series of the infer, results : {series_id : InferResult}
+        '''
+        stats = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for sid, result in results.items():
+                y, score = result.data['y'], result.data['anomaly_score']
+                valid = ~np.isnan(score)
+                inside = (y >= result.data['yhat_lower']) & (y <= result.data['yhat_upper'])
+                stats[sid] = (int(np.count_nonzero(valid)), int(np.count_nonzero(inside & valid)), float(np.sum(score[valid])))
+        with self.lock:
+            for sid in queried:
+                if sid not in results:
+                    self.unfitted.add(sid)
+            for sid, (samples, covered, score_sum) in stats.items():
+                if sid not in self.fit_t:
+                    self.fit_t[sid] = self.restored_t if self.restored_t is not None else now
+                self.unfitted.discard(sid)
+                acc = self.residuals.setdefault(sid, [0, 0, 0.0])
+                acc[0] += samples
+                acc[1] += covered
+                acc[2] += score_sum
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.fit_t)
+
+    def known(self, series_id : str) -> bool:
+        '''
+        True once the series was fitted by the task
+        '''
+        with self.lock:
+            return series_id in self.fit_t
+
+    def due(self, now : float) -> Set[str]:
+        '''
+        return: the series to refit, None while the task was never fitted (every series is due)
+        '''
+        with self.lock:
+            if len(self.fit_t) == 0 and self.restored_t is None:
+                return None
+            due = set(self.unfitted)
+            for sid, fit_t in self.fit_t.items():
+                if now - fit_t >= self.max_age:
+                    due.add(sid)
+                    continue
+                acc = self.residuals.get(sid)
+                if acc is None or acc[0] < self.min_samples:
+                    continue
+                if acc[1] / acc[0] < self.min_coverage or abs(acc[2] / acc[0]) > self.max_bias:
+                    due.add(sid)
+            return due
+
+    def fitted(self, series_ids : Iterable[str], now : float) -> None:
+        with self.lock:
+            for sid in series_ids:
+                self.fit_t[sid] = now
+                self.residuals.pop(sid, None)
+                self.unfitted.discard(sid)
+
+    def forget(self, series_ids : Iterable[str]) -> None:
+        '''
+        drop series which are no longer returned by the queries
+        '''
+        with self.lock:
+            for sid in series_ids:
+                self.fit_t.pop(sid, None)
+                self.residuals.pop(sid, None)
+                self.unfitted.discard(sid)
@@ -61,6 +61,17 @@ class ScheduledTask():
         self.query = query
         self.args = args
         self.next_trigger_t = next_trigger_t
+        # set by the scheduler when the task is stopped, stale timers of a cancelled task are dropped lazily
+        self.cancelled = False
+        # at most one run of a task is in flight, an overrun may ask for one more run after it
+        self.running = False
+        self.pending = False
+        # fit quality of the series, set for the tasks refitted on drift (scheduler._drift.DriftTracker)
+        self.drift = None
+        # set when series moved between the nodes of a cluster sharded by series, the next fit runs even if no series is due
+        self.rebalanced = False
+        # checkpoint restored by the first run of the task, see Periodical._restore_checkpoint
+        self.checkpoint = None
 
     def __gt__(self, other):
         return self.next_trigger_t > other.next_trigger_t
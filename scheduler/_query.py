@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+from connector import *
+from connector.store import SeriesStore
+import scheduler._interface as _interface
+
+sys.path.append('..')
+import common
+
+logger = logging.getLogger(__name__)
+
+# (query_name, {'series_id': dataframe}, {'series_id': labels}), maps are None if nothing returned
+QueryResult = Tuple[str, Dict[str, Any], Dict[str, Dict[str, str]]]
+
+def query_args(sch_task : _interface.ScheduledTask, kind : str) -> List[Tuple[str, str, str, str]]:
+    '''
+    kind : 'fit' | 'infer'
+    return: [(query_name, queries, sampling_period, query_length)] of every query of the task
+    '''
+    args = []
+    for query_name, query_args_raw in sch_task.query.items():
+        query_len = sch_task.args[kind + '_window']
+        if 'sampling_period_' + kind in query_args_raw:
+            sampling_period = query_args_raw['sampling_period_' + kind]
+        elif kind == 'fit':
+            sampling_period = common.default_time_window(query_len, 250)
+        else:
+            sampling_period = sch_task.args['infer_every']
+        args.append((query_name, query_args_raw['queries'], sampling_period, query_len))
+    return args
+
+class QueryFanout():
+    '''
+    Event loop owned by a scheduler, every query of a task is sent at once and the queries of
+    tasks running on different workers share the loop, so a run waits for its slowest query only.
+        io_workers : threads running the blocking part of the connectors
+        coalesce_window : a result is shared with the identical queries (reader, tenant, queries, step, window)
+                          asked while it is in flight or up to this delay after it returned, '0s' only shares in flight queries
+        store : fit queries of the readers which have a 'query_range' are served by this store, None to query every window
+    The number of queries in flight on a connector is limited by its 'query_concurrency'.
+    '''
+
+    def __init__(self, name : str, io_workers : int = 32, coalesce_window : str = "1s", store : SeriesStore = None) -> None:
+        if io_workers <= 0:
+            raise ValueError("[CONFIG](QueryFanout) 'io_workers' is invalid")
+        if not common.check_time_range_str(coalesce_window):
+            raise ValueError("[CONFIG](QueryFanout) 'coalesce_window' is invalid")
+        self.coalesce_sec = common.parse_time_range_str(coalesce_window)
+        self.store = store
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix=name + "-io"))
+        # connector -> semaphore, only used from the loop thread
+        self.limits : Dict[Connector, asyncio.Semaphore] = {}
+        # query key -> future of the query in flight, and (loop time, result) of the queries which just returned,
+        # only used from the loop thread
+        self.in_flight : Dict[Tuple, asyncio.Future] = {}
+        self.recent : Dict[Tuple, Tuple[float, QueryResult]] = {}
+        self.stats_lock = threading.Lock()
+        self.stats = {"queries": 0, "in_flight": 0, "max_in_flight": 0, "failed": 0, "coalesced": 0}
+        threading.Thread(target=self.loop.run_forever, name=name + "-io-loop", daemon=True).start()
+
+    def query(self, sch_task : _interface.ScheduledTask, kind : str) -> List[QueryResult]:
+        '''
+        run every query of the task concurrently, blocks the calling worker until all of them returned
+        return: results in the order of sch_task.query, the first error is raised once every query is done
+        '''
+        future = asyncio.run_coroutine_threadsafe(self.__query_task(sch_task, kind), self.loop)
+        return future.result()
+
+    async def __query_task(self, sch_task : _interface.ScheduledTask, kind : str) -> List[QueryResult]:
+        args = query_args(sch_task, kind)
+        results = await asyncio.gather(*[self.__query_one(sch_task.reader, sch_task.tenant, kind, *arg) for arg in args],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def __query_one(self, reader : Connector, tenant : str, kind : str, query_name : str, queries : str,
+                          sampling_period : str, query_len : str) -> QueryResult:
+        stored = kind == 'fit' and self.store is not None and hasattr(reader, 'query_range')
+        key = (reader, tenant, queries, sampling_period, query_len, stored)
+        recent = self.recent.get(key)
+        shared = None
+        if recent is not None and self.loop.time() - recent[0] <= self.coalesce_sec:
+            shared = self.__share(recent[1], query_name)
+        elif key in self.in_flight:
+            # an error of the query is raised to every task waiting for it
+            shared = self.__share(await asyncio.shield(self.in_flight[key]), query_name)
+        if shared is not None:
+            with self.stats_lock:
+                self.stats["coalesced"] += 1
+            return shared
+        future = self.loop.create_future()
+        self.in_flight[key] = future
+        try:
+            result = await self.__fetch(reader, tenant, query_name, queries, sampling_period, query_len, stored)
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved, nobody may be waiting for it
+            future.exception()
+            raise
+        finally:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+        future.set_result(result)
+        if self.coalesce_sec > 0:
+            self.recent[key] = (self.loop.time(), result)
+            self.loop.call_later(self.coalesce_sec, self.__forget, key, result)
+        return result
+
+    def __forget(self, key : Tuple, result : QueryResult) -> None:
+        recent = self.recent.get(key)
+        if recent is not None and recent[1] is result:
+            del self.recent[key]
+
+    @staticmethod
+    def __share(result : QueryResult, query_name : str) -> QueryResult:
+        '''
+        the result of an identical query for a task naming it 'query_name',
+        None if it can't be shared (series ids of another query name which can't be rebuilt)
+        '''
+        source_name, y_map, _ = result
+        if source_name == query_name:
+            return result
+        if y_map is None:
+            return query_name, None, None
+        if isinstance(y_map, SeriesBlock):
+            block = y_map.renamed(query_name)
+            return query_name, block, block.labels
+        return None
+
+    async def __fetch(self, reader : Connector, tenant : str, query_name : str, queries : str,
+                      sampling_period : str, query_len : str, stored : bool) -> QueryResult:
+        limit = self.limits.get(reader)
+        if limit is None:
+            limit = asyncio.Semaphore(max(getattr(reader, 'query_concurrency', 1), 1))
+            self.limits[reader] = limit
+        async with limit:
+            with self.stats_lock:
+                self.stats["queries"] += 1
+                self.stats["in_flight"] += 1
+                self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+            try:
+                if stored:
+                    y_map = await self.loop.run_in_executor(None, self.__query_store, reader, tenant, query_name,
+                                                            queries, sampling_period, query_len)
+                    y_label_map = y_map.labels if y_map is not None else None
+                else:
+                    y_map, y_label_map = await reader.query_series_async(tenant, query_name, queries, sampling_period, query_len)
+            except Exception as e:
+                with self.stats_lock:
+                    self.stats["failed"] += 1
+                logger.error("[Scheduler](QueryFanout) query: %s, error occurred, %s", query_name, e)
+                raise
+            finally:
+                with self.stats_lock:
+                    self.stats["in_flight"] -= 1
+        return query_name, y_map, y_label_map
+
+    def __query_store(self, reader : Connector, tenant : str, query_name : str, queries : str,
+                      sampling_period : str, query_len : str) -> SeriesBlock:
+        if not (common.check_time_range_str(sampling_period) and common.check_time_range_str(query_len)):
+            raise ValueError("[Scheduler](QueryFanout) 'sampling_period' or 'query_length' is invalid: {}, {}".format(sampling_period, query_len))
+        step = common.parse_time_range_str(sampling_period)
+        fetch = lambda start, end: reader.query_range(tenant, query_name, queries, str(step) + "s", start, end)
+        return self.store.query((tenant, query_name, queries, step), common.parse_time_range_str(query_len), time.time(), fetch)
+
+    def query_stats(self) -> Dict[str, int]:
+        '''
+        {'queries', 'in_flight', 'max_in_flight', 'failed', 'coalesced'}, 'coalesced' counts the queries served by another one
+        '''
+        with self.stats_lock:
+            return dict(self.stats)
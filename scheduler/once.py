@@ -1,10 +1,15 @@
 import logging
 import sys
 import scheduler._interface as _interface
+from scheduler._query import QueryFanout
 import time
-import copy
+import uuid
+import json
+import threading
+from collections import ChainMap, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from typing import Any, List, Dict
+from typing import Any, Callable, Iterator, List, Dict, Tuple
 from connector import *
 from model import *
 
@@ -16,37 +21,99 @@ import common
 
 logger = logging.getLogger(__name__)
 
+class _ReleasingIterator():
+    '''
+    iterator calling 'release' once it is exhausted or closed, even if it was never iterated (a response closed by the server)
+    '''
+
+    def __init__(self, iterator : Iterator[str], release : Callable[[], None]) -> None:
+        self.iterator = iterator
+        self.release = release
+        self.released = False
+        self.lock = threading.Lock()
+
+    def __iter__(self) -> '_ReleasingIterator':
+        return self
+
+    def __next__(self) -> str:
+        try:
+            return next(self.iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.iterator.close()
+        self.release()
+
 class Once(_interface.Scheduler):
 
-    def __init__(self):
+    def __init__(self, io_workers : int = 8, workers : int = 2, queue_size : int = 100, job_ttl : str = "10m",
+                 cache_ttl : str = "1m", infer_batch : int = 256, coalesce_window : str = "1s",
+                 max_result_mb : float = 256, max_streams : int = 4):
+        '''
+        workers : threads running the submitted jobs, out of the request threads of the web server
+        queue_size : max jobs waiting for a worker, further jobs are rejected
+        job_ttl : how long the result of a finished job can be read
+        cache_ttl : a job submitted again with the same query, model args and windows within this delay
+                    returns the result of the first one, at most job_ttl
+        infer_batch : series inferred at once, the result of a series can be read as soon as its batch is done
+        coalesce_window : identical queries of concurrent jobs are sent once, see QueryFanout
+        max_result_mb : size of the results kept by the jobs, the oldest finished jobs are dropped above it,
+                        a running job which does not fit fails
+        max_streams : results of running jobs streamed at once, each stream holds a request thread of the web server
+                      until its job is done, the results of a finished job are read without waiting
+        '''
+        if workers <= 0 or queue_size < 0 or infer_batch <= 0:
+            raise ValueError("[CONFIG](Once) 'workers', 'queue_size' or 'infer_batch' is invalid")
+        if max_result_mb <= 0 or max_streams < 0:
+            raise ValueError("[CONFIG](Once) 'max_result_mb' or 'max_streams' is invalid")
+        if not (common.check_time_range_str(job_ttl) and common.check_time_range_str(cache_ttl)):
+            raise ValueError("[CONFIG](Once) 'job_ttl' or 'cache_ttl' is invalid")
         self.anomaly_metrics_prefix = common.output_metrics_prefix
+        self.fanout = QueryFanout("once", io_workers=io_workers, coalesce_window=coalesce_window)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="once")
+        self.pool_slots = threading.BoundedSemaphore(workers + queue_size)
+        self.job_ttl_sec = common.parse_time_range_str(job_ttl)
+        self.cache_ttl_sec = min(common.parse_time_range_str(cache_ttl), self.job_ttl_sec)
+        self.infer_batch = infer_batch
+        self.max_result_bytes = int(max_result_mb * 1024 * 1024)
+        # bytes of the lines of every job
+        self.result_bytes = 0
+        self.stream_slots = threading.BoundedSemaphore(max_streams) if max_streams > 0 else None
+        # {job_id : job}, oldest first, 'lines' holds the serialized record of each series
+        self.jobs : OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        # {job key : job_id}
+        self.job_keys : Dict[str, str] = {}
+        self.jobs_lock = threading.Lock()
+        # notified each time a job gets a record or finishes
+        self.jobs_cond = threading.Condition(self.jobs_lock)
     
     def check_args(self, args : dict[str,str]) -> bool:
         if args['fit_window'] is None or not common.check_time_range_str(args['fit_window']):
             return False
         if args['infer_window'] is None or not common.check_time_range_str(args['infer_window']):
             return False
+        if 'infer_every' not in args or args['infer_every'] is None:
+            args['infer_every'] = args['infer_window']
+        elif not common.check_time_range_str(args['infer_every']):
+            return False
         return True
     
     def __run_fit(self, sch_task : _interface.ScheduledTask) -> bool:
-        y_all : Dict[str, pd.DataFrame] = {}
-        for query_name in sch_task.query.keys():
-            query_args_raw = sch_task.query[query_name]
-            queries = query_args_raw['queries']
-            query_len = sch_task.args['fit_window']
-            sampling_period = None
-            if 'sampling_period_fit' not in query_args_raw:
-                sampling_period = common.default_time_window(query_len, 250)
-            else:
-                sampling_period = query_args_raw['sampling_period_fit']
-            data, _ = sch_task.reader.query_series(sch_task.tenant, query_name, queries, sampling_period, query_len)
+        y_all : ChainMap = ChainMap()
+        for query_name, data, _ in self.fanout.query(sch_task, 'fit'):
             if data is None:
                 logger.warning("[Scheduler](Once) query: %s, return none", query_name)
                 continue
             if data.__len__ == 0:
                 logger.warning("[Scheduler](Once) query: %s, return empty result", query_name)
                 continue
-            y_all.update(data)
+            y_all.maps.insert(0, data)
         if len(y_all) == 0:
             return True
         try:
@@ -58,58 +125,44 @@ class Once(_interface.Scheduler):
             logger.error("[Scheduler](Once) fit: error occurred, %s", e)
             return False
 
-    def __run_infer(self, sch_task : _interface.ScheduledTask) -> Dict:
-        y_all : Dict[str, pd.DataFrame] = {}
-        y_label_all : Dict[str, Dict[str, str]] = {}
-        original = {}
-        for query_name in sch_task.query.keys():
-            query_args_raw = sch_task.query[query_name]
-            queries = query_args_raw['queries']
-            query_len = sch_task.args['infer_window']
-            sampling_period = None
-            if 'sampling_period_infer' not in query_args_raw:
-                sampling_period = sch_task.args['infer_every']
-            else:
-                sampling_period = query_args_raw['sampling_period_infer']
-            y_map, y_label_map = sch_task.reader.query_series(sch_task.tenant, query_name, queries, sampling_period, query_len)
+    def __run_infer(self, sch_task : _interface.ScheduledTask, emit : Callable[[Dict[str, Any]], None]) -> None:
+        '''
+        infer the series batch by batch, emit({'query', 'series_id', 'labels', 'original', 'anomaly'}) is called
+        for each series once its batch is done
+        '''
+        for query_name, y_map, y_label_map in self.fanout.query(sch_task, 'infer'):
             if y_map is None:
                 logger.warning("[Scheduler](Once) query: %s, none returned y", query_name)
                 continue
             if y_map.__len__ == 0:
                 logger.warning("[Scheduler](Once) query: %s, empty returned y", query_name)
                 continue
-            y_all.update(y_map)
-            y_label_all.update(y_label_map)
-            original[query_name] = self.__to_metric_prom(y_all, y_label_all)
-        if len(y_all) == 0:
-            return {}
-        result = {"original": original, "anomaly": {}}
-        try:
-            hat = sch_task.model.infer(sch_task.model_instance, y_all)
-            if hat is None:
-                logger.warning("[Scheduler](Once) query:, %s, model: %s, empty inferer", query_name, sch_task.model.__class__)
-                return result
-            for sid, infer_result in hat.items():
-                metrics = infer_result.to_metrics_prom(self.anomaly_metrics_prefix, y_label_all[sid])
-                result["anomaly"][query_name] = metrics
-            return result
-        except Exception as e:
-            logger.error("[Scheduler](Once) infer: error occurred, %s", e)
-            return result
-        
-    def __to_metric_prom(self, y_all: dict[str, pd.DataFrame], y_label_all: dict[str, Dict[str, str]]) -> Dict:
-        result = {"data": {"result": []}}
-        for sid, y in y_all.items():
-            labels = copy.deepcopy(y_label_all[sid])
-            ts_sec = y['ds'].astype('int64').divide(1e9)
-            value = y['y']
-            to_write = [[k,str(v)] for k,v in zip(ts_sec, value)]
-            result["data"]["result"].append({"metric": labels, "values": to_write})
-        return result
+            series_ids = list(y_map.keys())
+            for pos in range(0, len(series_ids), self.infer_batch):
+                batch = series_ids[pos:pos + self.infer_batch]
+                # a block keeps the vectorized path of the models
+                y_batch = y_map.select(batch) if isinstance(y_map, SeriesBlock) else {sid: y_map[sid] for sid in batch}
+                hat = sch_task.model.infer(sch_task.model_instance, y_batch)
+                if hat is None:
+                    logger.warning("[Scheduler](Once) query:, %s, model: %s, empty inferer", query_name, sch_task.model.__class__)
+                    hat = {}
+                for sid in batch:
+                    labels = y_label_map[sid]
+                    anomaly = hat[sid].to_metrics_prom(self.anomaly_metrics_prefix, labels) if sid in hat else None
+                    emit({"query": query_name, "series_id": sid, "labels": labels,
+                          "original": self.__to_values(y_map[sid]), "anomaly": anomaly})
+
+    def __to_values(self, y : pd.DataFrame) -> List[List[Any]]:
+        ts_sec = (y['ds'].values.view('int64') // 1000000000).tolist()
+        return [[k, str(v)] for k, v in zip(ts_sec, y['y'].tolist())]
         
-    def schedule(self, name : str, tenant : str, reader : Connector, writer : Connector,
-                 model : BaseModel, model_args : Dict[str,Any],
-                 query : dict[str, dict[str, Any]], args : dict[str, str]) -> None:
+    def __run(self, name : str, tenant : str, reader : Connector, writer : Connector,
+              model : BaseModel, model_args : Dict[str,Any],
+              query : dict[str, dict[str, Any]], args : dict[str, str],
+              emit : Callable[[Dict[str, Any]], None]) -> str:
+        '''
+        return: None on success, the reason of the failure otherwise
+        '''
         # create model instance
         model_instance_id = model.create_instance(model_args)
         next_fit_t = time.time()
@@ -117,13 +170,187 @@ class Once(_interface.Scheduler):
         # create task
         fit_task = _interface.ScheduledTask(name, tenant, reader, writer, model, model_instance_id, query, args, next_fit_t)
         infer_task = _interface.ScheduledTask(name, tenant, reader, writer, model, model_instance_id, query, args, next_infer_t)
-        # submit
-        if not self.__run_fit(fit_task):
-            return 'Fitting failed'
-        result =  self.__run_infer(infer_task)
-        common.threadlocal.result = result
-        # delete model instance
-        model.remove_instance(model_instance_id)
+        try:
+            if not self.__run_fit(fit_task):
+                return 'Fitting failed'
+            self.__run_infer(infer_task, emit)
+            return None
+        finally:
+            # delete model instance
+            model.remove_instance(model_instance_id)
+
+    def schedule(self, name : str, tenant : str, reader : Connector, writer : Connector,
+                 model : BaseModel, model_args : Dict[str,Any],
+                 query : dict[str, dict[str, Any]], args : dict[str, str]) -> None:
+        '''
+        run the task in the calling thread, the records of the series are left in common.threadlocal.result
+        '''
+        records = []
+        error = self.__run(name, tenant, reader, writer, model, model_args, query, args, records.append)
+        common.threadlocal.result = error if error is not None else records
+
+    @staticmethod
+    def __job_key(tenant : str, reader : Connector, model : BaseModel, model_args : Dict[str,Any],
+                  query : dict[str, dict[str, Any]], args : dict[str, str]) -> str:
+        return json.dumps([tenant, id(reader), id(model), model_args, query, args], sort_keys=True, default=str)
+
+    def submit(self, name : str, tenant : str, reader : Connector, writer : Connector,
+               model : BaseModel, model_args : Dict[str,Any],
+               query : dict[str, dict[str, Any]], args : dict[str, str], use_cache : bool = True) -> Tuple[str, bool]:
+        '''
+        run the task on the job workers, unless a job with the same arguments is running or finished within cache_ttl
+        return: (job_id, cached), the job id to read with job() and stream()
+        '''
+        key = self.__job_key(tenant, reader, model, model_args, query, args)
+        with self.jobs_lock:
+            self.__expire_jobs()
+            job_id = self.job_keys.get(key)
+            if job_id is not None and use_cache:
+                job = self.jobs[job_id]
+                if job["status"] != "failed" and (job["finished"] is None or time.time() - job["finished"] <= self.cache_ttl_sec):
+                    return job_id, True
+        if not self.pool_slots.acquire(blocking=False):
+            raise RuntimeError("[Scheduler](Once) the job queue is full !")
+        job_id = str(uuid.uuid4())
+        with self.jobs_lock:
+            self.jobs[job_id] = {"id": job_id, "tenant": tenant, "key": key, "status": "pending", "submitted": time.time(),
+                                 "started": None, "finished": None, "lines": [], "bytes": 0, "error": None}
+            self.job_keys[key] = job_id
+        try:
+            self.pool.submit(self.__run_job, job_id, name, tenant, reader, writer, model, model_args, query, args)
+        except Exception:
+            with self.jobs_lock:
+                self.__drop_job(job_id)
+            self.pool_slots.release()
+            raise
+        return job_id, False
+
+    def __run_job(self, job_id : str, *task) -> None:
+        with self.jobs_lock:
+            job = self.jobs[job_id]
+            job["status"] = "running"
+            job["started"] = time.time()
+        def emit(record : Dict[str, Any]) -> None:
+            # serialized right away, a job holds one string per series
+            line = json.dumps(record)
+            with self.jobs_cond:
+                if not self.__reserve(job_id, len(line)):
+                    # the job ends as failed before its lines are released, the streams stop on it
+                    error = "[Scheduler](Once) the result is larger than 'max_result_mb'"
+                    job.update({"status": "failed", "finished": time.time(), "error": error})
+                    self.result_bytes -= job["bytes"]
+                    job["lines"], job["bytes"] = [], 0
+                    self.jobs_cond.notify_all()
+                    raise RuntimeError(error)
+                job["lines"].append(line)
+                job["bytes"] += len(line)
+                self.result_bytes += len(line)
+                self.jobs_cond.notify_all()
+        try:
+            error = self.__run(*task, emit)
+        except Exception as e:
+            logger.error("[Scheduler](Once) job %s: error occurred, %s", job_id, e)
+            error = str(e)
+        finally:
+            self.pool_slots.release()
+        with self.jobs_cond:
+            job.update({"status": "done" if error is None else "failed", "finished": time.time(), "error": error})
+            self.jobs_cond.notify_all()
+
+    def __drop_job(self, job_id : str) -> None:
+        # must be called with jobs_lock held
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return
+        self.result_bytes -= job["bytes"]
+        if self.job_keys.get(job["key"]) == job_id:
+            del self.job_keys[job["key"]]
+
+    def __reserve(self, job_id : str, size : int) -> bool:
+        '''
+        make room for 'size' more bytes of a job, the oldest finished jobs are dropped first
+        return: False if the running jobs alone would exceed max_result_bytes
+        must be called with jobs_lock held
+        '''
+        if self.result_bytes + size <= self.max_result_bytes:
+            return True
+        for other_id in list(self.jobs.keys()):
+            if self.result_bytes + size <= self.max_result_bytes:
+                break
+            if other_id != job_id and self.jobs[other_id]["finished"] is not None:
+                logger.warning("[Scheduler](Once) job %s dropped before its ttl, results over 'max_result_mb'", other_id)
+                self.__drop_job(other_id)
+        return self.result_bytes + size <= self.max_result_bytes
+
+    def __expire_jobs(self) -> None:
+        # must be called with jobs_lock held
+        now = time.time()
+        for job_id in list(self.jobs.keys()):
+            job = self.jobs[job_id]
+            if job["finished"] is not None and now - job["finished"] > self.job_ttl_sec:
+                self.__drop_job(job_id)
+
+    def job(self, job_id : str, tenant : str = None) -> Dict[str, Any]:
+        '''
+        {'id', 'tenant', 'status' ('pending' | 'running' | 'done' | 'failed'), 'submitted', 'started', 'finished', 'series', 'error'}
+        'series' is the number of series whose result is ready
+        return: None if the job is unknown, expired or of another tenant
+        '''
+        with self.jobs_lock:
+            self.__expire_jobs()
+            job = self.jobs.get(job_id)
+            if job is None or (tenant is not None and job["tenant"] != tenant):
+                return None
+            status = {k: v for k, v in job.items() if k not in ("lines", "key", "bytes")}
+            status["series"] = len(job["lines"])
+            return status
+
+    def wait_ready(self, job_id : str, timeout : float) -> bool:
+        '''
+        wait until the job has the result of a series, or is finished
+        return: False if it has none after 'timeout' seconds
+        '''
+        deadline = time.time() + timeout
+        with self.jobs_cond:
+            job = self.jobs.get(job_id)
+            while job is not None and len(job["lines"]) == 0 and job["finished"] is None and time.time() < deadline:
+                self.jobs_cond.wait(deadline - time.time())
+            return job is None or len(job["lines"]) > 0 or job["finished"] is not None
+
+    def stream(self, job_id : str, tenant : str = None, timeout : float = 600.0) -> Iterator[str]:
+        '''
+        the records of the series as json lines, as soon as they are ready, then a last line with the status of the job
+        return: None if the job is unknown, expired or of another tenant
+        raise RuntimeError if the job is not finished and max_streams streams wait for their job
+        '''
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is None or (tenant is not None and job["tenant"] != tenant):
+                return None
+            waiting = job["finished"] is None
+        if waiting and self.stream_slots is not None and not self.stream_slots.acquire(blocking=False):
+            raise RuntimeError("[Scheduler](Once) too many result streams, poll the job and read its result once done !")
+        def lines() -> Iterator[str]:
+            sent = 0
+            deadline = time.time() + timeout
+            while True:
+                with self.jobs_cond:
+                    while len(job["lines"]) <= sent and job["finished"] is None and time.time() < deadline:
+                        self.jobs_cond.wait(deadline - time.time())
+                    # the list only grows (or is emptied once the job failed on max_result_mb),
+                    # the lines already there are read out of the lock
+                    ready = job["lines"][sent:]
+                    finished = job["finished"] is not None
+                for line in ready:
+                    yield line + "\n"
+                sent += len(ready)
+                if finished or time.time() >= deadline:
+                    status = job["status"] if finished else "timeout"
+                    yield json.dumps({"status": status, "series": sent, "error": job["error"]}) + "\n"
+                    return
+        if not waiting or self.stream_slots is None:
+            return lines()
+        return _ReleasingIterator(lines(), self.stream_slots.release)
 
     def stop(self, name) -> bool:
-        raise RuntimeError("Not implemented")
\ No newline at end of file
+        raise RuntimeError("Not implemented")
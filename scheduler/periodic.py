@@ -1,10 +1,17 @@
 import logging
+import os
 import sys
 import scheduler._interface as _interface
+from scheduler._query import QueryFanout
+from scheduler._drift import DriftTracker
+from connector.store import shared_store
 import time
 import heapq
+import itertools
+import threading
+from collections import ChainMap
 
-from typing import Any, List, Dict
+from typing import Any, Callable, List, Dict, Tuple
 from connector import *
 from model import *
 
@@ -14,78 +21,280 @@ import pandas as pd
 
 sys.path.append('..')
 import common
+import metrics
 
 logger = logging.getLogger(__name__)
 
+RUN_LABELS = ("tenant", "task", "model", "kind")
+RUN_SECONDS = metrics.histogram("anomaly_scheduler_run_seconds", "Duration of the periodical runs, queries included", RUN_LABELS)
+RUNS = metrics.counter("anomaly_scheduler_runs_total", "Periodical runs by result (success, failure, error)", RUN_LABELS + ("result",))
+RUN_SERIES = metrics.gauge("anomaly_scheduler_run_series", "Series processed by the last run of a task", RUN_LABELS)
+REFIT_SERIES = metrics.counter("anomaly_scheduler_refit_series_total",
+                               "Series of the tasks refitted on drift, refitted or kept at each fit run",
+                               ("tenant", "task", "model", "decision"))
+LAG_SECONDS = metrics.histogram("anomaly_scheduler_lag_seconds", "Delay between a timer deadline and its dispatch", ("kind",),
+                                buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0))
+
+def _run_labels(kind : str, sch_task : _interface.ScheduledTask) -> Tuple[str, str, str, str]:
+    # scheduled task names are '<tenant>_<task>'
+    task = sch_task.name[len(sch_task.tenant) + 1:] if sch_task.name.startswith(sch_task.tenant + "_") else sch_task.name
+    return (sch_task.tenant, task, type(sch_task.model).__name__, kind)
+
+class _Checkpoint():
+    '''
+    checkpoint of a scheduled task, loaded by the first fit or infer of the task rather than by schedule,
+    the fit and infer tasks share it
+    '''
+
+    def __init__(self, path : str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # None until the first run tried it
+        self.loaded : bool = None
+
 class Periodical(_interface.Scheduler):
 
-    workers_pool : ThreadPoolExecutor = ThreadPoolExecutor()
-    active_task : Dict[str, List[_interface.ScheduledTask]] = {}
+    # False for the schedulers driving the infer of their tasks otherwise
+    infer_on_timer : bool = True
 
-    def __init__(self, max_tasks : int):
+    def __init__(self, max_tasks : int, fit_workers : int = 4, infer_workers : int = 8,
+                 queue_size : int = 1000, overrun_policy : str = "skip", checkpoint : bool = True,
+                 io_workers : int = 32, coalesce_window : str = "1s", fit_store : bool = False,
+                 fit_store_idle : str = "35d"):
+        '''
+        fit_workers, infer_workers : size of the fit and infer worker pools
+        io_workers : threads running the queries, the queries of a run are sent concurrently
+        coalesce_window : identical queries of tasks due together are sent once, see QueryFanout
+        queue_size : max runs of each kind waiting for a worker, further runs are dropped
+        overrun_policy : what to do when a task is due while its previous run is still in flight,
+                         'skip' drops the run, 'coalesce' runs it once right after the previous one
+        checkpoint : save the fitted models after each fit and restore them when the task is scheduled again
+        fit_store : keep the fit windows in the SeriesStore of the process, under the home folder, a refit only queries the newest samples
+        fit_store_idle : stored windows not refreshed for this long are removed, it is raised to twice the longest 'fit_every'
+        '''
+        if fit_workers <= 0 or infer_workers <= 0 or queue_size < 0:
+            raise ValueError("[CONFIG](Periodical) 'fit_workers', 'infer_workers' or 'queue_size' is invalid")
+        if overrun_policy not in ("skip", "coalesce"):
+            raise ValueError("[CONFIG](Periodical) 'overrun_policy' is invalid")
+        if not common.check_time_range_str(fit_store_idle):
+            raise ValueError("[CONFIG](Periodical) 'fit_store_idle' is invalid")
         self.anomaly_metrics_prefix = common.output_metrics_prefix
-        self.model_to_infer = []
-        self.model_to_fit = []
+        # {task name : [fit task, infer task]} of this scheduler
+        self.active_task : Dict[str, List[_interface.ScheduledTask]] = {}
         self.max_tasks = max_tasks
-        heapq.heapify(self.model_to_infer)
-        heapq.heapify(self.model_to_fit)
-        Periodical.workers_pool.submit(Periodical.time_wheel, self)
+        self.overrun_policy = overrun_policy
+        self.checkpoint = checkpoint
+        self.pools : Dict[str, ThreadPoolExecutor] = {
+            'fit': ThreadPoolExecutor(max_workers=fit_workers, thread_name_prefix="periodical-fit"),
+            'infer': ThreadPoolExecutor(max_workers=infer_workers, thread_name_prefix="periodical-infer")}
+        # a slot is held from submission to the end of a run, which bounds the executor queues
+        self.pool_slots : Dict[str, threading.BoundedSemaphore] = {
+            'fit': threading.BoundedSemaphore(fit_workers + queue_size),
+            'infer': threading.BoundedSemaphore(infer_workers + queue_size)}
+        self.fanout = QueryFanout("periodical", io_workers=io_workers, coalesce_window=coalesce_window,
+                                  store=shared_store() if fit_store else None)
+        if self.fanout.store is not None:
+            self.fanout.store.retain(common.parse_time_range_str(fit_store_idle))
+        # set in a cluster sharded by series, series_filter(series_id) is False for the series of other nodes
+        self.series_filter : Callable[[str], bool] = None
+        # set with series_filter, the checkpoints of this node only hold its series
+        self.checkpoint_node : str = None
+        self.runs_lock = threading.Lock()
+        self.run_stats = {kind: {"queued": 0, "running": 0, "finished": 0, "skipped": 0, "coalesced": 0, "dropped": 0}
+                          for kind in ('fit', 'infer')}
+        # heap of (next_trigger_t, sequence, 'fit' | 'infer', task)
+        self.timers : List[Tuple[float, int, str, _interface.ScheduledTask]] = []
+        self.timers_cancelled = 0
+        self.timers_seq = itertools.count()
+        self.timers_cond = threading.Condition()
+        # scheduling lag : delay in seconds between a timer deadline and its dispatch
+        self.lag_stats = {"dispatched": 0, "last": 0.0, "max": 0.0, "total": 0.0}
+        threading.Thread(target=self.time_wheel, name="periodical-time-wheel", daemon=True).start()
+
+    def register_metrics(self, name : str) -> None:
+        '''
+        export the queue, query and timer stats, called once per configured scheduler
+        name : scheduler name in the config
+        '''
+        metrics.collected("anomaly_scheduler_queue", "Runs waiting for or holding a worker, and runs not started since start-up",
+                          ("scheduler", "kind", "state"), "gauge",
+                          lambda: {(name, kind, state): value for kind, stats in self.queue_stats().items()
+                                   for state, value in stats.items() if state != "finished"})
+        metrics.collected("anomaly_scheduler_queries", "Queries sent, failed and served by an identical query",
+                          ("scheduler", "stat"), "counter",
+                          lambda: {(name, stat): value for stat, value in self.fanout.query_stats().items()
+                                   if stat in ("queries", "failed", "coalesced")})
+        metrics.collected("anomaly_scheduler_timers", "Timers in the heap of the time wheel", ("scheduler",), "gauge",
+                          lambda: {(name,): len(self.timers)})
+        metrics.collected("anomaly_scheduler_active_tasks", "Tasks scheduled periodically", ("scheduler",), "gauge",
+                          lambda: {(name,): len(self.active_task)})
+
+    def __push_timer(self, kind : str, sch_task : _interface.ScheduledTask) -> None:
+        # must be called with timers_cond held
+        heapq.heappush(self.timers, (sch_task.next_trigger_t, next(self.timers_seq), kind, sch_task))
+        if self.timers[0][3] is sch_task:
+            self.timers_cond.notify()
+
+    def __compact_timers(self) -> None:
+        # must be called with timers_cond held, drops stale timers once they are the majority of the heap
+        if self.timers_cancelled * 2 > len(self.timers):
+            self.timers = [timer for timer in self.timers if not timer[3].cancelled]
+            heapq.heapify(self.timers)
+            self.timers_cancelled = 0
+
+    def scheduling_lag(self) -> Dict[str, float]:
+        with self.timers_cond:
+            stats = dict(self.lag_stats)
+        stats["avg"] = stats["total"] / stats["dispatched"] if stats["dispatched"] > 0 else 0.0
+        return stats
 
     def time_wheel(self):
         logger.info("[Scheduler](Periodical) time wheel started")
         while True:
-            current_time = time.time()
-            infer_task = None
-            fit_task = None
-            if len(self.model_to_infer) > 0:
-                infer_task : _interface.ScheduledTask = self.model_to_infer[0]
-            if len(self.model_to_fit) > 0:
-                fit_task : _interface.ScheduledTask = self.model_to_fit[0]
-            try:
-                continuing = False
-                if infer_task is not None and infer_task.next_trigger_t < current_time:
-                    Periodical.workers_pool.submit(self.__run_infer, sch_task = infer_task)
-                    # update next_trigger_t
-                    infer_task.next_trigger_t = common.parse_time_range_str(infer_task.args['infer_every']) + time.time()
-                    heapq.heapify(self.model_to_infer)
-                    # continue to pop task from heap until it doesn't reach its execution time
-                    continuing = True
-            except Exception as e:
-                logger.error("[Scheduler](Periodical) inferring task error : task = %s, %s", infer_task.name, e)
+            with self.timers_cond:
+                while len(self.timers) > 0 and self.timers[0][3].cancelled:
+                    heapq.heappop(self.timers)
+                    self.timers_cancelled = max(self.timers_cancelled - 1, 0)
+                if len(self.timers) == 0:
+                    self.timers_cond.wait()
+                    continue
+                deadline = self.timers[0][0]
+                current_time = time.time()
+                if deadline > current_time:
+                    self.timers_cond.wait(deadline - current_time)
+                    continue
+                _, _, kind, sch_task = heapq.heappop(self.timers)
+                lag = current_time - deadline
+                self.lag_stats["dispatched"] += 1
+                self.lag_stats["last"] = lag
+                self.lag_stats["max"] = max(self.lag_stats["max"], lag)
+                self.lag_stats["total"] += lag
+                LAG_SECONDS.observe(lag, kind)
+                every = common.parse_time_range_str(sch_task.args[kind + '_every'])
+                # keep a fixed rate, but don't replay the periods missed while lagging behind
+                sch_task.next_trigger_t = deadline + every
+                if sch_task.next_trigger_t <= current_time:
+                    sch_task.next_trigger_t = current_time + every
+                self.__push_timer(kind, sch_task)
             try:
-                if fit_task is not None and fit_task.next_trigger_t < current_time:
-                    Periodical.workers_pool.submit(self.__run_fit, sch_task = fit_task)
-                    # update next_trigger_t
-                    fit_task.next_trigger_t = common.parse_time_range_str(fit_task.args['fit_every']) + time.time()
-                    heapq.heapify(self.model_to_fit)             
-                    # continue to pop task from heap until it doesn't reach its execution time
-                    continuing = True
+                self.__dispatch(kind, sch_task)
             except Exception as e:
-                logger.error("[Scheduler](Periodical) fitting task error : task = %s, %s", fit_task.name, e)
-            if not continuing:
-                time.sleep(10)
+                logger.error("[Scheduler](Periodical) %s task error : task = %s, %s", kind, sch_task.name, e)
+
+    def __dispatch(self, kind : str, sch_task : _interface.ScheduledTask) -> None:
+        stats = self.run_stats[kind]
+        with self.runs_lock:
+            if sch_task.running:
+                if self.overrun_policy == "coalesce" and not sch_task.pending:
+                    sch_task.pending = True
+                    stats["coalesced"] += 1
+                else:
+                    stats["skipped"] += 1
+                logger.warning("[Scheduler](Periodical) %s overrun : task = %s, policy = %s", kind, sch_task.name, self.overrun_policy)
+                return
+            if not self.pool_slots[kind].acquire(blocking=False):
+                stats["dropped"] += 1
+                logger.warning("[Scheduler](Periodical) %s queue is full, run dropped : task = %s", kind, sch_task.name)
+                return
+            sch_task.running = True
+            stats["queued"] += 1
+        try:
+            self.pools[kind].submit(self.__run_guarded, kind, sch_task)
+        except Exception:
+            with self.runs_lock:
+                sch_task.running = False
+                stats["queued"] -= 1
+            self.pool_slots[kind].release()
+            raise
+
+    def __run_guarded(self, kind : str, sch_task : _interface.ScheduledTask) -> None:
+        stats = self.run_stats[kind]
+        run = self.__run_fit if kind == 'fit' else self.__run_infer
+        with self.runs_lock:
+            stats["queued"] -= 1
+            stats["running"] += 1
+        labels = _run_labels(kind, sch_task)
+        try:
+            while True:
+                start_t = time.perf_counter()
+                try:
+                    result = "success" if run(sch_task = sch_task) else "failure"
+                except Exception as e:
+                    result = "error"
+                    logger.error("[Scheduler](Periodical) %s: error occurred, task = %s, %s", kind, sch_task.name, e)
+                RUN_SECONDS.observe(time.perf_counter() - start_t, *labels)
+                RUNS.inc(*labels, result)
+                with self.runs_lock:
+                    stats["finished"] += 1
+                    if not sch_task.pending or sch_task.cancelled:
+                        sch_task.pending = False
+                        sch_task.running = False
+                        break
+                    sch_task.pending = False
+        finally:
+            with self.runs_lock:
+                stats["running"] -= 1
+            self.pool_slots[kind].release()
+
+    def queue_stats(self) -> Dict[str, Dict[str, int]]:
+        '''
+        {'fit' | 'infer' : {'queued', 'running', 'finished', 'skipped', 'coalesced', 'dropped'}}
+        '''
+        with self.runs_lock:
+            return {kind: dict(stats) for kind, stats in self.run_stats.items()}
+
+    def __owned_series(self, y_map : Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+        if self.series_filter is None or y_map is None:
+            return y_map
+        return self.__select_series(y_map, [sid for sid in y_map.keys() if self.series_filter(sid)])
+
+    @staticmethod
+    def __select_series(y_map : Dict[str, pd.DataFrame], series_ids : List[str]) -> Dict[str, pd.DataFrame]:
+        if len(series_ids) == len(y_map):
+            return y_map
+        if isinstance(y_map, SeriesBlock):
+            return y_map.select(series_ids)
+        return {sid: y_map[sid] for sid in series_ids}
+
+    def _restore_checkpoint(self, sch_task : _interface.ScheduledTask) -> None:
+        '''
+        load the checkpoint found by schedule into the model instance, once, before the first fit or infer of the task
+        the fit is dispatched right away if it can't be loaded
+        '''
+        checkpoint : _Checkpoint = sch_task.checkpoint
+        if checkpoint is None:
+            return
+        with checkpoint.lock:
+            if checkpoint.loaded is not None:
+                return
+            checkpoint.loaded = sch_task.model.load_checkpoint(sch_task.model_instance, checkpoint.path)
+        if checkpoint.loaded:
+            if sch_task.drift is not None:
+                sch_task.drift.restored(os.path.getmtime(checkpoint.path))
+            logger.info("[Scheduler](Periodical) task %s restored from checkpoint %s", sch_task.name, checkpoint.path)
+            return
+        logger.warning("[Scheduler](Periodical) checkpoint: not loaded, fitting now, task = %s, %s", sch_task.name, checkpoint.path)
+        with self.timers_cond:
+            active = self.active_task.get(sch_task.name)
+        if active is not None and active[0] is not sch_task:
+            self.__dispatch('fit', active[0])
 
     def __run_infer(self, sch_task : _interface.ScheduledTask) -> bool:
-        y_all : Dict[str, pd.DataFrame] = {}
+        self._restore_checkpoint(sch_task)
+        # query results are merged lazily, series are materialized when the model reads them
+        y_all : ChainMap = ChainMap()
         y_label_all : Dict[str, Dict[str, str]] = {}
-        for query_name in sch_task.query.keys():
-            query_args_raw = sch_task.query[query_name]
-            queries = query_args_raw['queries']
-            query_len = sch_task.args['infer_window']
-            sampling_period = None
-            if 'sampling_period_infer' not in query_args_raw:
-                sampling_period = sch_task.args['infer_every']
-            else:
-                sampling_period = query_args_raw['sampling_period_infer']
-            y_map, y_label_map = sch_task.reader.query_series(sch_task.tenant, query_name, queries, sampling_period, query_len)
+        for query_name, y_map, y_label_map in self.fanout.query(sch_task, 'infer'):
+            y_map = self.__owned_series(y_map)
             if y_map is None:
                 logger.warning("[Scheduler](Periodical) query: %s, none returned y", query_name)
                 continue
             if y_map.__len__ == 0:
                 logger.warning("[Scheduler](Periodical) query: %s, empty returned y", query_name)
                 continue
-            y_all.update(y_map)
+            y_all.maps.insert(0, y_map)
             y_label_all.update(y_label_map)
+        RUN_SERIES.set(len(y_all), *_run_labels('infer', sch_task))
         if len(y_all) == 0:
             return True
         try:
@@ -93,43 +302,92 @@ class Periodical(_interface.Scheduler):
             if hat is None:
                 logger.warning("[Scheduler](Periodical) query:, %s, model: %s, empty inferer", query_name, sch_task.model.__class__)
                 return False
+            # a series which cannot be written does not stop the other ones
+            failed, error = 0, None
             for sid, infer_result in hat.items():
-                metrics, values, labels = infer_result.to_metrics(self.anomaly_metrics_prefix, query_name, y_label_all[sid])
-                sch_task.writer.insert_series(sch_task.tenant, metrics, labels, values)
-            return True
+                try:
+                    if not sch_task.writer.insert_result(sch_task.tenant, self.anomaly_metrics_prefix, query_name, y_label_all[sid], infer_result):
+                        failed, error = failed + 1, "insert_result returned False"
+                except Exception as e:
+                    failed, error = failed + 1, e
+            if failed > 0:
+                logger.error("[Scheduler](Periodical) infer: %d of %d results not written, task = %s, %s",
+                             failed, len(hat), sch_task.name, error)
+            if sch_task.drift is not None:
+                sch_task.drift.observe(y_all.keys(), hat, time.time())
+            return failed == 0 or failed < len(hat)
         except Exception as e:
             logger.error("[Scheduler](Periodical) infer: error occurred, %s", e)
             return False
 
+    def rebalance(self) -> None:
+        '''
+        fit every task now, called when series moved to or from this node, see Cluster
+        a task refitted on drift only fits the series it does not know yet
+        '''
+        with self.timers_cond:
+            fit_tasks = [fit_task for fit_task, _ in self.active_task.values()]
+        for fit_task in fit_tasks:
+            fit_task.rebalanced = True
+            try:
+                self.__dispatch('fit', fit_task)
+            except Exception as e:
+                logger.error("[Scheduler](Periodical) rebalance: fit not dispatched, task = %s, %s", fit_task.name, e)
+
     def __run_fit(self, sch_task : _interface.ScheduledTask) -> bool:
-        y_all : Dict[str, pd.DataFrame] = {}
-        for query_name in sch_task.query.keys():
-            query_args_raw = sch_task.query[query_name]
-            queries = query_args_raw['queries']
-            query_len = sch_task.args['fit_window']
-            sampling_period = None
-            if 'sampling_period_fit' not in query_args_raw:
-                sampling_period = common.default_time_window(query_len, 250)
-            else:
-                sampling_period = query_args_raw['sampling_period_fit']
-            data, _ = sch_task.reader.query_series(sch_task.tenant, query_name, queries, sampling_period, query_len)
+        self._restore_checkpoint(sch_task)
+        now = time.time()
+        rebalanced, sch_task.rebalanced = sch_task.rebalanced, False
+        due = sch_task.drift.due(now) if sch_task.drift is not None else None
+        if due is not None and len(due) == 0 and not rebalanced:
+            # every series still fits its infers, neither the queries nor the model are run
+            RUN_SERIES.set(0, *_run_labels('fit', sch_task))
+            REFIT_SERIES.inc(*_run_labels('fit', sch_task)[:-1], "kept", amount=len(sch_task.drift))
+            return True
+        y_all : ChainMap = ChainMap()
+        queried = set()
+        for query_name, data, _ in self.fanout.query(sch_task, 'fit'):
+            data = self.__owned_series(data)
+            if data is not None and due is not None:
+                queried.update(data.keys())
+                # series never fitted by the task are fitted too
+                data = self.__select_series(data, [sid for sid in data.keys() if sid in due or not sch_task.drift.known(sid)])
             if data is None:
                 logger.warning("[Scheduler](Periodical) query: %s, return none", query_name)
                 continue
             if data.__len__ == 0:
                 logger.warning("[Scheduler](Periodical) query: %s, return empty result", query_name)
                 continue
-            y_all.update(data)
+            y_all.maps.insert(0, data)
+        RUN_SERIES.set(len(y_all), *_run_labels('fit', sch_task))
+        if due is not None:
+            sch_task.drift.forget(due - queried)
+            labels = _run_labels('fit', sch_task)[:-1]
+            REFIT_SERIES.inc(*labels, "refit", amount=len(y_all))
+            REFIT_SERIES.inc(*labels, "kept", amount=len(queried) - len(y_all))
         if len(y_all) == 0:
             return True
         try:
             success = sch_task.model.fit(sch_task.model_instance, y_all)
+            if sch_task.drift is not None and success:
+                # a series whose fit failed keeps its residuals, it stays due
+                failed = sch_task.model.failed_series(sch_task.model_instance, y_all.keys())
+                sch_task.drift.fitted([sid for sid in y_all.keys() if sid not in failed], now)
             if not success:
                 logger.warning("[Scheduler](Periodical) fit: failed, model = %s, ", sch_task.model.__class__, sch_task.model_instance)
+            elif self.checkpoint and not sch_task.cancelled:
+                self.__save_checkpoint(sch_task)
             return success
         except Exception as e:
             logger.error("[Scheduler](Periodical) fit: error occurred, %s", e)
             return False
+
+    def __save_checkpoint(self, sch_task : _interface.ScheduledTask) -> None:
+        path = common.get_model_checkpoint_path(sch_task.tenant, sch_task.name, self.checkpoint_node)
+        if sch_task.model.save_checkpoint(sch_task.model_instance, path):
+            common.remove_model_checkpoints(sch_task.tenant, sch_task.name, keep=path, node=self.checkpoint_node)
+        else:
+            logger.warning("[Scheduler](Periodical) checkpoint: not saved, task = %s", sch_task.name)
     
     def check_args(self, args : dict[str,str]) -> bool:
         if args['fit_window'] is None or not common.check_time_range_str(args['fit_window']):
@@ -144,40 +402,84 @@ class Periodical(_interface.Scheduler):
             args['infer_every'] = args['infer_window']
         elif not common.check_time_range_str(args['infer_every']):
             return False
+        return self.__check_refit_args(args)
+
+    def __check_refit_args(self, args : dict[str,str]) -> bool:
+        '''
+        refit : 'always' refits every series each 'fit_every', 'drift' only the series due according to a DriftTracker
+        refit_max_age : a series is refitted at least this often, default 7 times 'fit_every'
+        refit_min_coverage, refit_max_bias, refit_min_samples : see DriftTracker
+        '''
+        refit = args.get('refit', "always")
+        if refit not in ("always", "drift"):
+            return False
+        if refit == "always":
+            return True
+        if args.get('refit_max_age') is None:
+            args['refit_max_age'] = str(7 * common.parse_time_range_str(args['fit_every'])) + "s"
+        elif not common.check_time_range_str(args['refit_max_age']):
+            return False
+        for name, default in (('refit_min_coverage', 0.6), ('refit_max_bias', 0.5), ('refit_min_samples', 10)):
+            if args.get(name) is None:
+                args[name] = default
+            try:
+                value = float(args[name])
+            except (TypeError, ValueError):
+                return False
+            if value < 0 or (name == 'refit_min_coverage' and value > 1):
+                return False
         return True
-    
+
     def schedule(self, name : str, tenant : str, reader : Connector, writer : Connector,
                  model : BaseModel, model_args : Dict[str,Any],
                  query : dict[str, dict[str, Any]], args : dict[str, str]) -> None:
-        if self.max_tasks >= 0 and len(Periodical.active_task) >= self.max_tasks:
+        if self.max_tasks >= 0 and len(self.active_task) >= self.max_tasks:
             raise RuntimeError("[Scheduler](Periodical) the number of tasks has reached its limit !")
         if not self.check_args(args):
             raise ValueError("[Scheduler](Periodical) args error !")
         # update task ?
-        if name in Periodical.active_task:
+        if name in self.active_task:
             self.stop(name)
         # create model instance
         model_instance_id = model.create_instance(model_args)
         # schedule
         next_fit_t = time.time()
         next_infer_t = common.parse_time_range_str(args['infer_every']) + time.time()
+        drift = None
+        if args.get('refit', "always") == "drift":
+            drift = DriftTracker(float(args['refit_min_coverage']), float(args['refit_max_bias']),
+                                 common.parse_time_range_str(args['refit_max_age']), int(args['refit_min_samples']))
+        checkpoint = None
+        if self.checkpoint:
+            checkpoints = common.list_model_checkpoints(tenant, name, self.checkpoint_node)
+            if len(checkpoints) > 0:
+                # warm restart, the checkpoint stands for the last fit, it is loaded by the first run of the task
+                checkpoint = _Checkpoint(checkpoints[0])
+                next_fit_t = max(next_fit_t, os.path.getmtime(checkpoints[0]) + common.parse_time_range_str(args['fit_every']))
         fit_task = _interface.ScheduledTask(name, tenant, reader, writer, model, model_instance_id, query, args, next_fit_t)
         infer_task = _interface.ScheduledTask(name, tenant, reader, writer, model, model_instance_id, query, args, next_infer_t)
-        heapq.heappush(self.model_to_fit, fit_task)
-        heapq.heappush(self.model_to_infer, infer_task)
-        Periodical.active_task[name] = [fit_task, infer_task]
+        fit_task.drift = infer_task.drift = drift
+        fit_task.checkpoint = infer_task.checkpoint = checkpoint
+        if self.fanout.store is not None:
+            # a stored window outlives the time between two refits
+            self.fanout.store.retain(2 * common.parse_time_range_str(args['fit_every']))
+        with self.timers_cond:
+            self.__push_timer('fit', fit_task)
+            if self.infer_on_timer:
+                self.__push_timer('infer', infer_task)
+            self.active_task[name] = [fit_task, infer_task]
 
     def stop(self, name) -> bool:
-        if name in Periodical.active_task:
-            fit_task, infer_task = Periodical.active_task[name]
-            try:
-                self.model_to_fit.remove(fit_task)
-                self.model_to_infer.remove(infer_task)
-            except Exception:
+        with self.timers_cond:
+            if name not in self.active_task:
                 return False
-            heapq.heapify(self.model_to_fit)
-            heapq.heapify(self.model_to_infer)
-            del Periodical.active_task[name]
-            return True
-        else:
-            return False
\ No newline at end of file
+            fit_task, infer_task = self.active_task.pop(name)
+            fit_task.cancelled = True
+            infer_task.cancelled = True
+            self.timers_cancelled += 2 if self.infer_on_timer else 1
+            self.__compact_timers()
+        # runs still in flight see the instance gone and give up
+        fit_task.model.remove_instance(fit_task.model_instance)
+        for kind, sch_task in (('fit', fit_task), ('infer', infer_task)):
+            RUN_SERIES.remove(*_run_labels(kind, sch_task))
+        return True
@@ -0,0 +1,172 @@
+import logging
+import sys
+import time
+import threading
+import numpy as np
+
+import scheduler._interface as _interface
+from scheduler.periodic import Periodical, RUN_SECONDS, RUNS, RUN_SERIES, _run_labels
+
+from typing import Any, Callable, Dict, List, Tuple
+from connector import *
+from model import *
+
+sys.path.append('..')
+import common
+
+logger = logging.getLogger(__name__)
+
+class _StreamState():
+    '''
+    last 'infer_window' of the series of a task, {series_id : (unix seconds, values)}
+    '''
+
+    def __init__(self) -> None:
+        self.series : Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.unsubscribe : Callable[[], None] = None
+        self.swept = time.time()
+
+    def sweep(self, window_sec : int) -> None:
+        # series which stopped receiving samples, checked once per window
+        now = time.time()
+        if now - self.swept < window_sec:
+            return
+        self.swept = now
+        for sid in [sid for sid, (ts, _) in self.series.items() if len(ts) == 0 or ts[-1] < now - window_sec]:
+            del self.series[sid]
+
+class Streaming(Periodical):
+    '''
+    Fits like Periodical, but the infer is driven by the samples pushed to a stream connector
+    (scheduler args 'stream_source' : name of a reader, e.g. a Pulsar connector with a 'source_topic').
+    The last 'infer_window' of each series is kept in memory, every micro-batch updates it and
+    only the new samples are scored and written, without querying the reader.
+    A sample belongs to a query of the task if its series was fitted, 'stream_metric' in the query args
+    restricts the query to one metric name of the stream.
+    '''
+
+    infer_on_timer = False
+
+    def __init__(self, max_tasks : int, fit_workers : int = 4, infer_workers : int = 8,
+                 queue_size : int = 1000, overrun_policy : str = "skip", checkpoint : bool = True,
+                 io_workers : int = 32, coalesce_window : str = "1s", fit_store : bool = False,
+                 fit_store_idle : str = "35d"):
+        super().__init__(max_tasks, fit_workers=fit_workers, infer_workers=infer_workers, queue_size=queue_size,
+                         overrun_policy=overrun_policy, checkpoint=checkpoint, io_workers=io_workers,
+                         coalesce_window=coalesce_window, fit_store=fit_store, fit_store_idle=fit_store_idle)
+        # set by the handler, {name : connector} the stream sources are looked up in
+        self.connectors : Dict[str, Connector] = {}
+        # {task name : state}
+        self.streams : Dict[str, _StreamState] = {}
+        self.streams_lock = threading.Lock()
+
+    def check_args(self, args : dict[str,str]) -> bool:
+        if 'stream_source' not in args or args['stream_source'] not in self.connectors:
+            return False
+        return super().check_args(args)
+
+    def schedule(self, name : str, tenant : str, reader : Connector, writer : Connector,
+                 model : BaseModel, model_args : Dict[str,Any],
+                 query : dict[str, dict[str, Any]], args : dict[str, str]) -> None:
+        if not self.check_args(args):
+            raise ValueError("[Scheduler](Streaming) args error !")
+        super().schedule(name, tenant, reader, writer, model, model_args, query, args)
+        infer_task = self.active_task[name][1]
+        state = _StreamState()
+        with self.streams_lock:
+            self.streams[name] = state
+        state.unsubscribe = self.connectors[args['stream_source']].subscribe(
+            tenant, lambda batch: self.__on_batch(infer_task, state, batch))
+
+    def stop(self, name) -> bool:
+        with self.streams_lock:
+            state = self.streams.pop(name, None)
+        if state is not None and state.unsubscribe is not None:
+            state.unsubscribe()
+        active = self.active_task.get(name)
+        if active is not None:
+            RUN_SERIES.remove(*_run_labels('stream', active[1]))
+        return super().stop(name)
+
+    @staticmethod
+    def __append(window : Tuple[np.ndarray, np.ndarray], ts : np.ndarray, values : np.ndarray,
+                 window_sec : int) -> Tuple[Tuple[np.ndarray, np.ndarray], int]:
+        '''
+        add the samples to the window of a series, samples not newer than the window are dropped (redelivered batches)
+        return: (the new window, the timestamp of the first new sample), None if there is no new sample
+        '''
+        # the last sample of a duplicated timestamp wins
+        ts, pos = np.unique(ts[::-1], return_index=True)
+        values = values[::-1][pos]
+        if window is not None and len(window[0]) > 0:
+            newer = ts > window[0][-1]
+            ts, values = ts[newer], values[newer]
+        if len(ts) == 0:
+            return None
+        if window is not None:
+            ts_all = np.concatenate([window[0], ts])
+            values_all = np.concatenate([window[1], values])
+        else:
+            ts_all, values_all = ts, values
+        start = int(np.searchsorted(ts_all, ts_all[-1] - window_sec, side='right'))
+        return (ts_all[start:], values_all[start:]), int(ts[0])
+
+    def __on_batch(self, sch_task : _interface.ScheduledTask, state : _StreamState, batch : StreamBatch) -> bool:
+        if sch_task.cancelled:
+            return True
+        self._restore_checkpoint(sch_task)
+        labels = _run_labels('stream', sch_task)
+        start_t = time.perf_counter()
+        window_sec = common.parse_time_range_str(sch_task.args['infer_window'])
+        # {series_id : (query_name, labels, first new timestamp)}, the windows are only updated once the batch is written
+        touched : Dict[str, Tuple[str, Dict[str, str], int]] = {}
+        windows : Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for series_labels, ts, values in batch.values():
+            for query_name, query_args in sch_task.query.items():
+                metric = query_args.get('stream_metric')
+                if metric is not None and series_labels.get('__name__') != metric:
+                    continue
+                label = {k: v for k, v in series_labels.items() if k != '__name__'}
+                # same id as the series of a query result, see SeriesBlock.decode
+                sid = common.map_hash(dict(label, __name__=query_name) if query_name is not None and query_name != '' else label)
+                if self.series_filter is not None and not self.series_filter(sid):
+                    continue
+                appended = self.__append(windows.get(sid, state.series.get(sid)), ts, values, window_sec)
+                if appended is None:
+                    continue
+                windows[sid] = appended[0]
+                if sid not in touched:
+                    touched[sid] = (query_name, label, appended[1])
+        if len(touched) == 0:
+            return True
+        ids = list(touched.keys())
+        parts = [windows[sid] for sid in ids]
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum([len(ts) for ts, _ in parts], out=offsets[1:])
+        block = SeriesBlock(ids, {sid: touched[sid][1] for sid in ids},
+                            np.concatenate([ts for ts, _ in parts]), np.concatenate([values for _, values in parts]), offsets)
+        try:
+            hat = sch_task.model.infer(sch_task.model_instance, block)
+            scored = {}
+            for sid, infer_result in (hat or {}).items():
+                query_name, label, first_new = touched[sid]
+                scored[sid] = infer_result.since(first_new)
+                if not sch_task.writer.insert_result(sch_task.tenant, self.anomaly_metrics_prefix, query_name, label, scored[sid]):
+                    # the batch is delivered again, the windows are not updated
+                    raise IOError("result of series %s not written" % sid)
+            # acked once written, not only buffered by the writer
+            if len(scored) > 0 and not sch_task.writer.flush(sch_task.tenant):
+                raise IOError("results of tenant %s not flushed" % sch_task.tenant)
+        except Exception as e:
+            RUNS.inc(*labels, "error")
+            logger.error("[Scheduler](Streaming) infer: error occurred, task = %s, %s", sch_task.name, e)
+            raise
+        finally:
+            RUN_SECONDS.observe(time.perf_counter() - start_t, *labels)
+        state.series.update(windows)
+        state.sweep(window_sec)
+        if sch_task.drift is not None:
+            sch_task.drift.observe(ids, scored, time.time())
+        RUNS.inc(*labels, "success")
+        RUN_SERIES.set(len(hat) if hat is not None else 0, *labels)
+        return True
@@ -0,0 +1,244 @@
+'''
+End-to-end benchmarks of the fit, infer, write and /test paths against a local fake VictoriaMetrics
+
+    python test/benchmark/bench.py --series 1000 --model zscore --json result.json
+    python test/benchmark/bench.py --series 1000 --model zscore --baseline result.json
+
+Each scenario runs in its own process so that its peak RSS is not hidden by another one.
+The cpu time of the fit worker processes of a model is only counted once they exited.
+'''
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import yaml
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_vm import FakeVictoriametrics
+
+SCENARIOS = ("fit", "infer", "write", "test")
+TENANT = "1"
+QUERY_NAME = "bench"
+QUERY = 'bench_metric{job="bench"}'
+
+def _usage() -> Dict[str, float]:
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"cpu_s": me.ru_utime + me.ru_stime + children.ru_utime + children.ru_stime,
+            # kilobytes on linux
+            "peak_rss_mb": max(me.ru_maxrss, children.ru_maxrss) / 1024.0}
+
+def _percentile(values : List[float], q : float) -> float:
+    return float(np.percentile(np.asarray(values), q)) if len(values) > 0 else 0.0
+
+class Bench():
+    '''
+    Components built from the service config, reading from and writing to the fake datasource
+    '''
+
+    def __init__(self, args : argparse.Namespace) -> None:
+        import common
+        import connector
+        import model
+        self.args = args
+        self.vm = FakeVictoriametrics(series=args.series, seed=args.seed).start()
+        with open(args.config, 'r') as f:
+            configs = yaml.safe_load(f)
+        params = {}
+        for cnt in configs['connector']:
+            if cnt['class'] == 'Victoriametrics':
+                params = dict(cnt['params'])
+                break
+        params.update({"datasource_url": self.vm.url, "multi_tenant": True, "cache_size_mb": args.cache_mb,
+                       "user_query": None, "pwd_query": None, "user_insert": None, "pwd_insert": None})
+        self.connector = connector.Victoriametrics(**params)
+        model_conf = [m for m in configs['model'] if m['name'] == args.model]
+        if len(model_conf) == 0:
+            raise ValueError("unknown model '" + args.model + "' in " + args.config)
+        self.model_name = args.model
+        self.model = getattr(model, model_conf[0]['class'])(**model_conf[0].get('params', {}))
+        self.model_args = json.loads(args.model_args)
+        self.home = tempfile.mkdtemp(prefix="bench-")
+        common.check_home_folder(self.home)
+        self.step = args.step
+        self.fit_window = str(args.fit_points * args.step) + "s"
+        self.infer_window = str(args.infer_points * args.step) + "s"
+        self.instance = None
+        self.results = None
+
+    def query(self, window : str):
+        y, labels = self.connector.query_series(TENANT, QUERY_NAME, QUERY, str(self.step) + "s", window)
+        if y is None or len(y) != self.args.series:
+            raise RuntimeError("fake datasource returned " + str(0 if y is None else len(y)) + " series")
+        return y, labels
+
+    def fit(self) -> int:
+        if self.instance is None:
+            self.instance = self.model.create_instance(self.model_args)
+        y, _ = self.query(self.fit_window)
+        if not self.model.fit(self.instance, y):
+            raise RuntimeError("fit failed")
+        return len(y)
+
+    def infer(self) -> int:
+        y, self.labels = self.query(self.infer_window)
+        self.results = self.model.infer(self.instance, y)
+        if self.results is None:
+            raise RuntimeError("infer failed")
+        return len(self.results)
+
+    def write(self) -> int:
+        for sid, result in self.results.items():
+            self.connector.insert_result(TENANT, "anomaly", QUERY_NAME, self.labels[sid], result)
+        if not self.connector.flush():
+            raise RuntimeError("write failed")
+        return len(self.results)
+
+    def setup_test(self) -> None:
+        import handler
+        import scheduler
+        handler.init_global_configs(self.home, {"vm": self.connector}, {"vm": self.connector},
+                                    {self.model_name: self.model}, {"once": scheduler.Once()})
+        self.client = handler.app.test_client()
+
+    def test(self) -> int:
+        res = self.client.post("/test/" + TENANT + "?stream=true&cache=false", json={
+            "reader": "vm", "writer": "vm", "model": self.model_name, "model_args": self.model_args,
+            "scheduler_args": {"fit_window": self.fit_window, "infer_window": self.infer_window},
+            "query_name": QUERY_NAME,
+            "query_args": {"queries": QUERY, "sampling_period_fit": str(self.step) + "s",
+                           "sampling_period_infer": str(self.step) + "s"}})
+        if res.status_code != 200:
+            raise RuntimeError("/test returned " + str(res.status_code))
+        lines = res.get_data(as_text=True).splitlines()
+        status = json.loads(lines[-1])
+        if status["status"] != "done":
+            raise RuntimeError("/test job failed: " + str(status["error"]))
+        return len(lines) - 1
+
+def run_scenario(args : argparse.Namespace, scenario : str) -> Dict[str, Any]:
+    bench = Bench(args)
+    # state the scenario starts from, not measured
+    setup : Dict[str, List[Callable[[], int]]] = {
+        "fit": [], "infer": [bench.fit], "write": [bench.fit, bench.infer], "test": [bench.setup_test]}
+    run : Dict[str, Callable[[], int]] = {"fit": bench.fit, "infer": bench.infer, "write": bench.write, "test": bench.test}
+    for step in setup[scenario]:
+        step()
+    for _ in range(args.warmup):
+        if scenario == "write":
+            bench.infer()
+        run[scenario]()
+    bench.vm.reset_stats()
+    latencies = []
+    series = 0
+    start = _usage()
+    for _ in range(args.repeat):
+        if scenario == "write":
+            # every write sends fresh results, as after each infer
+            bench.infer()
+        t = time.perf_counter()
+        series += run[scenario]()
+        latencies.append(time.perf_counter() - t)
+    end = _usage()
+    served = bench.vm.reset_stats()
+    elapsed = sum(latencies)
+    report = {"scenario": scenario, "model": args.model, "series": args.series, "repeat": args.repeat,
+              "series_per_s": series / elapsed if elapsed > 0 else 0.0,
+              "p50_s": _percentile(latencies, 50), "p99_s": _percentile(latencies, 99),
+              "cpu_s": end["cpu_s"] - start["cpu_s"], "peak_rss_mb": end["peak_rss_mb"]}
+    if scenario == "write":
+        report["samples_per_s"] = served["import_samples"] / elapsed if elapsed > 0 else 0.0
+        report["bytes_sent"] = served["import_bytes"]
+    else:
+        report["query_bytes"] = served["query_bytes"]
+    bench.model.close()
+    bench.vm.stop()
+    return report
+
+def compare(reports : List[Dict[str, Any]], baseline : List[Dict[str, Any]], tolerance : float) -> List[str]:
+    '''
+    return: the regressions of 'reports' against 'baseline', a slower throughput or a longer p99 beyond the tolerance
+    '''
+    regressions = []
+    previous = {(r["scenario"], r["model"], r["series"]): r for r in baseline}
+    for report in reports:
+        base = previous.get((report["scenario"], report["model"], report["series"]))
+        if base is None:
+            continue
+        if report["series_per_s"] < base["series_per_s"] * (1 - tolerance):
+            regressions.append("%s: series/s %.1f -> %.1f" % (report["scenario"], base["series_per_s"], report["series_per_s"]))
+        if report["p99_s"] > base["p99_s"] * (1 + tolerance):
+            regressions.append("%s: p99 %.3fs -> %.3fs" % (report["scenario"], base["p99_s"], report["p99_s"]))
+        if report["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append("%s: peak rss %.0fMB -> %.0fMB" % (report["scenario"], base["peak_rss_mb"], report["peak_rss_mb"]))
+    return regressions
+
+def print_reports(reports : List[Dict[str, Any]]) -> None:
+    print("%-6s %-20s %8s %12s %10s %10s %9s %10s" % ("path", "model", "series", "series/s", "p50", "p99", "cpu", "peak rss"))
+    for r in reports:
+        print("%-6s %-20s %8d %12.1f %9.3fs %9.3fs %8.2fs %8.0fMB" % (r["scenario"], r["model"], r["series"], r["series_per_s"],
+                                                                     r["p50_s"], r["p99_s"], r["cpu_s"], r["peak_rss_mb"]))
+
+def parse_args(argv : List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="benchmarks of the anomaly detection service")
+    parser.add_argument("-s", "--scenario", type=str, help="comma separated scenarios among " + ",".join(SCENARIOS), default=",".join(SCENARIOS))
+    parser.add_argument("-c", "--config", type=str, help="service config the components are built from", default=os.path.join(ROOT, "config.yaml"))
+    parser.add_argument("-m", "--model", type=str, help="model name in the config, default zscore", default="zscore")
+    parser.add_argument("--model-args", type=str, help="instance args as json, default {}", default="{}")
+    parser.add_argument("--series", type=int, help="series returned by the fake datasource, default 1000", default=1000)
+    parser.add_argument("--fit-points", type=int, help="points of each series in a fit query, default 2016", default=2016)
+    parser.add_argument("--infer-points", type=int, help="points of each series in an infer query, default 12", default=12)
+    parser.add_argument("--step", type=int, help="sampling period in seconds, default 300", default=300)
+    parser.add_argument("--cache-mb", type=int, help="query cache of the connector, default 0 (disabled)", default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-r", "--repeat", type=int, help="measured runs of each scenario, default 5", default=5)
+    parser.add_argument("-w", "--warmup", type=int, help="runs before measuring, default 1", default=1)
+    parser.add_argument("--json", type=str, help="write the reports to this file", default=None)
+    parser.add_argument("--baseline", type=str, help="reports of a previous version to compare with", default=None)
+    parser.add_argument("--tolerance", type=float, help="allowed relative regression, default 0.2", default=0.2)
+    parser.add_argument("--in-process", action="store_true", help="run the scenarios in this process")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(filename)s - %(levelname)s - %(message)s')
+    for noisy in ("cmdstanpy", "prophet"):
+        logging.getLogger(noisy).setLevel(logging.CRITICAL)
+    scenarios = [s.strip() for s in args.scenario.split(",") if s.strip() != ""]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise SystemExit("unknown scenario: " + scenario)
+    reports = []
+    if args.in_process or len(scenarios) == 1:
+        reports = [run_scenario(args, scenario) for scenario in scenarios]
+    else:
+        argv = [a for a in sys.argv[1:]]
+        for scenario in scenarios:
+            with tempfile.NamedTemporaryFile(suffix=".json") as out:
+                child = [sys.executable, os.path.abspath(__file__)] + argv + ["--scenario", scenario, "--json", out.name, "--in-process"]
+                # the last occurrence of an option wins, the baseline is compared once all scenarios ran
+                child += ["--baseline", ""] if args.baseline is not None else []
+                subprocess.run(child, check=True, stdout=subprocess.DEVNULL)
+                with open(out.name, 'r') as f:
+                    reports.extend(json.load(f))
+    print_reports(reports)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(reports, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        sys.exit(1 if len(regressions) > 0 else 0)
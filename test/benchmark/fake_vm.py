@@ -0,0 +1,173 @@
+import gzip
+import json
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+QUERY_PATH = re.compile(r'^/(select/[^/]+/prometheus/)?api/v1/query_range$')
+IMPORT_PATH = re.compile(r'^/(insert/[^/]+/prometheus/)?api/v1/import(/prometheus)?$')
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+def _parse_step(step : str) -> int:
+    # '300', '300s', '5m', ...
+    if step[-1:] in UNITS:
+        return int(float(step[:-1]) * UNITS[step[-1]])
+    return int(float(step))
+
+class FakeVictoriametrics():
+    '''
+    Local stand-in of VictoriaMetrics for the benchmarks
+        series : number of series returned by every 'query_range'
+        seed : the synthetic values only depend on the seed, the series and the timestamp
+    'query_range' returns 'series' series covering [start, end] with the requested step,
+    'import' accepts prometheus text and json lines, optionally gzip compressed and chunked,
+    and only counts what it received.
+    '''
+
+    def __init__(self, series : int = 100, seed : int = 0, host : str = "127.0.0.1", port : int = 0) -> None:
+        self.series = series
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.stats = {"queries": 0, "query_bytes": 0, "imports": 0, "import_bytes": 0, "import_samples": 0}
+        # rendered bodies of the last queries, a benchmark sends the same range many times
+        self.bodies : OrderedDict[Tuple[int, ...], bytes] = OrderedDict()
+        self.server = ThreadingHTTPServer((host, port), self.__handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return "http://" + host + ":" + str(port) + "/"
+
+    def start(self) -> 'FakeVictoriametrics':
+        threading.Thread(target=self.server.serve_forever, name="fake-vm", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self) -> Dict[str, int]:
+        with self.lock:
+            stats = dict(self.stats)
+            for key in self.stats:
+                self.stats[key] = 0
+        return stats
+
+    def render(self, start : float, end : float, step : int) -> bytes:
+        first = int(np.ceil(start / step)) * step
+        count = max(int((end - first) // step) + 1, 0)
+        key = (self.series, self.seed, first, step, count)
+        with self.lock:
+            body = self.bodies.get(key)
+            if body is not None:
+                self.bodies.move_to_end(key)
+                return body
+        ts = first + np.arange(count, dtype=np.int64) * step
+        rng = np.random.default_rng(self.seed)
+        level = rng.uniform(10, 100, self.series)
+        amplitude = rng.uniform(1, 10, self.series)
+        phase = rng.uniform(0, 2 * np.pi, self.series)
+        # noise is hashed from (series, timestamp) so that overlapping ranges agree
+        noise = ((np.arange(self.series)[:, None] * 2654435761 + ts[None, :] * 40503) % 1000) / 1000.0 - 0.5
+        values = level[:, None] + amplitude[:, None] * np.sin(2 * np.pi * ts[None, :] / 86400 + phase[:, None]) + noise
+        ts_s = [str(t) for t in ts.tolist()]
+        result = []
+        for i in range(self.series):
+            samples = ",".join(['[' + t + ',"' + format(v, '.3f') + '"]' for t, v in zip(ts_s, values[i].tolist())])
+            result.append('{"metric":{"__name__":"bench_metric","job":"bench","instance":"host-' + str(i) + '"},"values":[' + samples + ']}')
+        body = ('{"status":"success","data":{"resultType":"matrix","result":[' + ",".join(result) + ']}}').encode("utf-8")
+        with self.lock:
+            self.bodies[key] = body
+            while len(self.bodies) > 8:
+                self.bodies.popitem(last=False)
+        return body
+
+    def __handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def __reply(self, status : int, body : bytes = b'', content_type : str = "application/json") -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def __read_body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    parts = []
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            break
+                        parts.append(self.rfile.read(size))
+                        self.rfile.readline()
+                    return b''.join(parts)
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                if url.path.endswith("/health"):
+                    return self.__reply(200, b'OK', "text/plain")
+                if QUERY_PATH.match(url.path) is None:
+                    return self.__reply(404)
+                args = parse_qs(url.query)
+                try:
+                    step = _parse_step(args['step'][0])
+                    body = fake.render(float(args['start'][0]), float(args['end'][0]), max(step, 1))
+                except (KeyError, ValueError) as e:
+                    return self.__reply(400, json.dumps({"status": "error", "error": str(e)}).encode("utf-8"))
+                with fake.lock:
+                    fake.stats["queries"] += 1
+                    fake.stats["query_bytes"] += len(body)
+                self.__reply(200, body)
+
+            def do_PUT(self) -> None:
+                url = urlparse(self.path)
+                data = self.__read_body()
+                if IMPORT_PATH.match(url.path) is None:
+                    return self.__reply(404)
+                size = len(data)
+                if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+                    data = gzip.decompress(data)
+                elif self.headers.get('Content-Encoding', '').lower() == 'deflate':
+                    data = zlib.decompress(data)
+                if url.path.endswith("/prometheus"):
+                    samples = data.count(b'\n')
+                else:
+                    samples = sum(len(json.loads(line)["values"]) for line in data.splitlines() if len(line) > 0)
+                with fake.lock:
+                    fake.stats["imports"] += 1
+                    fake.stats["import_bytes"] += size
+                    fake.stats["import_samples"] += samples
+                self.__reply(204)
+
+            do_POST = do_PUT
+
+        return Handler
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="fake VictoriaMetrics for local benchmarks")
+    parser.add_argument("-s", "--series", type=int, help="series returned by every query, default 100", default=100)
+    parser.add_argument("-p", "--port", type=int, help="listening port, default 8428", default=8428)
+    args = parser.parse_args()
+    vm = FakeVictoriametrics(series=args.series, port=args.port).start()
+    print("fake VictoriaMetrics listening on " + vm.url)
+    while True:
+        time.sleep(60)
+        print(vm.reset_stats())
@@ -0,0 +1,78 @@
+'''
+Warm-started Prophet refits against cold ones
+
+    python test/model/warm_start_test.py --series 10
+
+Every series is fitted on a first window, then refitted on the window one day later twice : from scratch, and warm started
+from the first fit as ProphetModel stores it (packed, then rebuilt). The warm refits must take fewer optimizer iterations
+and reach the same fit, within the noise of the series.
+'''
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, ROOT)
+
+# standard deviation of the noise of the series
+NOISE = 0.3
+
+def _series(rng : np.random.Generator, pos : int, start : int, hours : int) -> pd.DataFrame:
+    # hourly, daily seasonality and a trend changing once, by a different amount for each series
+    t = np.arange(start, start + hours)
+    trend = 0.01 * t * (1 + (t > 200) * (pos % 3))
+    y = 10 + pos + trend + 2 * np.sin(t / 24 * 2 * np.pi) + rng.normal(0, NOISE, hours)
+    return pd.DataFrame({"ds": pd.Timestamp("2024-01-01") + pd.to_timedelta(t, unit="h"), "y": y})
+
+def run(args : argparse.Namespace) -> Dict[str, Any]:
+    from prophet import Prophet
+    from model.m_prophet import _PackedInstance, _new_prophet
+    # lines per fit otherwise
+    for noisy in ("cmdstanpy", "prophet"):
+        logging.getLogger(noisy).disabled = True
+    rng = np.random.default_rng(args.seed)
+    report = {"series": args.series, "warm_started": 0, "cold_iterations": 0, "warm_iterations": 0,
+              "cold_s": 0.0, "warm_s": 0.0, "max_yhat_diff": 0.0}
+    for pos in range(args.series):
+        sid = str(pos)
+        first = Prophet()
+        first.fit(_series(rng, pos, 0, args.hours))
+        previous = _PackedInstance().with_models({sid: first}).get(sid)
+        window = _series(rng, pos, 24, args.hours)
+        fits = {}
+        for start, prev in (("cold", None), ("warm", previous)):
+            model = _new_prophet({}, prev, 3.0)
+            start_t = time.perf_counter()
+            # every iteration of the optimizer is kept, to count them
+            model.fit(window, save_iterations=True)
+            report[start + "_s"] += time.perf_counter() - start_t
+            report[start + "_iterations"] += len(model.stan_backend.stan_fit.optimized_iterations_np)
+            fits[start] = model
+        report["warm_started"] += int(fits["warm"].warm_started)
+        yhat = {start: model.predict(window[['ds']])['yhat'].values for start, model in fits.items()}
+        report["max_yhat_diff"] = max(report["max_yhat_diff"], float(np.max(np.abs(yhat["warm"] - yhat["cold"]))))
+    if report["warm_started"] != args.series:
+        raise AssertionError("a refit started cold : " + str(report))
+    if report["warm_iterations"] >= report["cold_iterations"]:
+        raise AssertionError("warm starts did not save optimizer iterations : " + str(report))
+    # the optimum moves within the noise, the fits may differ by less than it
+    if report["max_yhat_diff"] > NOISE:
+        raise AssertionError("warm and cold refits disagree : " + str(report))
+    report["cold_s"], report["warm_s"] = round(report["cold_s"], 3), round(report["warm_s"], 3)
+    report["max_yhat_diff"] = round(report["max_yhat_diff"], 4)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="warm-started Prophet refits against cold ones")
+    parser.add_argument("--series", type=int, help="series refitted, default 10", default=10)
+    parser.add_argument("--hours", type=int, help="hourly samples of a window, default 336", default=336)
+    parser.add_argument("--seed", type=int, help="seed of the generated series, default 1", default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(filename)s - %(levelname)s - %(message)s')
+    print(run(args))
@@ -0,0 +1,157 @@
+import collections
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Tuple
+
+import pulsar
+
+class FakeMessage():
+    def __init__(self, topic : str, data : bytes, partition_key : str = None, message_id : int = 0) -> None:
+        self.topic = topic
+        self.payload = data
+        self.key = partition_key
+        self.id = message_id
+        self.redelivery_count = 0
+
+    def data(self) -> bytes:
+        return self.payload
+
+    def partition_key(self) -> str:
+        return self.key
+
+    def message_id(self) -> int:
+        return self.id
+
+class FakeBroker():
+    '''
+    In-process stand-in of a Pulsar broker for the streaming tests
+    Topics keep every message, a subscription delivers each message once to its consumers,
+    a negatively acknowledged message is delivered again after the redelivery delay of its consumer.
+    '''
+
+    def __init__(self) -> None:
+        self.cond = threading.Condition()
+        self.topics : Dict[str, List[FakeMessage]] = collections.defaultdict(list)
+        # {(topic, subscription) : [messages to deliver]}
+        self.backlog : Dict[Tuple[str, str], Deque[FakeMessage]] = {}
+        # (due time, (topic, subscription), message)
+        self.redeliveries : List[Tuple[float, Tuple[str, str], FakeMessage]] = []
+        self.stats = {"published": 0, "delivered": 0, "acked": 0, "nacked": 0}
+
+    def publish(self, topic : str, data : bytes, partition_key : str = None) -> FakeMessage:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.cond:
+            message = FakeMessage(topic, data, partition_key, self.stats["published"])
+            self.topics[topic].append(message)
+            for (t, _), backlog in self.backlog.items():
+                if t == topic:
+                    backlog.append(message)
+            self.stats["published"] += 1
+            self.cond.notify_all()
+        return message
+
+    def messages(self, topic : str) -> List[FakeMessage]:
+        with self.cond:
+            return list(self.topics.get(topic, []))
+
+    def subscribe(self, topic : str, subscription : str) -> None:
+        with self.cond:
+            # a new subscription starts at the end of the topic, like the default initial position
+            self.backlog.setdefault((topic, subscription), collections.deque())
+
+    def receive(self, topic : str, subscription : str, timeout_ms : int) -> FakeMessage:
+        deadline = time.time() + timeout_ms / 1000.0
+        key = (topic, subscription)
+        with self.cond:
+            while True:
+                now = time.time()
+                due = [r for r in self.redeliveries if r[0] <= now and r[1] == key]
+                for r in due:
+                    self.redeliveries.remove(r)
+                    r[2].redelivery_count += 1
+                    self.backlog[key].appendleft(r[2])
+                if len(self.backlog[key]) > 0:
+                    self.stats["delivered"] += 1
+                    return self.backlog[key].popleft()
+                if now >= deadline:
+                    raise pulsar.Timeout()
+                waits = [r[0] - now for r in self.redeliveries if r[1] == key] + [deadline - now]
+                self.cond.wait(max(min(waits), 0.001))
+
+    def acknowledge(self, message : FakeMessage) -> None:
+        with self.cond:
+            self.stats["acked"] += 1
+
+    def negative_acknowledge(self, key : Tuple[str, str], message : FakeMessage, delay_ms : int) -> None:
+        with self.cond:
+            self.stats["nacked"] += 1
+            self.redeliveries.append((time.time() + delay_ms / 1000.0, key, message))
+            self.cond.notify_all()
+
+class FakeProducer():
+    def __init__(self, broker : FakeBroker, topic : str, **kwargs : Any) -> None:
+        self.broker = broker
+        self.topic = topic
+        self.kwargs = kwargs
+        self.closed = False
+
+    def send(self, content : bytes, partition_key : str = None, **kwargs : Any) -> int:
+        return self.broker.publish(self.topic, content, partition_key).id
+
+    def send_async(self, content : bytes, callback : Callable[[Any, Any], None], partition_key : str = None, **kwargs : Any) -> None:
+        message = self.broker.publish(self.topic, content, partition_key)
+        if callback is not None:
+            callback(pulsar.Result.Ok, message.id)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+class FakeConsumer():
+    def __init__(self, broker : FakeBroker, topic : str, subscription : str, negative_ack_redelivery_delay_ms : int = 60000,
+                 **kwargs : Any) -> None:
+        self.broker = broker
+        self.key = (topic, subscription)
+        self.delay_ms = negative_ack_redelivery_delay_ms
+        self.closed = False
+        broker.subscribe(topic, subscription)
+
+    def receive(self, timeout_millis : int = None) -> FakeMessage:
+        if self.closed:
+            raise pulsar.AlreadyClosed()
+        return self.broker.receive(self.key[0], self.key[1], 2 ** 31 if timeout_millis is None else timeout_millis)
+
+    def acknowledge(self, message : FakeMessage) -> None:
+        self.broker.acknowledge(message)
+
+    def negative_acknowledge(self, message : FakeMessage) -> None:
+        self.broker.negative_acknowledge(self.key, message, self.delay_ms)
+
+    def close(self) -> None:
+        self.closed = True
+
+class FakeClient():
+    def __init__(self, broker : FakeBroker, service_url : str = None, **kwargs : Any) -> None:
+        self.broker = broker
+        self.service_url = service_url
+
+    def create_producer(self, topic : str, **kwargs : Any) -> FakeProducer:
+        return FakeProducer(self.broker, topic, **kwargs)
+
+    def subscribe(self, topic : str, subscription_name : str, **kwargs : Any) -> FakeConsumer:
+        return FakeConsumer(self.broker, topic, subscription_name, **kwargs)
+
+    def close(self) -> None:
+        pass
+
+def install(broker : FakeBroker = None) -> FakeBroker:
+    '''
+    route the clients created by connector.Pulsar to 'broker'
+    '''
+    import connector.mqpulsar
+    broker = broker if broker is not None else FakeBroker()
+    connector.mqpulsar.pulsar.Client = lambda *args, **kwargs: FakeClient(broker, *args, **kwargs)
+    return broker
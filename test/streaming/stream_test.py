@@ -0,0 +1,194 @@
+'''
+Streaming infer against in-process stand-ins of Pulsar and VictoriaMetrics
+
+    python test/streaming/stream_test.py --series 200
+
+A task of the Streaming scheduler is fitted from the fake VictoriaMetrics, then samples are pushed to the fake broker:
+every sample is scored and written once, a spike is flagged, the messages are acknowledged,
+and a batch whose write failed is delivered again and written after the redelivery delay.
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "test", "benchmark"))
+
+import fake_pulsar
+from fake_vm import FakeVictoriametrics
+
+TENANT = "1"
+QUERY_NAME = "stream"
+TOPIC = "persistent://metrics/{tenant}/samples"
+
+def _writer_class():
+    import connector
+
+    class CapturingWriter(connector.Connector):
+        '''
+        keeps the written results, the next 'fail' writes raise, the next 'refuse' writes return False
+        and the next 'unflushed' flushes return False (the results written since the previous flush are lost)
+        '''
+
+        def __init__(self) -> None:
+            self.lock = threading.Lock()
+            self.results : List[Tuple[Dict[str, str], Any, float]] = []
+            self.fail = 0
+            self.refuse = 0
+            self.unflushed = 0
+            self.buffered : List[Tuple[Dict[str, str], Any, float]] = []
+
+        def check_query_args(self, args : Dict[str, Any]) -> bool:
+            return False
+
+        def query_series(self, *args : Any) -> Any:
+            raise RuntimeError("write only")
+
+        def insert_series(self, *args : Any) -> bool:
+            raise RuntimeError("results are written by insert_result")
+
+        def insert_result(self, tenant : str, metrics_prefix : str, query_name : str, labels : Dict[str, str], result : Any) -> bool:
+            with self.lock:
+                if self.fail > 0:
+                    self.fail -= 1
+                    raise IOError("write refused by the test")
+                if self.refuse > 0:
+                    self.refuse -= 1
+                    return False
+                self.buffered.append((dict(labels), result, time.time()))
+            return True
+
+        def flush(self, tenant : str = None) -> bool:
+            with self.lock:
+                buffered, self.buffered = self.buffered, []
+                if self.unflushed > 0:
+                    self.unflushed -= 1
+                    return False
+                self.results.extend(buffered)
+            return True
+
+        def take(self) -> List[Tuple[Dict[str, str], Any, float]]:
+            with self.lock:
+                results, self.results = self.results, []
+            return results
+
+    return CapturingWriter()
+
+def _lines(vm : FakeVictoriametrics, ts : int, spike : int = None) -> str:
+    # the values the fake datasource would return at 'ts', in the band of the fit
+    rows = json.loads(vm.render(ts, ts, 60))["data"]["result"]
+    lines = []
+    for i, row in enumerate(rows):
+        value = 1e6 if i == spike else float(row["values"][0][1])
+        lines.append('bench_metric{job="bench",instance="host-' + str(i) + '"} ' + str(value) + ' ' + str(ts))
+    return "\n".join(lines)
+
+def _wait(predicate, timeout : float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+def run(args : argparse.Namespace) -> Dict[str, Any]:
+    broker = fake_pulsar.install()
+    import common
+    import connector
+    import model
+    import scheduler
+    common.check_home_folder(args.home if args.home is not None else tempfile.mkdtemp(prefix="stream-test-"))
+    vm = FakeVictoriametrics(series=args.series).start()
+    reader = connector.Victoriametrics(datasource_url=vm.url, multi_tenant=True, cache_size_mb=0)
+    stream = connector.Pulsar(source_topic=TOPIC, stream_batch_size=args.batch, stream_linger="1s", redelivery_delay="1s")
+    writer = _writer_class()
+    sch = scheduler.Streaming(max_tasks=-1, checkpoint=False)
+    sch.connectors = {"stream": stream}
+    # a band wide enough for the synthetic series, only the spike is out of it
+    sch.schedule("stream-test", TENANT, reader, writer, model.ZScoreModel(), {"method": "std", "threshold": 20},
+                 {QUERY_NAME: {"queries": 'bench_metric{job="bench"}', "sampling_period_fit": "60s",
+                               "sampling_period_infer": "60s"}},
+                 {"fit_window": "1d", "infer_window": "10m", "stream_source": "stream"})
+    topic = TOPIC.replace("{tenant}", TENANT)
+    report = {"series": args.series}
+    try:
+        if not _wait(lambda: sch.queue_stats()["fit"]["finished"] >= 1, 60):
+            raise AssertionError("the task was not fitted")
+        now = int(time.time()) // 60 * 60
+        # every sample is scored once, the spike is flagged
+        sent = time.time()
+        broker.publish(topic, _lines(vm, now - 60))
+        broker.publish(topic, _lines(vm, now, spike=0))
+        # both messages may fall in one micro-batch, the samples are counted
+        scored = lambda: sum(len(result.timestamps()) for _, result, _ in list(writer.results))
+        if not _wait(lambda: scored() >= 2 * args.series, 30):
+            raise AssertionError("%d samples scored, expected %d" % (scored(), 2 * args.series))
+        time.sleep(1.5)
+        results = writer.take()
+        report["latency_s"] = round(max(t for _, _, t in results) - sent, 3)
+        rows = sum(len(result.timestamps()) for _, result, _ in results)
+        if rows != 2 * args.series:
+            raise AssertionError("%d samples scored, expected %d" % (rows, 2 * args.series))
+        # out of the band when |score| > 1
+        flagged = {labels["instance"] for labels, result, _ in results if np.nanmax(np.abs(result.data["anomaly_score"])) > 1}
+        if flagged != {"host-0"}:
+            raise AssertionError("anomalies flagged on " + str(sorted(flagged)))
+        if not _wait(lambda: broker.stats["acked"] == 2, 5):
+            raise AssertionError("messages acked: " + str(broker.stats))
+        # a failed write is delivered again, then written once
+        writer.fail = 1
+        broker.publish(topic, _lines(vm, now + 60, spike=1))
+        if not _wait(lambda: broker.stats["nacked"] >= 1, 10):
+            raise AssertionError("the failed batch was not nacked: " + str(broker.stats))
+        if not _wait(lambda: len(writer.results) >= args.series and broker.stats["acked"] >= 3, 30):
+            raise AssertionError("the failed batch was not delivered again: " + str(broker.stats))
+        time.sleep(1.5)
+        results = writer.take()
+        if sum(len(result.timestamps()) for _, result, _ in results) != args.series:
+            raise AssertionError("the redelivered batch was not written exactly once")
+        # a write returning False is a failure too
+        writer.refuse = 1
+        broker.publish(topic, _lines(vm, now + 120))
+        if not _wait(lambda: broker.stats["nacked"] >= 2, 10):
+            raise AssertionError("the refused batch was not nacked: " + str(broker.stats))
+        if not _wait(lambda: len(writer.results) >= args.series and broker.stats["acked"] >= 4, 30):
+            raise AssertionError("the refused batch was not delivered again: " + str(broker.stats))
+        time.sleep(1.5)
+        results = writer.take()
+        if sum(len(result.timestamps()) for _, result, _ in results) != args.series:
+            raise AssertionError("the refused batch was not written exactly once")
+        # a batch is only acked once its results are flushed by the writer
+        writer.unflushed = 1
+        broker.publish(topic, _lines(vm, now + 180))
+        if not _wait(lambda: broker.stats["nacked"] >= 3, 10):
+            raise AssertionError("the unflushed batch was not nacked: " + str(broker.stats))
+        if not _wait(lambda: len(writer.results) >= args.series and broker.stats["acked"] >= 5, 30):
+            raise AssertionError("the unflushed batch was not delivered again: " + str(broker.stats))
+        time.sleep(1.5)
+        results = writer.take()
+        if sum(len(result.timestamps()) for _, result, _ in results) != args.series:
+            raise AssertionError("the unflushed batch was not written exactly once")
+        report.update(broker.stats)
+    finally:
+        sch.stop("stream-test")
+        vm.stop()
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="streaming infer against in-process Pulsar and VictoriaMetrics stand-ins")
+    parser.add_argument("--series", type=int, help="series of the stream, default 200", default=200)
+    parser.add_argument("--batch", type=int, help="messages of a micro-batch, default 1000", default=1000)
+    parser.add_argument("--home", type=str, help="existing home folder of the scheduler, default a temporary one", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(filename)s - %(levelname)s - %(message)s')
+    print(run(args))